@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import logging
+import random
+import timeit
+import tracemalloc
+import numpy
+from iec6205621 import columnar
+from iec6205621 import parser
+
+# Parser throughput and memory on real and synthetic readouts
+# python3 bench_parser.py
+# python3 bench_parser.py --days 30 --entries 5000 --only p01
+#
+# For every payload and Parser entry point:
+#   us/op       time of one parse of the payload
+#   rows/s      parsed values (records) per second
+#   MB/s        raw readout bytes per second
+#   peak KB     tracemalloc peak during one parse
+#   B/row       memory held by the result per record
+#
+# Entry points: baseline (dict records), compact, stream and columnar for the load profiles
+
+logger = logging.getLogger('bench')
+logger.setLevel(logging.CRITICAL)
+
+meters = {
+    'emh': {'meter_id': '08354050', 'manufacturer': 'emh'},
+    'metcom': {'meter_id': '10067967', 'manufacturer': 'metcom'},
+}
+
+# Metcom list1 with history values, see iec6205621/test_server.py
+LIST1 = b'F.F(00000000)\r\n0.0.0(10067967)\r\n0.0.1(10067967)\r\n0.9.1(202405)\r\n0.9.2(221113)\r\n0.1.0(12)\r\n0.1.2(2211010000)\r\n0.1.2*12(2211010000)\r\n0.1.2*11(2210010000)\r\n0.1.2*10(2209010000)\r\n1.6.1(0.50262*kW)(2211120730)\r\n1.6.1*12(0.39912*kW)(2210130900)\r\n1.6.1*11(0.74906*kW)(2209281400)\r\n1.6.1*10(0.49578*kW)(2208111330)\r\n2.6.1(0.00000*kW)(2211010000)\r\n2.6.1*12(0.00000*kW)(2210010000)\r\n2.6.1*11(0.00000*kW)(2209010000)\r\n2.6.1*10(0.00000*kW)(2208010000)\r\n1.8.0(01281.6601*kWh)\r\n1.8.0*12(01236.1958*kWh)\r\n1.8.0*11(01158.9747*kWh)\r\n1.8.0*10(01097.4085*kWh)\r\n2.8.0(00000.0000*kWh)\r\n2.8.0*12(00000.0000*kWh)\r\n2.8.0*11(00000.0000*kWh)\r\n2.8.0*10(00000.0000*kWh)\r\n5.8.0(00049.1785*kvarh)\r\n5.8.0*12(00048.8006*kvarh)\r\n5.8.0*11(00045.9754*kvarh)\r\n5.8.0*10(00041.7958*kvarh)\r\n6.8.0(00000.0000*kvarh)\r\n6.8.0*12(00000.0000*kvarh)\r\n6.8.0*11(00000.0000*kvarh)\r\n6.8.0*10(00000.0000*kvarh)\r\n7.8.0(00000.0000*kvarh)\r\n7.8.0*12(00000.0000*kvarh)\r\n7.8.0*11(00000.0000*kvarh)\r\n7.8.0*10(00000.0000*kvarh)\r\n8.8.0(00079.9454*kvarh)\r\n8.8.0*12(00075.0837*kvarh)\r\n8.8.0*11(00062.7016*kvarh)\r\n8.8.0*10(00050.2358*kvarh)\r\n0.3.3(3000)\r\n0.2.2(00000001)\r\n0.2.0(01.01.28)\r\n0.2.0(02.02.13)\r\n0.2.0(2.2.8)\r\n!\r\n'
+
+# Metcom list2 (CEC), see test_parser.py
+LIST2 = b'1-0:1.8.0(00000391.3*Wh)^M\r\n1-0:2.8.0(00366818.9*Wh)^M\r\n1.7.0(0.00000*kW)^M\r\n2.7.0(0.00287*kW)^M\r\n3.7.0(0.00187*kvar)^M\r\n4.7.0(0.00000*kvar)^M\r\n13.7.0(0.000315*k)^M\r\n33.7.0(0.000327*k)^M\r\n53.7.0(0.000316*k)^M\r\n73.7.0(0.000304*k)^M\r\n21.7.0(0.00000*kW)^M\r\n22.7.0(0.00094*kW)^M\r\n41.7.0(0.00000*kW)^M\r\n42.7.0(0.00104*kW)^M\r\n61.7.0(0.00000*kW)^M\r\n62.7.0(0.00088*kW)^M\r\n1-0:32.7.0(57.90*V)^M\r\n1-0:52.7.0(57.86*V)^M\r\n1-0:72.7.0(58.10*V)^M\r\n1-0:31.7.0(0.050*A)^M\r\n1-0:51.7.0(0.057*A)^M\r\n1-0:71.7.0(0.050*A)^M\r\n90.7.0(0.157*A)^M\r\n1-0:81.7.0(0.0*deg)^M\r\n1-0:81.7.1(119.7*deg)^M\r\n1-0:81.7.2(-120.1*deg)^M\r\n1-0:81.7.4(145.0*deg)^M\r\n1-0:81.7.15(151.4*deg)^M\r\n1-0:81.7.26(149.7*deg)^M\r\n1-0:14.7.0(0.05000*kHz)^M\r\n9.7.0(0.00000*kVA)^M\r\n1-0:10.7.0(0.00239*kVA)^M\r\n!^M\r\n'
+
+# EMH P.01, 24 hours, z=8
+P01 = b'P.01(1221005001500)(00000000)(15)(8)(1-1:1.29)(kWh)(1-1:2.29)(kWh)(1-1:5.29)(kvarh)(1-1:6.29)(kvarh)(1-1:7.29)(kvarh)(1-1:8.29)(kvarh)(1-2:1.29)(kWh)(1-3:2.29)(kWh)\r\n'
+P01 += b'(0.00000)(0.04088)(0.00000)(0.00358)(0.00000)(0.00000)(0.00000)(0.00000)\r\n' * 96
+
+
+class Generator:
+    """
+    Synthetic readouts in the EMH and Metcom layouts, the same seed gives the same bytes
+
+    g = Generator('metcom')
+    g.p01(z=6, days=7)      P.01 block per day, 96 lines each
+    g.p98(entries=1000)     logbook with bursts of entries in the same second
+    """
+    start = datetime.datetime(2022, 10, 5)
+
+    # P.01 channels, z=6 Metcom and EMH, z=8 EMH with the second and third tariff channels
+    channels = {
+        6: [('1.5', 'kW'), ('2.5', 'kW'), ('5.5', 'kvar'), ('6.5', 'kvar'), ('7.5', 'kvar'), ('8.5', 'kvar')],
+        8: [('1-1:1.29', 'kWh'), ('1-1:2.29', 'kWh'), ('1-1:5.29', 'kvarh'), ('1-1:6.29', 'kvarh'),
+            ('1-1:7.29', 'kvarh'), ('1-1:8.29', 'kvarh'), ('1-2:1.29', 'kWh'), ('1-3:2.29', 'kWh')],
+    }
+
+    def __init__(self, manufacturer: str, seed: int = 62056):
+        self.manufacturer = manufacturer
+        self.random = random.Random(seed)
+
+    def _ts(self, dt: datetime.datetime):
+        # Season flag 0 + YYMMDDhhmmss
+        return f'0{dt.strftime("%y%m%d%H%M%S")}'
+
+    def _status(self, value: int):
+        return f'{value:02X}' if self.manufacturer == 'metcom' else f'{value:08X}'
+
+    def _obis(self, obis: str):
+        if self.manufacturer == 'metcom' and ':' not in obis:
+            return f'1-0:{obis}.0'
+        return obis
+
+    def list1(self, history: int = 12):
+        lines = ['F.F(00000000)', '0.0.0(10067967)', '0.0.1(10067967)', '0.9.1(202405)', '0.9.2(221113)', f'0.1.0({history})']
+        for obis, unit, digits in [('1.6.1', 'kW', 5), ('2.6.1', 'kW', 5)]:
+            lines.append(f'{obis}({self.random.random():.{digits}f}*{unit})(2211120730)')
+            for h in range(history, 0, -1):
+                lines.append(f'{obis}*{h:02}({self.random.random():.{digits}f}*{unit})(22{h % 12 + 1:02}130900)')
+        for obis, unit in [('1.8.0', 'kWh'), ('2.8.0', 'kWh'), ('5.8.0', 'kvarh'), ('6.8.0', 'kvarh'), ('7.8.0', 'kvarh'), ('8.8.0', 'kvarh')]:
+            value = self.random.uniform(0, 9999)
+            lines.append(f'{obis}({value:010.4f}*{unit})')
+            for h in range(history, 0, -1):
+                value *= 0.97
+                lines.append(f'{obis}*{h:02}({value:010.4f}*{unit})')
+        lines += ['0.3.3(3000)', '0.2.2(00000001)', '0.2.0(01.01.28)', '!']
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    def list2(self):
+        lines = []
+        for obis, unit in [('32.7.0', 'V'), ('52.7.0', 'V'), ('72.7.0', 'V'), ('31.7.0', 'A'), ('51.7.0', 'A'), ('71.7.0', 'A'),
+                           ('81.7.0', 'deg'), ('81.7.1', 'deg'), ('81.7.2', 'deg'), ('81.7.4', 'deg'), ('81.7.15', 'deg'),
+                           ('81.7.26', 'deg'), ('14.7.0', 'kHz'), ('1.7.0', 'kW'), ('2.7.0', 'kW'), ('3.7.0', 'kvar'), ('4.7.0', 'kvar')]:
+            prefix = '1-0:' if self.manufacturer == 'metcom' else ''
+            lines.append(f'{prefix}{obis}({self.random.uniform(-180, 240):.2f}*{unit})')
+        lines.append('!')
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    def p01(self, z: int = 6, days: int = 1, rp: int = 15):
+        lines = []
+        per_day = 24 * 60 // rp
+        for day in range(days):
+            ts = Generator.start + datetime.timedelta(days=day, minutes=rp)
+            header = ''.join(f'({self._obis(obis)})({unit})' for obis, unit in Generator.channels[z])
+            lines.append(f'P.01({self._ts(ts)})({self._status(0)})({rp})({z}){header}')
+            for n in range(per_day):
+                lines.append(''.join(f'({self.random.random() * 0.3:.5f})' for i in range(z)))
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    def p02(self, days: int = 30):
+        header = ''.join(f'(1-0:{obis})({unit})' for obis, unit in
+                         [('1.8.0', 'kWh'), ('2.8.0', 'kWh'), ('5.8.0', 'kvarh'), ('6.8.0', 'kvarh'), ('7.8.0', 'kvarh'), ('8.8.0', 'kvarh')])
+        lines = []
+        value = 2700.0
+        for day in range(days):
+            ts = Generator.start + datetime.timedelta(days=day)
+            value += self.random.uniform(0, 10)
+            lines.append(f'P.02({self._ts(ts)})({self._status(0)})(1440)(6){header}')
+            lines.append(f'({value:010.4f})(00000.0000)(00095.7249)(00000.0000)(00000.0000)(00203.1329)')
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    def p98(self, entries: int = 100):
+        lines = []
+        ts = Generator.start
+        for n in range(entries):
+            # Bursts of entries in the same second after an outage
+            if self.random.random() > 0.3:
+                ts += datetime.timedelta(seconds=self.random.randint(1, 3600))
+            if self.manufacturer == 'metcom':
+                lines.append(f'P.98({self._ts(ts)})(00)()(2)(0-0:C.11.0)()(0-0:C.11.10)()({self.random.randint(0, 9)})(0)')
+            else:
+                lines.append(f'P.98({self._ts(ts)})({1 << self.random.randint(0, 31):08X})()(0)')
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    def p99(self, entries: int = 100):
+        lines = []
+        ts = Generator.start
+        for n in range(entries):
+            ts += datetime.timedelta(seconds=self.random.randint(1, 3600))
+            lines.append(f'P.99({self._ts(ts)})({self.random.getrandbits(32):08X})()(0)')
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    def malformed(self, data: bytes, every: int = 10):
+        """
+        Every n-th line damaged: a value replaced by garbage or a value group lost
+        """
+        lines = data.split(b'\r\n')
+        for n in range(1, len(lines) - 1, every):
+            if self.random.random() > 0.5:
+                lines[n] = lines[n].replace(b'(0.', b'(x.', 1)
+            else:
+                lines[n] = lines[n][:lines[n].rfind(b'(')]
+        return b'\r\n'.join(lines)
+
+    @staticmethod
+    def truncated(data: bytes, ratio: float = 0.66):
+        """
+        Readout terminated by timeout in the middle of a line
+        """
+        return data[:int(len(data) * ratio)]
+
+
+def payloads(days: int = 1, entries: int = 100):
+    """
+    :return: [(name, raw_data, data_type, manufacturer), ...]
+    """
+    result = [
+        ('list1', LIST1, 'list1', 'metcom'),
+        ('list2', LIST2, 'list2', 'metcom'),
+        ('emh p01', P01, 'p01', 'emh'),
+    ]
+    for manufacturer in ['emh', 'metcom']:
+        g = Generator(manufacturer)
+        result += [
+            (f'{manufacturer} list1 h12', g.list1(history=12), 'list1', manufacturer),
+            (f'{manufacturer} list2', g.list2(), 'list2', manufacturer),
+            (f'{manufacturer} p01 z6 {days}d', g.p01(z=6, days=days), 'p01', manufacturer),
+            (f'{manufacturer} p02 {days * 30}d', g.p02(days=days * 30), 'p02', manufacturer),
+            (f'{manufacturer} p98 {entries}', g.p98(entries=entries), 'p98', manufacturer),
+            (f'{manufacturer} p99 {entries}', g.p99(entries=entries), 'p99', manufacturer),
+        ]
+        if manufacturer == 'emh':
+            result.append((f'emh p01 z8 {days}d', g.p01(z=8, days=days), 'p01', manufacturer))
+        p01 = g.p01(z=6, days=days)
+        result += [
+            (f'{manufacturer} p01 malformed', g.malformed(p01), 'p01', manufacturer),
+            (f'{manufacturer} p01 truncated', g.truncated(p01), 'p01', manufacturer),
+            (f'{manufacturer} list1 truncated', g.truncated(g.list1()), 'list1', manufacturer),
+            (f'{manufacturer} p98 truncated', g.truncated(g.p98(entries=entries)), 'p98', manufacturer),
+        ]
+    return result
+
+
+def entry_points(data_type: str):
+    """
+    Parser entry points which apply to the data type, name => function(raw_data, meter) returning records
+    """
+    def baseline(raw_data, meter):
+        # dict records, what the compact entry points are compared against
+        return parser.Parser(raw_data, data_type, logger, **meter).parse()
+
+    def parse_compact(raw_data, meter):
+        return parser.Parser(raw_data, data_type, logger, compact=True, **meter).parse()
+
+    def stream(raw_data, meter):
+        # 1 KB chunks as they come from the serial line
+        p = parser.Parser(b'', data_type, logger, compact=True, **meter)
+        return list(p.stream(raw_data[i:i + 1024] for i in range(0, len(raw_data), 1024)))
+
+    def parse_columnar(raw_data, meter):
+        return parser.Parser(raw_data, data_type, logger, **meter).parse_columnar()
+
+    result = {'baseline': baseline, 'compact': parse_compact, 'stream': stream}
+    if data_type in parser.Parser.profile_types:
+        result['columnar'] = parse_columnar
+    return result
+
+
+def count_rows(result):
+    # LoadProfile counts its values, so rows/s compares with the record entry points
+    if isinstance(result, columnar.LoadProfile):
+        return int(numpy.count_nonzero(~numpy.isnan(result.values)))
+    return len(result)
+
+
+def measure(function, raw_data, meter, repeat: int = 3):
+    """
+    :return: (seconds per call, rows, peak bytes, retained bytes) or None if the parser exits
+    """
+    try:
+        start = timeit.default_timer()
+        rows = count_rows(function(raw_data, meter))
+        first = timeit.default_timer() - start
+    except SystemExit:
+        return None
+
+    # About 50 ms per repeat, the whole suite stays within a minute
+    number = max(1, int(0.05 / first))
+    timer = timeit.Timer(lambda: function(raw_data, meter))
+    seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    tracemalloc.start()
+    result = function(raw_data, meter)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, rows, peak, retained
+
+
+def bench(name, raw_data, data_type, manufacturer='metcom', only=None):
+    for entry_point, function in entry_points(data_type).items():
+        if only and only not in f'{name} {entry_point}':
+            continue
+        result = measure(function, raw_data, meters[manufacturer])
+        label = f'{name} {entry_point}'
+        if result is None:
+            print(f'{label:<30} {len(raw_data) / 1024:8.1f} KB    parser exit')
+            continue
+        seconds, rows, peak, retained = result
+        print(f'{label:<30} {len(raw_data) / 1024:8.1f} KB {rows:8} rows {seconds * 1e6:10.1f} us/op '
+              f'{rows / seconds:11.0f} rows/s {len(raw_data) / seconds / 1e6:7.2f} MB/s '
+              f'{peak / 1024:9.1f} peak KB {retained / max(rows, 1):7.1f} B/row')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Parser benchmark')
+    arg_parser.add_argument('--days', type=int, default=1, help='P.01 days, P.02 has 30 times more')
+    arg_parser.add_argument('--entries', type=int, default=100, help='P.98/P.99 entries')
+    arg_parser.add_argument('--only', help='run payloads and entry points containing this string, like "p01" or "baseline"')
+    args = arg_parser.parse_args()
+
+    for name, raw_data, data_type, manufacturer in payloads(days=args.days, entries=args.entries):
+        bench(name, raw_data, data_type, manufacturer, only=args.only)
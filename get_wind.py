@@ -11,6 +11,7 @@ import requests
 import pandas as pd
 from windpowerlib import ModelChain, WindTurbine, create_power_curve
 import iec6205621.inserter as iec_inserter
+from iec6205621.scheduler import Scheduler
 from requests.auth import HTTPBasicAuth
 
 
@@ -682,7 +683,8 @@ def main(config_file):
 
     db = MeterDB(logger, **config['DB'])
     meters_in_db = []
-    last_runs = dict()
+    # Next run of every meter, refreshed from the DB every minute
+    scheduler = Scheduler()
     query_interval = int(config['API']['query_interval'])
 
     while True:
@@ -701,28 +703,15 @@ def main(config_file):
             query_interval = int(config['API']['query_interval'])
             # Re-read meters from DB every minute
             meters_in_db = db.get_meters_from_pg()
+            scheduler.sync(meters_in_db, query_interval)
 
         if len(meters_in_db) < 1:
             logger.info('No meters found')
             time.sleep(60)
             continue
 
-        # meters_to_process = meters_in_db
-        meters_to_process = []
-        for meter in meters_in_db:
-            meter_id = meter['meter_id']
-            check = time.time() // query_interval
-            if last_runs.get(meter_id):
-                # Meter in last_runs - it was processed already
-                if check > last_runs[meter_id]:
-                    logger.debug(f'{meter_id} Interval: {query_interval}, Last_run: {last_runs[meter_id]}, Check {check}')
-                    last_runs[meter_id] = check
-                    meters_to_process.append(meter)
-            else:
-                # Meter not in last_runs - it was not processed before
-                logger.debug(f'{meter_id} Interval: {query_interval}, Last_run: 0, Check {check}')
-                meters_to_process.append(meter)
-                last_runs[meter_id] = check
+        # Meters due now, each one is moved to its next slot
+        meters_to_process = scheduler.due()
 
         if len(meters_to_process) > 0:
 
@@ -759,8 +748,8 @@ def main(config_file):
                     )
 
         else:
-            # To decrease CPU usage
-            time.sleep(0.05)
+            # Sleep until the next meter is due, at most 1s to keep the config timer
+            time.sleep(scheduler.wait(limit=1))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+class Breaker:
+    """
+    Retries with exponential backoff and a circuit breaker per meter
+
+    A failed session is retried after retry_delay, 2 * retry_delay, 4 * retry_delay... seconds,
+    unless the regular interval comes first. After threshold failed sessions in a row the meter is parked (open):
+    its sessions are skipped for cooldown seconds, then a probe (TCP connect only) checks if it's back.
+    Probe OK - the next session is a trial (half-open), its success closes the breaker.
+    Probe or trial failed - parked again for twice the cooldown, up to max_cooldown.
+    Only an unreachable meter counts as failed. A data type which failed while the meter answered
+    is retried with the same backoff per data type, the breaker stays closed.
+
+    breaker = Breaker(retry_delay=30, threshold=5, cooldown=3600)
+    retry = breaker.failed('10067967', now, meter)      # retry time, None if the meter is parked
+    retry = breaker.retry(('10067967', 'p98'), now)     # retry time of one data type
+    breaker.succeeded('10067967', ['p01'])              # with the data types read
+    breaker.allows('10067967')                          # False while parked or probing
+    for meter in breaker.probes(now):                   # cooldown is over, probe them
+        ...
+    breaker.probed('10067967', ok=True, now=now)
+    """
+
+    def __init__(self, retry_delay: int = 30, threshold: int = 5, cooldown: int = 3600, max_cooldown: int = 86400):
+        self.retry_delay = retry_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # meter_id => [failures in a row, state, open until, cooldown, meter]
+        # state 'retry', 'open', 'probe' or 'half-open', meters without failures are not here
+        self.meters = dict()
+        # (meter_id, data_id) => failures in a row of the data type
+        self.backoff = dict()
+        self.retries = self.opened = self.probed_count = self.parked = 0
+
+    def failed(self, meter_id, now: float, meter: dict = None):
+        """
+        :return: time of the retry, None if the meter is parked
+        """
+        entry = self.meters.get(meter_id)
+        if entry is None:
+            entry = self.meters[meter_id] = [0, 'retry', 0, 0, meter]
+        entry[0] += 1
+        if meter is not None:
+            entry[4] = meter
+
+        if entry[1] == 'half-open':
+            # The trial after a good probe failed
+            self._open(entry, now, min(entry[3] * 2, self.max_cooldown))
+            return None
+        if entry[0] >= self.threshold:
+            self._open(entry, now, self.cooldown)
+            return None
+        self.retries += 1
+        return now + self.retry_delay * 2 ** (entry[0] - 1)
+
+    def _open(self, entry, now: float, cooldown: float):
+        entry[1] = 'open'
+        entry[2] = now + cooldown
+        entry[3] = cooldown
+        self.opened += 1
+
+    def retry(self, key, now: float) -> float:
+        """
+        :param key: (meter_id, data_id)
+        :return: time of the retry
+        """
+        failures = self.backoff[key] = self.backoff.get(key, 0) + 1
+        self.retries += 1
+        return now + self.retry_delay * 2 ** min(failures - 1, 16)
+
+    def succeeded(self, meter_id, data_ids=()):
+        self.meters.pop(meter_id, None)
+        for data_id in data_ids:
+            self.backoff.pop((meter_id, data_id), None)
+
+    def allows(self, meter_id) -> bool:
+        """
+        :return: False if the sessions of the meter are skipped, the skipped ones are counted
+        """
+        entry = self.meters.get(meter_id)
+        if entry is None or entry[1] in ('retry', 'half-open'):
+            return True
+        self.parked += 1
+        return False
+
+    def probes(self, now: float) -> list:
+        """
+        :return: meter dicts of the parked meters to be probed now, they stay parked until probed()
+        """
+        meters = []
+        for entry in self.meters.values():
+            if entry[1] == 'open' and entry[2] <= now:
+                entry[1] = 'probe'
+                meters.append(entry[4])
+        self.probed_count += len(meters)
+        return meters
+
+    def probed(self, meter_id, ok: bool, now: float):
+        entry = self.meters.get(meter_id)
+        if entry is None:
+            return
+        if ok:
+            entry[1] = 'half-open'
+        else:
+            self._open(entry, now, min(entry[3] * 2, self.max_cooldown))
+
+    def prune(self, meter_ids):
+        """
+        Forgets the meters not in meter_ids, removed from the DB or moved to another collector
+        """
+        known = set(self.meters) | {key[0] for key in self.backoff}
+        self.remove(known - set(meter_ids))
+
+    def remove(self, meter_ids):
+        """
+        Forgets only these meters, a few rows changed in the DB
+        """
+        meter_ids = set(meter_ids)
+        for meter_id in meter_ids:
+            self.meters.pop(meter_id, None)
+        for key in [key for key in self.backoff if key[0] in meter_ids]:
+            del self.backoff[key]
+
+    def stats(self) -> dict:
+        """
+        Meters per state now, retries, opened breakers, probes and skipped sessions since the previous call
+        """
+        stats = {'retry': 0, 'open': 0, 'probe': 0, 'half-open': 0}
+        for entry in self.meters.values():
+            stats[entry[1]] += 1
+        stats.update(retries=self.retries, opened=self.opened, probes=self.probed_count, parked=self.parked)
+        self.retries = self.opened = self.probed_count = self.parked = 0
+        return stats
@@ -7,6 +7,7 @@ from serial.serialutil import SerialException
 import sys
 import datetime
 import pytz
+from iec6205621 import dlms
 
 
 # TODO: Each function shall return {data: data, error_code: 1, error_text: asd}, the `library user shall decide wheather to terminate the flow. In other words - lib shall return object
@@ -64,6 +65,15 @@ def normalize_log_str(logstring: str):
             logstring = logstring.replace(sp_char, special_chars[sp_char])
     return logstring
 
+
+class NoAnswer(SystemExit):
+    """
+    Meter not reachable: no TCP connection, nothing received within Tr, serial error or <NAK> to the password
+    Exits like the other errors of the client, sys.exit(1) or sys.exit(0) for the connection,
+    request_sender.py counts only these against the parallel sessions limit
+    """
+
+
 class Meter:
     """
     Mode C
@@ -90,6 +100,8 @@ class Meter:
     CRLF = b'\r\n'
 
     CTLBYTES = SOH + STX + ETX
+    # bytes.translate() table clearing the parity bit of every byte
+    PARITY_TABLE = bytes(b & 0x7f for b in range(256))
 
     # Tr = 2.2      # Tr should be 2.2 seconds, but some meters respond longer
     Tr = 4
@@ -128,6 +140,18 @@ class Meter:
         self.MAX_BACKUP_ATTEMPTS = meter.get('max_backup_attempts') or 2
 
         self.mode = meter.get('mode') or True          # True => <ACK>050<CR><LF>, False => <ACK>051<CR><LF>
+
+        # Mode E (HDLC/DLMS) for load profiles, used only if the meter announces it in the identification message
+        self.use_mode_e = meter.get('mode_e') or False
+        self.mode_e_available = False
+        self.dlms_logical_address = meter.get('dlms_logical_address') or 1
+        self.dlms_physical_address = meter.get('dlms_physical_address') or 0x11
+
+        # Optional callable, receives the data sets while they are received (parity bits and control bytes removed)
+        # m.on_data = parser.feed
+        self.on_data = None
+        # Signed on in the programming mode, the next R5 command is sent right away, see send_to_meter()
+        self.programming_mode = False
         self._connect()
 
     def log(self, severity, logstring):
@@ -155,7 +179,7 @@ class Meter:
         except SerialException:
             self.log('WARN', 'Unable to establish TCP connection')
             self._mod_result_obj(1, 'Unable to establish TCP connection')
-            sys.exit(0)
+            raise NoAnswer(0)
 
     def _connect(self):
         connection_attempts = 0
@@ -182,8 +206,35 @@ class Meter:
         if connection_attempts == self.MAX_CONNECTION_ATTEMPTS:
             self.log('WARN', 'Exceeded maximum connection attempts. Unable to establish a TCP connection.')
             self._mod_result_obj(1, 'Exceeded maximum connection attempts. Failed to establish a TCP connection.')
-            sys.exit(0)
+            raise NoAnswer(0)
+
+
+    def end_session(self):
+        """
+        Leaves the programming mode, the next read starts with a new sign on over the same connection
+        HHU: <SOH>B0<ETX><BCC>
+        """
+        if not self.programming_mode:
+            return
+        self.programming_mode = False
+        frame = b'B0' + Meter.ETX
+        cmd = Meter.SOH + frame + Meter.bcc(frame)
+        self.log('DEBUG', f'HHU -> Meter: {cmd}')
+        try:
+            self.ser.write(cmd)
+            # Meter may answer with B0 as well, it is not part of the next response
+            time.sleep(0.5)
+            self.ser.reset_input_buffer()
+        except Exception as e:
+            self.log('WARN', f'Unable to end the session: {e}')
 
+    def close(self):
+        """
+        Ends the session and closes the connection
+        """
+        self.end_session()
+        if self.ser:
+            self.ser.close()
 
     def _request(self):
         """
@@ -229,13 +280,15 @@ class Meter:
                 baud_rate = self.BAUD_RATES[id_message[4]]
             else:
                 baud_rate = 'Unknown'
+            # /EMH5\2@... - enhanced capability "\2" means the meter is able to switch to mode E
+            self.mode_e_available = id_message[5:7] == '\\2'
             communication_id = id_message[7:-2]
-            self.log('DEBUG', f'Manufacturer: {manufacturer}, 20ms Tr support: {quick_tr}, baud rate: {baud_rate}, communication ID: {communication_id}')
+            self.log('DEBUG', f'Manufacturer: {manufacturer}, 20ms Tr support: {quick_tr}, baud rate: {baud_rate}, mode E: {self.mode_e_available}, communication ID: {communication_id}')
         except Exception as e:
             self.log('ERROR', f'ID {id_message} parsing error: "{e}"')
             return
 
-    def _ackOptionSelect(self, data_readout_mode: bool = True):
+    def _ackOptionSelect(self, data_readout_mode: bool = True, protocol: str = '0'):
         """
         Send ACK/optionSelect message (6.3.3)
         data_readout_mode = True (default)
@@ -243,16 +296,38 @@ class Meter:
             
         data_readout_mode = False
         HHU: <ACK>0511<CR><LF>
+
+        protocol = '2' - switch to mode E (HDLC), data_readout_mode is ignored
+        HHU: <ACK>252<CR><LF>
+        Meter: <ACK>252<CR><LF> (optional echo), then HDLC frames
         """
         
         baud_rate = '5'
+        if protocol == '2':
+            cmd = self.ACK + f'2{baud_rate}2\r\n'.encode()
+            self.log('DEBUG', f'HHU -> Meter: {cmd}')
+            self.ser.write(cmd)
+            # Some meters echo the acknowledgement before switching, drop it
+            tic = time.time()
+            echo = b''
+            while time.time() - tic < 1.5 and not echo.endswith(self.CRLF):
+                echo += self.ser.read(self.ser.in_waiting or 1)
+            self.log('DEBUG', f'Meter -> HHU: {echo}')
+            try:
+                # Mode E runs 8N1, socket:// URLs ignore it
+                self.ser.bytesize = serial.EIGHTBITS
+                self.ser.parity = serial.PARITY_NONE
+            except (SerialException, ValueError) as e:
+                self.log('WARN', f'Unable to switch to 8N1: {e}')
+            return
+
         if data_readout_mode:
             y = '0'
         else:
             # Programming mode
             y = '1'
         cmd = self.ACK + f'0{baud_rate}{y}\r\n'.encode()
-        return self._sendcmd_and_decode_response(cmd)
+        return self._sendcmd_and_clean_response(cmd, stream=data_readout_mode)
 
     def _command(self, password, password_type: str = 'utility'):
         if password_type == 'utility':
@@ -270,10 +345,11 @@ class Meter:
             time.sleep(0.5)
         return
 
-    def _sendcmd(self, cmd, data=None, etx=ETX, check_bcc=True):
+    def _sendcmd(self, cmd, data=None, etx=ETX, check_bcc=True, on_chunk=None):
         """
         param: cmd = 'R5'
         param: data = '1.8.1()'
+        param: on_chunk = callable, receives every chunk read from the meter
         """
 
         # Remember IEC 62056-21 timers:
@@ -305,7 +381,10 @@ class Meter:
             while True:
                 if self.ser.in_waiting > 0:
                     # If there is data to read - read it and reset the Tr timer
-                    result += self.ser.read(self.ser.in_waiting)
+                    chunk = self.ser.read(self.ser.in_waiting)
+                    result += chunk
+                    if on_chunk:
+                        on_chunk(chunk)
                     tic = time.time()
                     continue
                 elif self.ser.in_waiting == 0:
@@ -334,36 +413,70 @@ class Meter:
                             self.ser.close()
                             self.log('ERROR', 'No data received')
                             self._mod_result_obj(1, f'No data received')
-                            sys.exit(1)
+                            raise NoAnswer(1)
                         return result
-        except Exception as e:
+        except (SerialException, OSError) as e:
+            # Only the connection, errors of on_chunk (parser, inserter) are raised as they are
             self.log('ERROR', e)
             self._mod_result_obj(1, e)
-            sys.exit(1)
+            raise NoAnswer(1)
 
-    def _sendcmd_and_decode_response(self, cmd, data=None, etx=ETX, check_bcc=True):
+    def _sendcmd_and_clean_response(self, cmd, data=None, etx=ETX, check_bcc=True, stream=False):
         """
-            Send data to the meter, decode the response and return the result
+            Send data to the meter, remove parity bits and control bytes from the response
+            Returns bytes, the data sets are passed to the Parser without decoding
+            stream = True - the response is data sets, pass it to self.on_data while it is received
         """
-        response = self._sendcmd(cmd, data, etx=etx, check_bcc=check_bcc)
+        on_chunk = self._stream_filter(self.on_data) if stream and self.on_data else None
+        response = self._sendcmd(cmd, data, etx=etx, check_bcc=check_bcc, on_chunk=on_chunk)
         if response == Meter.NAK:
             # Try one retransmit
             self.log('WARN', f'{response} received, retransmitting')
-            response = self._sendcmd(cmd, data, etx=etx, check_bcc=check_bcc)
+            response = self._sendcmd(cmd, data, etx=etx, check_bcc=check_bcc, on_chunk=on_chunk)
             
-        self.data = Meter.drop_ctl_bytes(Meter.remove_parity_bits(response)).decode("ascii")
+        self.data = Meter.drop_ctl_bytes(Meter.remove_parity_bits(response))
+        return self.data
+
+    def _sendcmd_and_decode_response(self, cmd, data=None, etx=ETX, check_bcc=True):
+        """
+            Send data to the meter, decode the response and return the result
+            Used for the protocol messages, data sets are read with _sendcmd_and_clean_response()
+        """
+        self.data = self._sendcmd_and_clean_response(cmd, data, etx=etx, check_bcc=check_bcc).decode("ascii")
         self.log('DEBUG', self.data)
         return self.data
 
+    @staticmethod
+    def _stream_filter(on_data):
+        """
+        Cleans the chunks the same way as _sendcmd_and_clean_response() does with the whole response
+        <STX>P.01(...)<CR><LF>(0.00063)...<CR><LF><ETX><BCC>
+        Everything from <ETX> on (BCC) and a single <NAK> are not passed to on_data
+        """
+        etx_found = False
+
+        def on_chunk(chunk):
+            nonlocal etx_found
+            if etx_found or chunk == Meter.NAK:
+                return
+            chunk = Meter.remove_parity_bits(chunk)
+            if Meter.ETX in chunk:
+                etx_found = True
+                chunk = chunk[:chunk.index(Meter.ETX)]
+            chunk = Meter.drop_ctl_bytes(chunk)
+            if chunk:
+                on_data(chunk)
+        return on_chunk
+
     @staticmethod
     def drop_ctl_bytes(data):
         """Removes the standard delimiter bytes from the (response) data"""
-        return bytes(filter(lambda b: b not in Meter.CTLBYTES, data))
+        return data.translate(None, Meter.CTLBYTES)
 
     @staticmethod
     def remove_parity_bits(data):
         """Removes the parity bits from the (response) data"""
-        return bytes(b & 0x7f for b in data)
+        return data.translate(Meter.PARITY_TABLE)
 
     @staticmethod
     def bcc(data):
@@ -397,6 +510,9 @@ class Meter:
 
 
         """
+        # Lists are read in the data readout mode, a programming mode session of the previous read is ended
+        self.end_session()
+
         if list_number in ['1', 'list1']:
             return self._readList1()
         elif list_number in ['2', 'list2']:
@@ -426,10 +542,10 @@ class Meter:
                 return result
 
             elif self.manufacturer == 'emh':
-                return self._sendcmd_and_decode_response(cmd)
+                return self._sendcmd_and_clean_response(cmd, stream=True)
 
             elif self.manufacturer == 'metcom':
-                return self._sendcmd_and_decode_response(cmd)
+                return self._sendcmd_and_clean_response(cmd, stream=True)
 
             elif self.manufacturer == 'metcom_edge':
                 """
@@ -630,7 +746,7 @@ class Meter:
         if result.encode() == self.NAK:
             # TODO: retransmit on <NAK>
             self.log('WARN', f'<NAK> received: {result}, terminating')
-            sys.exit(1)
+            raise NoAnswer(1)
 
         if result == 'B0':
             self._mod_result_obj(1, f'{result} received, check password. Terminating')
@@ -684,6 +800,7 @@ class Meter:
         
         now = datetime.datetime.now(self.timezone)
         t_to = None
+        after = now
 
         # P01
 
@@ -726,6 +843,7 @@ class Meter:
                 # If variable not defined - just take 7 days ago
                 from_ts = now - datetime.timedelta(days=7)
                 
+            before = from_ts
             t_from = f"0{from_ts.strftime('%y%m%d%H%M')}"
 
         # data = f'P.0{profile_number}({t_from};{t_to})'.encode()
@@ -736,8 +854,71 @@ class Meter:
             data = f'P.0{profile_number}({t_from};)'.encode()
         cmd = b'R5'
 
+        if self.use_mode_e and profile_number in dlms.PROFILE_OBIS:
+            return self._readLoadProfileModeE(profile_number, before, after, in_cmd=cmd, in_data=data)
+
         return self.send_to_meter(in_cmd=cmd, in_data=data)
 
+    def _readLoadProfileModeE(self, profile_number, before, after, in_cmd: bytes, in_data: bytes):
+        """
+        Reads load profile in mode E with selective access by range
+        Falls back to mode C if the meter doesn't announce mode E
+
+        HHU -> Meter: /?{meter_id}!<CR><LF>
+        Meter -> HHU: /EMH5\\2@01LZQJL0013G<CR><LF>
+        HHU -> Meter: <ACK>252<CR><LF>
+        HDLC: SNRM/UA, AARQ/AARE, GET 1-0:99.1.0.255 attribute 2 with range [before, after], RLRQ/RLRE, DISC/UA
+
+        Returns the profile rendered in the mode C layout, see dlms.render_profile()
+        """
+        self.end_session()
+        self._request()
+        if not self.mode_e_available:
+            self.log('WARN', 'Mode E requested, but not announced by the meter. Using mode C')
+            return self._programming_mode_command(in_cmd=in_cmd, in_data=in_data)
+
+        self._ackOptionSelect(protocol='2')
+        client = dlms.DlmsClient(self.ser, self.log,
+                                 logical_address=self.dlms_logical_address,
+                                 physical_address=self.dlms_physical_address,
+                                 password=self.password,
+                                 timeout=self.Tr)
+        # The read profile is kept even if the meter doesn't confirm the disconnect
+        answering = True
+        try:
+            client.connect()
+            profile = client.read_profile(dlms.PROFILE_OBIS[profile_number], before, after)
+        except (dlms.DlmsTimeout, SerialException, OSError) as e:
+            answering = False
+            self.log('ERROR', f'Mode E P.0{profile_number} read failed: {e}')
+            self._mod_result_obj(1, f'Mode E P.0{profile_number} read failed: {e}')
+            raise NoAnswer(1)
+        except dlms.DlmsError as e:
+            # The meter answered, rejected association or data access error, like an (ERROR) answer in mode C
+            self.log('ERROR', f'Mode E P.0{profile_number} read failed: {e}')
+            self._mod_result_obj(1, f'Mode E P.0{profile_number} read failed: {e}')
+            sys.exit(1)
+        finally:
+            if answering:
+                try:
+                    client.disconnect()
+                except (dlms.DlmsError, SerialException, OSError) as e:
+                    self.log('WARN', f'Mode E disconnect failed: {e}')
+
+        try:
+            # Back to mode C for the next read over the same connection
+            self.ser.bytesize = serial.SEVENBITS
+            self.ser.parity = serial.PARITY_EVEN
+        except (SerialException, ValueError) as e:
+            self.log('WARN', f'Unable to switch back to 7E1: {e}')
+
+        self.log('DEBUG', f'Mode E P.0{profile_number}: {len(profile["rows"])} rows, columns {profile["columns"]}')
+        status_digits = 2 if self.manufacturer.startswith('metcom') else 8
+        self.data = dlms.render_profile(f'P.0{profile_number}', profile, status_digits)
+        if self.on_data:
+            self.on_data(self.data)
+        return self.data
+
     def send_to_meter(self, in_cmd: bytes, in_data: bytes):
         """
         Send sequence of messages to the meter, depending on the instance attributes.
@@ -747,10 +928,20 @@ class Meter:
 
         """
 
+        if self.programming_mode:
+            # Signed on by the previous read of the session, the meter waits for the next command
+            return self._programming_mode_read(in_cmd=in_cmd, in_data=in_data)
+
         # HHU -> Meter: /?{meter_id}!<CR><LF>
         # Meter -> HHU: /MCS5\@V0050710000051<CR><LF>
 
         self._request()
+        return self._programming_mode_command(in_cmd=in_cmd, in_data=in_data)
+
+    def _programming_mode_command(self, in_cmd: bytes, in_data: bytes):
+        """
+        Second part of send_to_meter(), executed after the identification message was received
+        """
 
         # HHU -> Meter: <ACK>051<CR><LF>
         # Meter -> HHU: <SOH>P0<STX>(00000001)<ETX><BCC>
@@ -758,11 +949,18 @@ class Meter:
 
         if self.password:
             self.send_password()
+        self.programming_mode = True
 
+        return self._programming_mode_read(in_cmd=in_cmd, in_data=in_data)
+
+    def _programming_mode_read(self, in_cmd: bytes, in_data: bytes):
+        """
+        One command in the programming mode, the meter stays signed on until end_session() or the inactivity timeout
+        """
         # HHU -> Meter: <SOH>R5<STX>P.01(01808130001;01808191600)<ETX><BCC>
         # Meter -> HHU: Data
-        result = self._sendcmd_and_decode_response(cmd=in_cmd, data=in_data)
-        if '(ERROR' in result:
+        result = self._sendcmd_and_clean_response(cmd=in_cmd, data=in_data, stream=True)
+        if b'(ERROR' in result:
             self._mod_result_obj(1, f'Meter responded with error: {result}')
             self.log('WARN', f'Meter responded with error: {result}')
             sys.exit(1)
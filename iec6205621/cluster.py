@@ -0,0 +1,147 @@
+import bisect
+import hashlib
+import socket
+import time
+from redis import Redis
+
+
+class HashRing:
+    """
+    Consistent hash of meter ids over collector nodes
+    Every node has replicas points on the hash circle, a meter belongs to the first point after its own hash.
+    md5 rather than crc32, similar names like collector1, collector2 and serial meter ids are spread evenly.
+    A joining node takes about 1/N of the meters from the others, the meters of a leaving node are spread
+    over the rest, the other meters stay where they are.
+
+    ring = HashRing(['collector1', 'collector2', 'collector3'])
+    ring.owner('10067967')      'collector2'
+    """
+
+    def __init__(self, nodes, replicas: int = 100):
+        self.nodes = sorted(set(nodes))
+        points = sorted((HashRing.hash(f'{node}#{n}'), node) for node in self.nodes for n in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], 'big')
+
+    def owner(self, key):
+        """
+        :return: node name, None for an empty ring
+        """
+        if not self.hashes:
+            return None
+        n = bisect.bisect(self.hashes, HashRing.hash(str(key))) % len(self.hashes)
+        return self.owners[n]
+
+
+class Cluster:
+    """
+    Several request_sender.py collectors sharing the meters of one schema
+    Membership is a Redis sorted set collectors:{group} of node => last heartbeat time,
+    nodes without a heartbeat for node_ttl seconds are dropped and their meters move to the others.
+
+    [CLUSTER]
+    redis_host = localhost
+    redis_port = 6379
+    node_id = collector1        # hostname by default, set it to run several collectors on one host
+    heartbeat = 10              # seconds
+    node_ttl = 30               # a node is dead after this many seconds without a heartbeat
+    lease_ttl = 900             # longest meter session
+
+    cluster = Cluster(logger, 'meters:all', **config['CLUSTER'])
+    if cluster.heartbeat():                 # every loop, True when a node joined or died
+        owned = [meter for meter in meters_in_db if cluster.owns(meter['meter_id'])]
+    cluster.leased('10067967', process_session, meter=meter, ...)
+
+    Right after a change the nodes may briefly disagree about the owner, a session holds the Redis lease
+    lease:{group}:{meter_id} so a meter is never read by two nodes at the same time.
+    Without Redis no node owns anything, the readouts couldn't be inserted anyway.
+    Node clocks should be in sync (NTP), heartbeats are compared to the local time.
+    """
+
+    def __init__(self, logger, group: str, **config):
+        self.logger = logger
+        self.node_id = config.get('node_id') or socket.gethostname()
+        self.heartbeat_interval = int(config.get('heartbeat') or 10)
+        self.node_ttl = int(config.get('node_ttl') or 30)
+        self.lease_ttl = int(config.get('lease_ttl') or 900)
+        self.nodes_key = f'collectors:{group}'
+        self.lease_prefix = f'lease:{group}'
+
+        # Thread safe, shared by the main loop and the pool workers
+        self.redis = Redis(host=config.get('redis_host') or 'localhost', port=int(config.get('redis_port') or 6379),
+                           socket_timeout=5, socket_connect_timeout=5)
+        # Deletes the lease only if it's still ours
+        self._release = self.redis.register_script(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0")
+
+        self.ring = HashRing([])
+        self.last_heartbeat = 0
+        # Last successful heartbeat
+        self.written = 0
+
+    def heartbeat(self, now: float = None) -> bool:
+        """
+        Refreshes our own heartbeat and reads the live nodes, at most once per heartbeat interval
+        :return: True if the membership has changed and the meters should be redistributed
+        """
+        now = time.time() if now is None else now
+        if now - self.last_heartbeat < self.heartbeat_interval:
+            return False
+        self.last_heartbeat = now
+
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zadd(self.nodes_key, {self.node_id: now})
+            pipe.zremrangebyscore(self.nodes_key, '-inf', now - self.node_ttl)
+            pipe.zrange(self.nodes_key, 0, -1)
+            # zrange is ordered by the heartbeat time, the ring by the name
+            nodes = sorted(node.decode() for node in pipe.execute()[2])
+            self.written = now
+        except Exception as e:
+            self.logger.error(f'{self.node_id} Redis heartbeat failed "{e}"')
+            if now - self.written < self.node_ttl:
+                # Short outage, the others still count us
+                return False
+            # The others have dropped us by now
+            nodes = []
+
+        if nodes == self.ring.nodes:
+            return False
+        self.logger.info(f'{self.node_id} Collectors {len(nodes)}: {nodes}')
+        self.ring = HashRing(nodes)
+        return True
+
+    def owns(self, meter_id) -> bool:
+        return self.ring.owner(meter_id) == self.node_id
+
+    def acquire(self, meter_id) -> bool:
+        """
+        :return: True if the lease of the meter is ours for lease_ttl seconds
+        """
+        try:
+            return bool(self.redis.set(f'{self.lease_prefix}:{meter_id}', self.node_id, nx=True, ex=self.lease_ttl))
+        except Exception as e:
+            self.logger.error(f'{meter_id} Redis lease failed "{e}"')
+            return False
+
+    def release(self, meter_id):
+        try:
+            self._release(keys=[f'{self.lease_prefix}:{meter_id}'], args=[self.node_id])
+        except Exception as e:
+            self.logger.error(f'{meter_id} Redis lease release failed "{e}"')
+
+    def leased(self, meter_id, fn, **kwargs):
+        """
+        Runs fn(**kwargs) holding the lease of the meter, skipped if another node holds it
+        """
+        if not self.acquire(meter_id):
+            self.logger.warning(f'{meter_id} no lease, read by another collector or Redis is not available, skipping this interval')
+            return None
+        try:
+            return fn(**kwargs)
+        finally:
+            self.release(meter_id)
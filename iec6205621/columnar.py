@@ -0,0 +1,99 @@
+import numpy as np
+
+
+def id_prefix(kz: str) -> str:
+    """
+    We need to separate P.02..P.10 data from P.01, cause obis is reused
+    'P.01' => '', 'P.02' => 'p02-', 'P.03' => 'p03-'
+    """
+    return '' if kz == 'P.01' else f'p{kz[2:]}-'
+
+
+def status_id(kz: str) -> str:
+    """
+    Record id of the interval status word, 'P.01' => 'p01-status'
+    """
+    return f'p{kz[2:]}-status'
+
+
+# Bits of the interval status stored in the pNN-status record, the DLMS profile status layout:
+#   bit 0 ERR critical error, 1 CIV clock invalid, 2 DNV data not valid, 5 CAD clock adjusted, 7 PDN power down
+# The informational bits are dropped, 3 DST (Metcom (08) half of the year), 4 and 6 reserved,
+# 8..31 of the EMH status word are manufacturer specific
+STATUS_FLAGS = {
+    'emh': 0xa7,
+    'metcom': 0xa7,
+}
+
+
+def status_flags(manufacturer: str) -> int:
+    return STATUS_FLAGS.get(manufacturer, 0xa7)
+
+
+class LoadProfile:
+    """
+    Columnar load profile as returned by Parser.parse_columnar()
+
+    P.01(1220823161500)(00000000)(15)(6)(1.5)(kW)(2.5)(kW)(5.5)(kvar)(6.5)(kvar)(7.5)(kvar)(8.5)(kvar)
+    (0.18374)(0.00078)(0.00000)(0.00006)(0.00087)(0.02431)
+    (0.16832)(0.00000)(0.00000)(0.00000)(0.00000)(0.02686)
+
+    ts      int64[2]        [1661264100, 1661265000]
+    values  float64[2, 6]   [[0.18374, 0.00078, 0.0, 0.00006, 0.00087, 0.02431], [0.16832, 0.0, 0.0, 0.0, 0.0, 0.02686]]
+    obis    ['1.5', '2.5', '5.5', '6.5', '7.5', '8.5']
+    units   ['kW', 'kW', 'kvar', 'kvar', 'kvar', 'kvar']
+    status  uint32[2]       [0, 0]
+
+    A channel which is not present in a block (header changed in the middle of the readout)
+    or a value which could not be parsed is NaN
+    status is the block status word of each interval, Metcom (08) => 8, EMH (00000000) => 0
+    status_flags are the bits of it written by to_records(), see STATUS_FLAGS
+    """
+
+    def __init__(self, kz: str, ts, values, obis: list, units: list, status, status_flags: int = 0xa7):
+        self.kz = kz
+        self.ts = np.asarray(ts, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64).reshape(len(self.ts), len(obis))
+        self.obis = obis
+        self.units = units
+        self.status = np.asarray(status, dtype=np.uint32)
+        self.status_flags = status_flags
+
+        self.id_prefix = id_prefix(kz)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __repr__(self):
+        return f'<LoadProfile {self.kz} {len(self.ts)} intervals x {len(self.obis)} channels>'
+
+    @property
+    def ids(self):
+        return [f'{self.id_prefix}{obis}' for obis in self.obis]
+
+    def to_records(self):
+        """
+        Row format used by Parser.parse() and expected by Inserter
+        :return: [{'id': '1.5', 'value': '0.18374', 'unit': 'kW', 'line_time': '1661264100'}, ...]
+        Values are rendered from float64, leading and trailing zeros of the meter output are not kept
+        An interval with a validity flag is one more record {'id': 'p01-status', 'value': '128', 'unit': None, ...}
+        """
+        ids = self.ids
+        status_record_id = status_id(self.kz)
+        records = []
+        flags = (self.status & self.status_flags).tolist()
+        for ts, row, status in zip(self.ts.tolist(), self.values.tolist(), flags):
+            line_time = str(ts)
+            for i, value in enumerate(row):
+                if value != value:
+                    # NaN
+                    continue
+                records.append({
+                    'id': ids[i],
+                    'value': np.format_float_positional(value, trim='0'),
+                    'unit': self.units[i],
+                    'line_time': line_time
+                })
+            if status:
+                records.append({'id': status_record_id, 'value': str(status), 'unit': None, 'line_time': line_time})
+        return records
@@ -1,6 +1,7 @@
 from redis import Redis
 import sys
-import json
+from iec6205621 import record
+from iec6205621.obis import Obis
 import time
 import psycopg2
 import configparser
@@ -108,7 +109,8 @@ class R2PG:
             db_response = self._execute_query(query)
 
             for i in db_response:
-                self.obis_cache[i[0]['obis']] = i[0]['id']
+                # Interned Obis keys, any lookup goes through Obis.parse()
+                self.obis_cache[Obis.parse(i[0]['obis'])] = i[0]['id']
             self.logger.info(f'{len(self.obis_cache)} OBIS codes loaded from DB')
             self.logger.debug(f'OBIS codes: {self.obis_cache}')
         except Exception as e:
@@ -182,7 +184,7 @@ class R2PG:
             for r_key in self.r_keys:
                 # Load key from Redis and transform it to JSON
                 data.append(
-                    (r_key, json.loads(self.r.get(r_key)))
+                    (r_key, record.loads(self.r.get(r_key)))
                 )
         except Exception as e:
             self.logger.error(f'Unable to get data: "{e}"')
@@ -253,8 +255,9 @@ class R2PG:
             for query_result in meter_query_data[1]:
                 # {'id': '0.0.0', 'value': '1', 'unit': None}
                 # {'id': '0.0.0', 'value': '1', 'unit': None, 'line_time': 'epoch'} - line_time exists if P01 was processed
-                value = query_result['value']
-                received_obis = query_result['id']
+                # Readings carry floats, no exponent in the DB
+                value = record.text(query_result['value'])
+                received_obis = Obis.parse(query_result['id'])
 
                 if 'line_time' in query_result:
                     # P01 line
@@ -264,10 +267,10 @@ class R2PG:
                 if received_obis not in self.obis_cache:
                     # Try updating DB/Cache
                     self.logger.error(f'OBIS {received_obis} not found in OBIS cache, skipping')
-                    if received_obis.endswith('P.01'):
+                    if received_obis.text.endswith('P.01'):
                         # TODO: в _add_obis не работает continue
                         continue
-                    elif '69.035' in received_obis:
+                    elif '69.035' in received_obis.text:
                         # Some issue with insertion: "INSERT INTO db.obis (obis) VALUES ('69.035');" 
                         # operation error: unterminated quoted string at or near "'69.035" LINE 1: INSERT INTO db.obis (obis) VALUES ('69.035
                         continue
@@ -275,7 +278,7 @@ class R2PG:
                     if not self._add_obis(received_obis):
                         continue
 
-                obis_id = self.obis_cache[query_result['id']]
+                obis_id = self.obis_cache[received_obis]
                 queries.append(f"EXECUTE m('{id}', to_timestamp('{ts}'), '{obis_id}', '{value}');")
         # self.logger.debug(query_header)
         # self.logger.debug(queries)
@@ -0,0 +1,592 @@
+import datetime
+import struct
+import time
+
+
+# IEC 62056-21 mode E: after the optical/TCP handshake the meter switches to
+# HDLC (IEC 62056-46) framing and speaks DLMS/COSEM (IEC 62056-53/62).
+# Only the subset needed to read profile generic objects is implemented:
+#   SNRM/UA, AARQ/AARE (no security or low level password), GET with
+#   selective access, GET with block transfer, RLRQ, DISC
+
+
+class DlmsError(Exception):
+    pass
+
+
+class DlmsTimeout(DlmsError):
+    """
+    No HDLC frame from the meter within the timeout
+    """
+
+
+HDLC_FLAG = 0x7E
+
+# HDLC control field
+SNRM = 0x93
+UA = 0x73
+DISC = 0x53
+DM = 0x1F
+FRMR = 0x97
+
+# LLC headers prepended to every I-frame information field
+LLC_REQUEST = b'\xe6\xe6\x00'
+LLC_RESPONSE = b'\xe6\xe7\x00'
+
+# A-XDR data types
+NULL = 0x00
+ARRAY = 0x01
+STRUCTURE = 0x02
+BOOLEAN = 0x03
+BIT_STRING = 0x04
+DOUBLE_LONG = 0x05
+DOUBLE_LONG_UNSIGNED = 0x06
+OCTET_STRING = 0x09
+VISIBLE_STRING = 0x0A
+INTEGER = 0x0F
+LONG = 0x10
+UNSIGNED = 0x11
+LONG_UNSIGNED = 0x12
+LONG64 = 0x14
+LONG64_UNSIGNED = 0x15
+ENUM = 0x16
+FLOAT32 = 0x17
+FLOAT64 = 0x18
+DATE_TIME = 0x19
+
+FIXED_SIZE_TYPES = {
+    BOOLEAN: '>?',
+    DOUBLE_LONG: '>i',
+    DOUBLE_LONG_UNSIGNED: '>I',
+    INTEGER: '>b',
+    LONG: '>h',
+    UNSIGNED: '>B',
+    LONG_UNSIGNED: '>H',
+    LONG64: '>q',
+    LONG64_UNSIGNED: '>Q',
+    ENUM: '>B',
+    FLOAT32: '>f',
+    FLOAT64: '>d',
+}
+
+# xDLMS APDU tags
+AARQ = 0x60
+AARE = 0x61
+RLRQ = 0x62
+RLRE = 0x63
+GET_REQUEST = 0xC0
+GET_RESPONSE = 0xC4
+
+GET_NORMAL = 0x01
+GET_NEXT = 0x02
+GET_WITH_DATABLOCK = 0x02
+
+# COSEM interface classes
+CLASS_DATA = 1
+CLASS_REGISTER = 3
+CLASS_EXTENDED_REGISTER = 4
+CLASS_PROFILE_GENERIC = 7
+CLASS_CLOCK = 8
+
+CLOCK_OBIS = '0-0:1.0.0.255'
+
+# Profile generic objects behind the mode C P.0x identifiers
+PROFILE_OBIS = {
+    '1': '1-0:99.1.0.255',
+    '2': '1-0:99.2.0.255',
+}
+
+# DLMS unit enum => (unit as printed by the meter in mode C, factor)
+# Mode C load profiles report kW/kvar/kWh, DLMS reports the base unit
+UNITS = {
+    8: ('deg', 1),
+    27: ('kW', 0.001),
+    28: ('kVA', 0.001),
+    29: ('kvar', 0.001),
+    30: ('kWh', 0.001),
+    31: ('kVAh', 0.001),
+    32: ('kvarh', 0.001),
+    33: ('A', 1),
+    35: ('V', 1),
+    44: ('Hz', 1),
+    255: ('', 1),
+}
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data: bytes):
+    """
+    CRC-16/X.25 used for HDLC HCS and FCS
+    :param data: bytes
+    :return: int
+    """
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ b) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+def encode_address(address: int, logical: int = None):
+    """
+    HDLC address field, the last byte has the LSB set
+    :param address: client address or server lower (physical) address
+    :param logical: server upper (logical device) address, None for a one byte client address
+    :return: bytes
+    """
+    if logical is None:
+        return bytes([(address << 1) | 1])
+    if logical < 0x80 and address < 0x80:
+        return bytes([logical << 1, (address << 1) | 1])
+    return bytes([
+        (logical >> 7) << 1, (logical & 0x7F) << 1,
+        (address >> 7) << 1, ((address & 0x7F) << 1) | 1
+    ])
+
+
+def _decode_address(frame: bytes, pos: int):
+    end = pos
+    while not frame[end] & 1:
+        end += 1
+    return frame[pos:end + 1], end + 1
+
+
+def hdlc_frame(dest: bytes, src: bytes, control: int, info: bytes = b'', segmented: bool = False):
+    """
+    Builds HDLC frame format type 3
+    7E A0 LL <dest> <src> <control> [<HCS> <info>] <FCS> 7E
+    """
+    header_len = 2 + len(dest) + len(src) + 1
+    length = header_len + 2
+    if info:
+        length += 2 + len(info)
+    fmt = 0xA000 | (0x0800 if segmented else 0) | length
+    header = struct.pack('>H', fmt) + dest + src + bytes([control])
+    if info:
+        header += struct.pack('<H', crc16(header)) + info
+    return bytes([HDLC_FLAG]) + header + struct.pack('<H', crc16(header)) + bytes([HDLC_FLAG])
+
+
+def parse_hdlc_frame(frame: bytes):
+    """
+    :param frame: bytes from the opening to the closing flag, both included
+    :return: {'dest': b'', 'src': b'', 'control': 0x73, 'info': b'', 'segmented': False}
+    """
+    if len(frame) < 9 or frame[0] != HDLC_FLAG or frame[-1] != HDLC_FLAG:
+        raise DlmsError(f'Not a HDLC frame {frame}')
+    body = frame[1:-1]
+    fmt = struct.unpack('>H', body[:2])[0]
+    if fmt >> 12 != 0xA:
+        raise DlmsError(f'Unsupported HDLC frame format {fmt:04X}')
+    if fmt & 0x07FF != len(body):
+        raise DlmsError(f'HDLC frame length {fmt & 0x07FF}, received {len(body)}')
+    if struct.unpack('<H', body[-2:])[0] != crc16(body[:-2]):
+        raise DlmsError('HDLC FCS mismatch')
+
+    dest, pos = _decode_address(body, 2)
+    src, pos = _decode_address(body, pos)
+    control = body[pos]
+    pos += 1
+    info = b''
+    if len(body) > pos + 2:
+        if struct.unpack('<H', body[pos:pos + 2])[0] != crc16(body[:pos]):
+            raise DlmsError('HDLC HCS mismatch')
+        info = body[pos + 2:-2]
+    return {'dest': dest, 'src': src, 'control': control, 'info': info, 'segmented': bool(fmt & 0x0800)}
+
+
+def encode_length(length: int):
+    if length < 0x80:
+        return bytes([length])
+    elif length < 0x100:
+        return bytes([0x81, length])
+    return b'\x82' + struct.pack('>H', length)
+
+
+def decode_length(buf: bytes, pos: int):
+    length = buf[pos]
+    if length < 0x80:
+        return length, pos + 1
+    size = length & 0x7F
+    return int.from_bytes(buf[pos + 1:pos + 1 + size], 'big'), pos + 1 + size
+
+
+def encode_data(data_type: int, value=None):
+    """
+    A-XDR encoding of COSEM data
+    :param data_type: one of the type constants above
+    :param value: list of (data_type, value) for ARRAY/STRUCTURE, bytes for strings, number otherwise
+    :return: bytes
+    """
+    if data_type in (ARRAY, STRUCTURE):
+        return bytes([data_type]) + encode_length(len(value)) + b''.join(encode_data(*v) for v in value)
+    elif data_type in (OCTET_STRING, VISIBLE_STRING):
+        return bytes([data_type]) + encode_length(len(value)) + value
+    elif data_type == DATE_TIME:
+        return bytes([data_type]) + value
+    elif data_type == NULL:
+        return bytes([NULL])
+    elif data_type in FIXED_SIZE_TYPES:
+        return bytes([data_type]) + struct.pack(FIXED_SIZE_TYPES[data_type], value)
+    raise DlmsError(f'Unsupported data type {data_type}')
+
+
+def decode_data(buf: bytes, pos: int = 0):
+    """
+    A-XDR decoding of COSEM data
+    ARRAY/STRUCTURE => list, OCTET_STRING => bytes, VISIBLE_STRING => str, numbers => int/float
+    :return: (value, position after the value)
+    """
+    data_type = buf[pos]
+    pos += 1
+    if data_type in (ARRAY, STRUCTURE):
+        count, pos = decode_length(buf, pos)
+        result = []
+        for _ in range(count):
+            value, pos = decode_data(buf, pos)
+            result.append(value)
+        return result, pos
+    elif data_type in (OCTET_STRING, VISIBLE_STRING):
+        length, pos = decode_length(buf, pos)
+        value = bytes(buf[pos:pos + length])
+        if data_type == VISIBLE_STRING:
+            value = value.decode('ascii')
+        return value, pos + length
+    elif data_type == BIT_STRING:
+        bits, pos = decode_length(buf, pos)
+        size = (bits + 7) // 8
+        return int.from_bytes(buf[pos:pos + size], 'big'), pos + size
+    elif data_type == DATE_TIME:
+        return bytes(buf[pos:pos + 12]), pos + 12
+    elif data_type == NULL:
+        return None, pos
+    elif data_type in FIXED_SIZE_TYPES:
+        fmt = FIXED_SIZE_TYPES[data_type]
+        return struct.unpack_from(fmt, buf, pos)[0], pos + struct.calcsize(fmt)
+    raise DlmsError(f'Unsupported data type {data_type:02X} at position {pos - 1}')
+
+
+def obis_to_bytes(obis: str):
+    """
+    '1-0:99.1.0.255' => b'\x01\x00\x63\x01\x00\xff'
+    '1-0:1.29.0' => b'\x01\x00\x01\x1d\x00\xff'
+    """
+    ab, cdef = obis.split(':')
+    groups = [int(i) for i in ab.split('-') + cdef.split('.')]
+    if len(groups) == 5:
+        groups.append(255)
+    return bytes(groups)
+
+
+def obis_to_str(logical_name: bytes):
+    """
+    b'\x01\x00\x01\x1d\x00\xff' => '1-0:1.29.0'
+    Value group F is dropped when not used (255), the way mode C prints OBIS codes
+    """
+    a, b, c, d, e, f = logical_name
+    obis = f'{a}-{b}:{c}.{d}.{e}'
+    if f != 255:
+        obis = f'{obis}.{f}'
+    return obis
+
+
+def encode_datetime(dt: datetime.datetime):
+    """
+    COSEM date-time, deviation and clock status not specified
+    """
+    return struct.pack('>HBBBBBBBhB', dt.year, dt.month, dt.day, dt.isoweekday(),
+                       dt.hour, dt.minute, dt.second, 0xFF, -0x8000, 0xFF)
+
+
+def decode_datetime(value: bytes):
+    """
+    :param value: 12 bytes COSEM date-time
+    :return: (naive datetime in meter time, True if daylight saving is active)
+    """
+    year, month, day, _, hour, minute, second, _, _, status = struct.unpack('>HBBBBBBBhB', value)
+    dst = status != 0xFF and bool(status & 0x80)
+    return datetime.datetime(year, month, day, hour, minute, second if second != 0xFF else 0), dst
+
+
+def aarq(password: str = None):
+    """
+    AARQ for logical name referencing without ciphering
+    Lowest level security, or low level security when the password is provided
+    """
+    # Application context name: LN referencing, no ciphering (2.16.756.5.8.1.1)
+    body = b'\xa1\x09\x06\x07\x60\x85\x74\x05\x08\x01\x01'
+    if password:
+        # ACSE requirements: authentication, mechanism name: low level security (2.16.756.5.8.2.1)
+        body += b'\x8a\x02\x07\x80'
+        body += b'\x8b\x07\x60\x85\x74\x05\x08\x02\x01'
+        secret = password.encode()
+        body += b'\xac' + encode_length(len(secret) + 2) + b'\x80' + encode_length(len(secret)) + secret
+
+    # xDLMS InitiateRequest: DLMS version 6, conformance block transfer with get + get + selective access, max PDU 0xFFFF
+    initiate_request = b'\x01\x00\x00\x00\x06\x5f\x1f\x04\x00\x00\x10\x14\xff\xff'
+    body += b'\xbe' + encode_length(len(initiate_request) + 2) + b'\x04' + encode_length(len(initiate_request)) + initiate_request
+    return bytes([AARQ]) + encode_length(len(body)) + body
+
+
+def parse_aare(pdu: bytes):
+    """
+    :return: association result, 0 = accepted
+    """
+    if not pdu or pdu[0] != AARE:
+        raise DlmsError(f'AARE expected, received {pdu}')
+    length, pos = decode_length(pdu, 1)
+    end = pos + length
+    while pos < end:
+        tag = pdu[pos]
+        length, value_pos = decode_length(pdu, pos + 1)
+        if tag == 0xA2:
+            # A2 03 02 01 <result>
+            return pdu[value_pos + 2]
+        pos = value_pos + length
+    raise DlmsError(f'No association result in AARE {pdu}')
+
+
+def get_request(class_id: int, obis: str, attribute: int, access: bytes = None, invoke_id: int = 0xC1):
+    """
+    Get-Request-Normal
+    :param access: selective access descriptor, see range_descriptor()
+    """
+    pdu = bytes([GET_REQUEST, GET_NORMAL, invoke_id]) + struct.pack('>H', class_id) + obis_to_bytes(obis) + bytes([attribute])
+    if access:
+        return pdu + b'\x01' + access
+    return pdu + b'\x00'
+
+
+def get_request_next(block_number: int, invoke_id: int = 0xC1):
+    return bytes([GET_REQUEST, GET_NEXT, invoke_id]) + struct.pack('>I', block_number)
+
+
+def range_descriptor(time_from: datetime.datetime, time_to: datetime.datetime):
+    """
+    Selective access by range (selector 1) on the profile clock column, all columns selected
+    """
+    restricting_object = encode_data(STRUCTURE, [
+        (LONG_UNSIGNED, CLASS_CLOCK),
+        (OCTET_STRING, obis_to_bytes(CLOCK_OBIS)),
+        (INTEGER, 2),
+        (LONG_UNSIGNED, 0),
+    ])
+    descriptor = bytes([STRUCTURE, 4]) + restricting_object
+    descriptor += encode_data(OCTET_STRING, encode_datetime(time_from))
+    descriptor += encode_data(OCTET_STRING, encode_datetime(time_to))
+    descriptor += encode_data(ARRAY, [])
+    return b'\x01' + descriptor
+
+
+def parse_get_response(pdu: bytes):
+    """
+    :return: {'data': bytes, 'last': True, 'block': 0}
+        data - undecoded A-XDR value (or raw data block in case of block transfer)
+    """
+    if not pdu or pdu[0] != GET_RESPONSE:
+        raise DlmsError(f'Get-Response expected, received {pdu}')
+    if pdu[1] == GET_NORMAL:
+        if pdu[3] != 0:
+            raise DlmsError(f'Data access error {pdu[4]}')
+        return {'data': pdu[4:], 'last': True, 'block': 0}
+    elif pdu[1] == GET_WITH_DATABLOCK:
+        last = bool(pdu[3])
+        block = struct.unpack('>I', pdu[4:8])[0]
+        if pdu[8] != 0:
+            raise DlmsError(f'Data access error {pdu[9]} in block {block}')
+        length, pos = decode_length(pdu, 9)
+        return {'data': pdu[pos:pos + length], 'last': last, 'block': block}
+    raise DlmsError(f'Unsupported Get-Response type {pdu[1]}')
+
+
+class DlmsClient:
+    """
+    DLMS/COSEM client over HDLC
+    Works on top of any pyserial-like object with read(), write() and in_waiting
+    """
+
+    def __init__(self, transport, log, client_address: int = 0x10, logical_address: int = 1,
+                 physical_address: int = 0x11, password: str = None, timeout: int = 4):
+        self.transport = transport
+        self.log = log
+        self.client_address = encode_address(client_address)
+        self.server_address = encode_address(physical_address, logical_address)
+        self.password = password
+        self.timeout = timeout
+        self.send_sequence = 0
+        self.receive_sequence = 0
+        self.buffer = b''
+
+    def _write(self, frame):
+        self.log('DEBUG', f'HHU -> Meter: {frame.hex()}')
+        self.transport.write(frame)
+
+    def _read_frame(self):
+        """
+        Reads one HDLC frame, the frame length is taken from the format field
+        """
+        tic = time.time()
+        while True:
+            start = self.buffer.find(bytes([HDLC_FLAG]))
+            if start >= 0 and len(self.buffer) >= start + 3:
+                length = struct.unpack('>H', self.buffer[start + 1:start + 3])[0] & 0x07FF
+                if len(self.buffer) >= start + length + 2:
+                    frame = self.buffer[start:start + length + 2]
+                    self.buffer = self.buffer[start + length + 2:]
+                    self.log('DEBUG', f'Meter -> HHU: {frame.hex()}')
+                    return parse_hdlc_frame(frame)
+
+            if time.time() - tic > self.timeout:
+                raise DlmsTimeout(f'HDLC frame timeout, received {self.buffer}')
+            chunk = self.transport.read(self.transport.in_waiting or 1)
+            if chunk:
+                self.buffer += chunk
+                tic = time.time()
+
+    def _send_u_frame(self, control):
+        self._write(hdlc_frame(self.server_address, self.client_address, control))
+        return self._read_frame()
+
+    def _exchange(self, pdu: bytes):
+        """
+        Sends xDLMS APDU in an I-frame, returns response APDU
+        Segmented responses are acknowledged with RR until the last segment
+        """
+        control = (self.receive_sequence << 5) | 0x10 | (self.send_sequence << 1)
+        self._write(hdlc_frame(self.server_address, self.client_address, control, LLC_REQUEST + pdu))
+        self.send_sequence = (self.send_sequence + 1) % 8
+
+        response = b''
+        while True:
+            frame = self._read_frame()
+            if frame['control'] & 0x01:
+                raise DlmsError(f'I-frame expected, received control {frame["control"]:02X}')
+            self.receive_sequence = (self.receive_sequence + 1) % 8
+            response += frame['info']
+            if not frame['segmented']:
+                break
+            # Receive ready, ask for the next segment
+            self._write(hdlc_frame(self.server_address, self.client_address, (self.receive_sequence << 5) | 0x11))
+
+        if not response.startswith(LLC_RESPONSE):
+            raise DlmsError(f'Unexpected LLC header {response[:3]}')
+        return response[3:]
+
+    def connect(self):
+        frame = self._send_u_frame(SNRM)
+        if frame['control'] != UA:
+            raise DlmsError(f'UA expected for SNRM, received control {frame["control"]:02X}')
+
+        result = parse_aare(self._exchange(aarq(self.password)))
+        if result != 0:
+            raise DlmsError(f'Association rejected, result {result}')
+        self.log('DEBUG', 'DLMS association established')
+
+    def disconnect(self):
+        try:
+            self._exchange(b'\x62\x03\x80\x01\x00')
+        except DlmsError as e:
+            self.log('DEBUG', f'Release request failed: {e}')
+        self._send_u_frame(DISC)
+
+    def get(self, class_id: int, obis: str, attribute: int, access: bytes = None):
+        """
+        Reads one attribute, follows block transfer
+        :return: decoded value
+        """
+        response = parse_get_response(self._exchange(get_request(class_id, obis, attribute, access)))
+        data = response['data']
+        while not response['last']:
+            response = parse_get_response(self._exchange(get_request_next(response['block'])))
+            data += response['data']
+        return decode_data(data)[0]
+
+    def read_profile(self, obis: str, time_from: datetime.datetime, time_to: datetime.datetime):
+        """
+        Reads profile generic buffer for the time range
+        :return: {
+            'capture_period': 900,
+            'columns': [(class_id, '1-0:1.29.0', attribute), ...],
+            'scaler_units': {1: (-3, 27), ...},         # column index => (scaler, unit)
+            'rows': [[b'<date-time>', 8, 123, ...], ...]
+            }
+        """
+        capture_objects = self.get(CLASS_PROFILE_GENERIC, obis, 3)
+        columns = [(c[0], obis_to_str(c[1]), c[2]) for c in capture_objects]
+        scaler_units = dict()
+        for index, (class_id, column_obis, _) in enumerate(columns):
+            if class_id in (CLASS_REGISTER, CLASS_EXTENDED_REGISTER):
+                scaler, unit = self.get(class_id, column_obis, 3)
+                scaler_units[index] = (scaler, unit)
+
+        return {
+            'capture_period': self.get(CLASS_PROFILE_GENERIC, obis, 4),
+            'columns': columns,
+            'scaler_units': scaler_units,
+            'rows': self.get(CLASS_PROFILE_GENERIC, obis, 2, range_descriptor(time_from, time_to)),
+        }
+
+
+def render_profile(kz: str, profile: dict, status_digits: int = 8):
+    """
+    Renders a profile read in mode E the way the meter prints it in mode C
+    so the same Parser processes both, returns bytes like the mode C reads
+
+    P.01(1220823161500)(00000000)(15)(2)(1-0:1.29.0)(kWh)(1-0:2.29.0)(kWh)
+    (0.18374)(0.00078)
+    (0.16832)(0.00000)
+
+    A new header starts when the status changes or an interval is missing
+    A NULL-data value is rendered empty, (), the parser skips it like any value which is not a number
+    """
+    clock_index = None
+    status_index = None
+    channels = []
+    for index, (class_id, obis, _) in enumerate(profile['columns']):
+        if class_id == CLASS_CLOCK:
+            clock_index = index
+        elif class_id == CLASS_DATA and status_index is None:
+            status_index = index
+        elif index in profile['scaler_units']:
+            channels.append(index)
+    if clock_index is None:
+        raise DlmsError(f'No clock column in {profile["columns"]}')
+
+    rp = datetime.timedelta(seconds=profile['capture_period'])
+    header_tail = f'({rp.seconds // 60 + rp.days * 1440})({len(channels)})'
+    for index in channels:
+        scaler, unit = profile['scaler_units'][index]
+        unit_name = UNITS.get(unit, (str(unit), 1))[0]
+        header_tail += f'({profile["columns"][index][1]})({unit_name})'
+
+    lines = []
+    expected = None
+    last_status = None
+    for row in profile['rows']:
+        ts, dst = decode_datetime(row[clock_index])
+        status = row[status_index] if status_index is not None else 0
+        status = status or 0
+        if ts != expected or status != last_status:
+            lines.append(f'{kz}({int(dst)}{ts.strftime("%y%m%d%H%M%S")})({status:0{status_digits}X}){header_tail}')
+        values = ''
+        for index in channels:
+            scaler, unit = profile['scaler_units'][index]
+            if row[index] is None:
+                values += '()'
+                continue
+            values += f'({row[index] * 10 ** scaler * UNITS.get(unit, (None, 1))[1]:.5f})'
+        lines.append(values)
+        expected = ts + rp
+        last_status = status
+    return ('\r\n'.join(lines) + '\r\n').encode() if lines else b''
@@ -1,6 +1,5 @@
-import logging
 from redis import Redis
-import json
+from iec6205621 import record
 
 class Inserter:
 
@@ -20,25 +19,27 @@ class Inserter:
         #       2592000 - 30 days
         self.expiry = expiry
 
-    def insert(self, data):
-        return self.redis_insert(data)
+    def insert(self, data, part=None):
+        return self.redis_insert(data, part)
 
-    def redis_insert(self, data):
+    def redis_insert(self, data, part=None):
         """
-        :data: data to be sent to redis
+        :data: data to be sent to redis, list of dicts or record.Reading, see record.dumps()
+        :part: number of the batch when one readout is inserted in several parts, key org:meterId_ts:data_id:part
         :return: None, watch logs
         """
+        key = self.meter_ts if part is None else f'{self.meter_ts}:{part}'
         try:
-            data = json.dumps(data)
+            data = record.dumps(data)
             r = Redis(host=self.host, port=self.port)
             
             if self.expiry:
                 # Redis with automatic key expiry
-                r.set(name=self.meter_ts, value=data, ex=self.expiry)
+                r.set(name=key, value=data, ex=self.expiry)
             else:
-                r.set(name=self.meter_ts, value=data)
+                r.set(name=key, value=data)
     
-            self.logger.debug(f'{self.meter_id} {self.meter_ts} Redis insert successful')
+            self.logger.debug(f'{self.meter_id} {key} Redis insert successful')
             
             # Add statistics counter
             counter_name = f'stats_{self.org}_{self.data_id}'
@@ -46,5 +47,5 @@ class Inserter:
             r.incr(counter_name)
             return True
         except Exception as e:
-            self.logger.error(f'{self.meter_id} {self.meter_ts} Redis instert failed "{e}"')
+            self.logger.error(f'{self.meter_id} {key} Redis instert failed "{e}"')
             return False
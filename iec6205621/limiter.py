@@ -0,0 +1,49 @@
+class AIMD:
+    """
+    Number of parallel meter sessions, additive increase and multiplicative decrease like TCP congestion control
+
+    limit += 1 / limit  for every healthy session, one more session after a full round of limit sessions
+    limit *= decrease   for a failed session (connect timeout, no answer, NAK), once per round:
+                        sessions started before the last decrease don't decrease it again,
+                        a storm of timeouts from one bad minute halves the limit once, not to the minimum
+    slow session        longer than slow_factor * average, the limit holds
+
+    limit = AIMD(50, maximum=50)
+    if limit.allows(running):
+        ...
+    limit.done(ok=False, started=1661264100.0, finished=1661264112.0)     # 50 => 25
+    """
+
+    def __init__(self, limit: float, minimum: float = 1, maximum: float = None, decrease: float = 0.5,
+                 slow_factor: float = 2.0):
+        self.minimum = minimum
+        self.maximum = maximum or limit
+        self.limit = float(max(minimum, min(limit, self.maximum)))
+        self.decrease = decrease
+        self.slow_factor = slow_factor
+        # Moving average of the session time, seconds
+        self.latency = None
+        self.decreased = float('-inf')
+
+    def allows(self, running: int) -> bool:
+        return running < int(self.limit)
+
+    def done(self, ok: bool, started: float, finished: float):
+        """
+        :param ok: False if the session failed on the network side
+        :param started: monotonic time the session was started
+        """
+        if not ok:
+            if started >= self.decreased:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.decreased = finished
+            return
+
+        latency = finished - started
+        if self.latency is None or latency <= self.slow_factor * self.latency:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+
+    @property
+    def throttled(self) -> bool:
+        return int(self.limit) < self.maximum
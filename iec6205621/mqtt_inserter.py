@@ -1,6 +1,7 @@
 from redis import Redis
 import sys
-import json
+from iec6205621 import record
+from iec6205621.obis import Obis
 import time
 from paho.mqtt import client as mqtt_client
 import configparser
@@ -119,7 +120,8 @@ class R2MQTT:
             db_response = self._execute_query(query)
 
             for i in db_response:
-                self.obis_cache[i[0]['obis']] = i[0]['id']
+                # Interned Obis keys, any lookup goes through Obis.parse()
+                self.obis_cache[Obis.parse(i[0]['obis'])] = i[0]['id']
             self.logger.info(f'{len(self.obis_cache)} OBIS codes loaded from DB')
             self.logger.debug(f'OBIS codes: {self.obis_cache}')
         except Exception as e:
@@ -172,7 +174,7 @@ class R2MQTT:
             for r_key in self.r_keys:
                 # Load key from Redis and transform it to JSON
                 data.append(
-                    (r_key, json.loads(self.r.get(r_key)))
+                    (r_key, record.loads(self.r.get(r_key)))
                 )
         except Exception as e:
             self.logger.error(f'Unable to get data {e}')
@@ -223,8 +225,9 @@ class R2MQTT:
 
             for query_result in meter_query_data[1]:
                 # {'id': '0.0.0', 'value': '1', 'unit': None}
-                value = query_result['value']
-                received_obis = query_result['id']
+                # Compact readings have float values, the payload is text like the DB value
+                value = record.text(query_result['value'])
+                received_obis = Obis.parse(query_result['id'])
 
                 # Check for OBIS in cache
                 if received_obis not in self.obis_cache:
@@ -238,7 +241,7 @@ class R2MQTT:
                         self.logger.warn(f'Inserted OBIS {received_obis} for {query_result}')
                     """
 
-                obis_id = self.obis_cache[query_result['id']]
+                obis_id = self.obis_cache[received_obis]
 
                 # Values to push to MQTT
                 queries.append({
@@ -0,0 +1,162 @@
+import re
+import sys
+from iec6205621 import obis_codes
+
+
+class Obis:
+    """
+    OBIS identifier A-B:C.D.E*F, parsed once and interned
+
+    Obis.parse('1-0:1.8.0')     a='1', b='0', c='1', d='8', e='0'
+    Obis.parse('1.8.0*12')      c='1', d='8', e='0', f='12'
+    Obis.parse('1-1:1.29')      a='1', b='1', c='1', d='29'
+    Obis.parse('p02-1.8.0')     prefix='p02', c='1', d='8', e='0'
+    Obis.parse('0.9.1-value')   c='0', d='9', e='1', suffix='value'
+    Obis.parse('p99_bit3')      not an OBIS code, text only
+
+    The same spelling always returns the same object, so it's cheap as a dict key.
+    Metadata from obis_codes.py is resolved for any spelling of the code:
+
+    Obis.parse('1-0:1.5.0').zabbix_key      'positiveActiveDemand'
+    Obis.parse('1.5').transform             'totalFactor'
+    Obis.parse('p02-1.8.0').description     'Positive active energy (A+) total [kWh]'
+    """
+    __slots__ = ('text', 'prefix', 'a', 'b', 'c', 'd', 'e', 'f', 'suffix', 'short', 'key', '_meta', '__weakref__')
+
+    # [prefix-][A-B:]C.D[.E][*F][-suffix]
+    re_obis = re.compile(r'^(?:([a-z]\w*)-)?(?:(\w+)-(\w+):)?(\w+)\.(\w+)(?:\.(\w+))?(?:\*(\w+))?(?:-([a-z]\w*))?$')
+
+    _cache = dict()
+    # key => Meta, built from obis_codes.py on the first lookup
+    _index = None
+
+    def __init__(self, text: str):
+        self.text = sys.intern(text)
+        self._meta = None
+        match = Obis.re_obis.match(text)
+        if match is None:
+            self.prefix = self.a = self.b = self.c = self.d = self.e = self.f = self.suffix = None
+            self.short = self.text
+            self.key = (None, self.text, None)
+            return
+        self.prefix, self.a, self.b, self.c, self.d, self.e, self.f, self.suffix = match.groups()
+
+        # C.D[.E][*F] as written, the channel A-B: and the prefix are dropped, '1-0:1.5.0' => '1.5.0'
+        short = f'{self.c}.{self.d}'
+        if self.e is not None:
+            short += f'.{self.e}'
+        if self.f is not None:
+            short += f'*{self.f}'
+        self.short = sys.intern(short)
+        # Metadata key, E defaults to 0 ('1.5' of EMH P.01 is '1.5.0'), F is a history index of the same value
+        self.key = (self.prefix, f'{self.c}.{self.d}.{self.e or 0}', self.suffix)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        :param text: str, bytes or Obis
+        :return: Obis, the same object for the same spelling
+        """
+        if isinstance(text, Obis):
+            return text
+        if isinstance(text, bytes):
+            text = text.decode('latin-1')
+        obis = cls._cache.get(text)
+        if obis is None:
+            obis = cls(text)
+            cls._cache[obis.text] = obis
+        return obis
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f'Obis({self.text!r})'
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __eq__(self, other):
+        if isinstance(other, Obis):
+            return self.text == other.text
+        if isinstance(other, str):
+            return self.text == other
+        return NotImplemented
+
+    @classmethod
+    def _build_index(cls):
+        """
+        key => Meta over all the dicts of obis_codes.py
+        zabbix_obis_codes and the descriptions are keyed by OBIS, transform_set by their values
+        """
+        index = dict()
+
+        def meta(code):
+            key = cls(code).key
+            if key not in index:
+                index[key] = Meta()
+            return index[key]
+
+        for code, description in obis_codes.obis_codes.items():
+            meta(code).description = description
+        for code, description in obis_codes.obis_codes_short.items():
+            meta(code).short_description = description
+        for code, description in obis_codes.table_obis_codes.items():
+            meta(code).table_description = description
+        for code, zabbix_key in obis_codes.zabbix_obis_codes.items():
+            meta(code).zabbix_key = zabbix_key
+        for m in index.values():
+            for name in (m.zabbix_key, m.table_description):
+                if name in obis_codes.transform_set:
+                    m.transform = obis_codes.transform_set[name]
+                    break
+        cls._index = index
+        return index
+
+    @property
+    def meta(self):
+        """
+        Meta of the most specific spelling: 'bill-1.5.0', then '1.5.0' for any prefix or channel
+        """
+        if self._meta is None:
+            index = Obis._index or Obis._build_index()
+            prefix, cde, suffix = self.key
+            self._meta = index.get(self.key) or index.get((None, cde, suffix)) or index.get((None, cde, None)) or Meta.empty
+        return self._meta
+
+    @property
+    def description(self):
+        return self.meta.description
+
+    @property
+    def short_description(self):
+        return self.meta.short_description
+
+    @property
+    def table_description(self):
+        return self.meta.table_description
+
+    @property
+    def zabbix_key(self):
+        return self.meta.zabbix_key
+
+    @property
+    def transform(self):
+        return self.meta.transform
+
+
+class Meta:
+    """
+    Everything obis_codes.py knows about one OBIS code
+    """
+    __slots__ = ('description', 'short_description', 'table_description', 'zabbix_key', 'transform')
+
+    def __init__(self):
+        self.description = None
+        self.short_description = None
+        self.table_description = None
+        self.zabbix_key = None
+        self.transform = None
+
+
+Meta.empty = Meta()
@@ -266,7 +266,20 @@ obis_codes = {
     "C.7.3": "Number of phase failures phase 3",
     "C.51.4": "DCF-77 last synchronization",
     "C.52.0": "Phase information",
-    "C.86.0": "Installation check"
+    "C.86.0": "Installation check",
+    # Logbook and load profile status words, one integer record instead of a record per bit
+    "100.0.99": "EMH P.99 status word",
+    "101.1.99": "Metcom P.99 status word",
+    "p01-status": "P.01 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p02-status": "P.02 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p03-status": "P.03 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p04-status": "P.04 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p05-status": "P.05 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p06-status": "P.06 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p07-status": "P.07 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p08-status": "P.08 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p09-status": "P.09 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80",
+    "p10-status": "P.10 interval status, validity flags ERR 0x01, CIV 0x02, DNV 0x04, CAD 0x20, PDN 0x80"
     }
 
 
@@ -1,21 +1,28 @@
 import re
 import sys
 import datetime
+import numpy
 import pytz
+from iec6205621 import columnar
+from iec6205621 import record
+from iec6205621.obis import Obis
 
 class Parser:
 
-    # Everything from the beginning to the first parenthesis
-    # re_id = re.compile('^(.+?)[(]')
-    #  Old expression do not capture values like 1-0:31.7.0(2.414*A)
-    re_id = re.compile('^(.*?:)?(.+?)[(]')
-    # Integer from opening parenthesis until the closing or until the asterisk. Maybe there is a minus in the beginning
-    re_value1 = re.compile('[(](-?[0-9]+\\.?[0-9]*)\\*?.*[)]')
-    re_value1 = re.compile('[(](-?[0-9]+\\.?[0-9]*)\\*?.*[)]')
-    # Alphanumeric from the opening parenthesis to the closing
-    re_value2 = re.compile('^.+?[(](\w+)[)]$')
-    # After asterisk inside parenthesis until closing one
-    re_unit = re.compile('.+?[(].+\\*(.*)[)]')
+    # Parser works on bytes as received from the meter (client.Meter returns bytes),
+    # strings are only created for the fields which are emitted
+    encoding = 'latin-1'
+
+    # Data set = id(value*unit)(value2)...
+    # Every parenthesis group with the optional unit after the asterisk
+    # (0.50262*kW) => (b'0.50262', b'kW'), (2211120730) => (b'2211120730', b'')
+    re_data_set = re.compile(rb'[(]([^()*]*)(?:[*]([^()]*))?[)]')
+    # Load profile value, (0.18374) or (-0.5) in P.03 average values or (12) counters
+    re_profile_value = re.compile(rb'-?\d+(?:\.\d+)?$')
+    # Load profile line with valid values only
+    re_profile_line = re.compile(rb'(?:[(]-?\d+(?:\.\d+)?[)])+\s*$')
+    # List line, 1.8.0(01281.6601*kWh) or 1-0:32.7.0(57.90*V)
+    re_list_line = re.compile(rb'^(.+?-.+?:)?\w+\.\w.*?[(].*?[)]')
 
     """
         MCS301 load profiles
@@ -55,19 +62,77 @@ class Parser:
         'metcom_p211': '101.1.211'
     }
 
+    # Logbook line, the same for all the log types and manufacturers
+    # KZ([z]YYMMDDhhmmss)(S)()(k)(KZ1)(E1)..(KZk)(Ek)(D1)..(Dk)
+    # P.98(1220906234907)(00)()(2)(0-0:C.11.0)()(0-0:C.11.10)()(5)(0)
+    # P.99(1201021132243)(00002000)()(1)(0.9.1)()(120000;120005)
+    re_log_group = re.compile(rb'[(]([^()]*)[)]')
+
+    # Which records are made of one logbook entry
+    #   ('status', log_obis key)        status word as it is, '00002000'
+    #   ('value', n, log_obis key)      n-th additional value D1..Dk
+    #   ('values',)                     every additional value with its own identifier, prefixed by the log type 'p200-0.9.1'
+    #   ('status_word', log_obis key)   status word as one integer, '00002000' => 8192
+    #
+    # Status words are decoded at query time, bit 13 of P.99:
+    #   SELECT ts, (value::bigint >> 13) & 1 AS bit13 FROM data WHERE obis_id = (SELECT id FROM obis WHERE obis = '100.0.99');
+    log_layouts = {
+        'emh': {
+            'P.98': [('status', 'emh_p98')],
+            'P.99': [('status_word', 'emh_p99')],
+            'P.200': [('status', 'emh_p200'), ('values',)],
+            'P.210': [('status', 'emh_p210'), ('values',)],
+            'P.211': [('status', 'emh_p211'), ('values',)],
+        },
+        'metcom': {
+            'P.98': [('value', 0, 'metcom_p98_1'), ('value', 1, 'metcom_p98_2')],
+            'P.99': [('status_word', 'metcom_p99')],
+            'P.200': [('status', 'metcom_p200'), ('values',)],
+            'P.210': [('status', 'metcom_p210'), ('values',)],
+            'P.211': [('status', 'metcom_p211'), ('values',)],
+        },
+    }
+
+    # client.normalize_log() renders the control characters, readouts from the log are parsed as received
+    rendered_chars = {
+        b'<CR>': b'\r',
+        b'<LF>': b'\n',
+        b'<STX>': b'',
+        b'<SOH>': b'',
+        b'<ACK>': b'',
+        b'<NAK>': b'',
+        b'<EOT>': b'',
+    }
+
     tz_offset = dict()
     tz_offset['CET'] = '+0200'
 
-    load_profiles = ['P.01','P.02','P.03','P.04','P.05','P.06','P.07','P.08','P.09','P.10']
+    load_profiles = [b'P.01', b'P.02', b'P.03', b'P.04', b'P.05', b'P.06', b'P.07', b'P.08', b'P.09', b'P.10']
+    # Data types parsed by the profile engine, 'p01' or 'P.01' => b'P.01'
+    profile_types = {f'p{kz[2:].decode()}': kz for kz in load_profiles}
+    profile_types.update({kz.decode(): kz for kz in load_profiles})
 
-    def __init__(self, raw_data: str, data_type: str, logger, **meter):
+    def __init__(self, raw_data, data_type: str, logger, compact: bool = False, **meter):
+        """
+        :param raw_data: bytes, bytearray or memoryview as returned by client.Meter, str is accepted as well
+        :param compact: return record.Reading objects with float values and int timestamps instead of dicts
+        """
         self.logger = logger
+        if isinstance(raw_data, str):
+            raw_data = raw_data.encode(Parser.encoding, 'replace')
+        elif not isinstance(raw_data, bytes):
+            raw_data = bytes(raw_data)
+        if b'<CR><LF>' in raw_data:
+            raw_data = Parser.unrender(raw_data)
         self.unparsed_data = raw_data
         self.parsed_data = []
         self.data_type = data_type
+        self.compact = compact
         self.meter_id = meter['meter_id']
         self.manufacturer = meter['manufacturer'].lower() or 'emh'
         self.use_first_line = meter.get('use_first_line') or False
+        # Only these OBIS codes are parsed, the other lines are dropped by their id, None - everything
+        self.obis_filter = Parser.obis_set(meter.get('obis_filter'))
 
         self.timezone = meter.get('timezone') or 'CET'
         self.offset = Parser.tz_offset.get(self.timezone)
@@ -78,6 +143,29 @@ class Parser:
         self.time_format = '%y%m%d%H%M%S %z'
         self.time_format_no_tz = '%y%m%d%H%M%S'
 
+        # Line parser state, shared by parse() and the streaming feed()
+        self._buffer = b''
+        self._lines = 0
+        self._done = False
+        self._profile = None
+        self._line_number = 0
+        # Load profiles: epoch of the last complete interval, the next readout starts here
+        self.resume_ts = None
+        # Used logbook entry timestamps per log type, see _log_unique_ts()
+        self._log_seen = dict()
+
+
+    @staticmethod
+    def unrender(raw_data: bytes) -> bytes:
+        """
+        Readout copied from the log, see client.normalize_log()
+        <STX>P.01(...)(kvar)<CR><LF>(0.00026)(0.00158)<CR><LF><ETX>~<SOH>B0<ETX> => P.01(...)(kvar)\r\n(0.00026)(0.00158)\r\n
+        Everything after the first <ETX> is the BCC and the next command
+        """
+        raw_data = raw_data.split(b'<ETX>')[0]
+        for rendered, char in Parser.rendered_chars.items():
+            raw_data = raw_data.replace(rendered, char)
+        return raw_data
 
     def parse(self):
         if self.data_type == 'list3':
@@ -88,20 +176,10 @@ class Parser:
             self._parse_list2()
         elif self.data_type == 'list4':
             self._parse_list2()
-        elif self.data_type == 'p01':
-            self._parseP01()            
-        elif self.data_type == 'p02':
-            self._parseP02()            
-        elif self.data_type in ['P.98', 'p98']:
-            self._parseP98()
-        elif self.data_type in ['P.99', 'p99']:
-            self._parseP99()
-        elif self.data_type in ['P.200', 'p200']:
-            self._parseP200()
-        elif self.data_type in ['P.210', 'p210']:
-            self._parseP210()
-        elif self.data_type in ['P.211', 'p211']:
-            self._parseP211()
+        elif self.data_type in Parser.profile_types:
+            self._parse_profile()
+        elif self.data_type in ['P.98', 'p98', 'P.99', 'p99', 'P.200', 'p200', 'P.210', 'p210', 'P.211', 'p211']:
+            self._parse_log()
         elif self.data_type in ['error', 'Error']:
             self._parseErrorLog()        
         else:
@@ -109,6 +187,74 @@ class Parser:
             sys.exit(1)
         return self.parsed_data
 
+    def parse_columnar(self):
+        """
+        Load profiles only (p01..p10)
+        :return: columnar.LoadProfile, use LoadProfile.to_records() for the parse() row format
+        """
+        if self.data_type not in Parser.profile_types:
+            self.log('ERROR', f'{self.data_type} columnar parser not implemented')
+            sys.exit(1)
+        return self._parse_profile_columnar()
+
+    def feed(self, data) -> list:
+        """
+        Push API for the data as it is received from the meter, see client.Meter.on_data
+        Complete lines are parsed right away, an incomplete line is kept until the next call
+
+        p = Parser(b'', 'p01', logger, **meter)
+        p.feed(b'P.01(1220823161500)(00000000)(15)(6)(1.5)(kW)(2.5)(kW)(5.5)(kvar)(6.5)(kvar)(7.5)(kvar)(8.5)(kvar)\\r\\n(0.183')  => []
+        p.feed(b'74)(0.00078)(0.00000)(0.00006)(0.00087)(0.02431)\\r\\n')  => [{'id': '1.5', 'value': '0.18374', ...}, ... 6 records]
+        p.close()  => records of the last line without <CR><LF>
+
+        Data types without a line parser (P.99, error log, list3...) are collected and parsed by close()
+        :param data: bytes
+        :return: list of records in the parse() format
+        """
+        line_parser = self._line_parser()
+        if line_parser is None:
+            self._buffer += data
+            return []
+
+        *lines, self._buffer = (self._buffer + data).split(b'\n')
+        records = []
+        for line in lines:
+            records.extend(line_parser(line))
+        return records
+
+    def close(self) -> list:
+        """
+        End of the readout, parses the rest of the buffer
+        :return: list of records
+        """
+        line_parser = self._line_parser()
+        data, self._buffer = self._buffer, b''
+        if line_parser is None:
+            self.unparsed_data += data
+            return self.parse()
+        if data:
+            return line_parser(data)
+        return []
+
+    def stream(self, chunks):
+        """
+        Generator over the records, for an iterable of received chunks
+        """
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.close()
+
+    def _line_parser(self):
+        if self.data_type in Parser.profile_types:
+            return self._profile_line
+        elif self.data_type in ['P.98', 'p98', 'P.99', 'p99', 'P.200', 'p200', 'P.210', 'p210', 'P.211', 'p211']:
+            return self._log_line
+        elif self.data_type == 'list1':
+            return self._list1_line
+        elif self.data_type in ['list2', 'list4']:
+            return self._list2_line
+        return None
+
     def log(self, severity, logstring):
         if severity == 'ERROR':
             self.logger.error(f'{self.meter_id} {logstring}')
@@ -119,6 +265,27 @@ class Parser:
         elif severity == 'DEBUG':
             self.logger.debug(f'{self.meter_id} {logstring}')
 
+    def _record(self, id: str, value: str, unit: str = None, line_time: int = None):
+        """
+        One parsed value
+        {'id': '1.6.1', 'value': '0.50262', 'unit': 'kW'}, with line_time {..., 'line_time': '1661551006'}
+        Reading('1.6.1', 0.50262, 'kW') if compact
+        """
+        if self.compact:
+            return record.Reading(id, value, unit, line_time)
+        if line_time is None:
+            return {'id': id, 'value': value, 'unit': unit}
+        return {'id': id, 'value': value, 'unit': unit, 'line_time': str(line_time)}
+
+    def _status_record(self, id: str, status: int, line_time: int):
+        """
+        Status word as one integer instead of a record per bit
+        {'id': '100.0.99', 'value': '8192', 'unit': None, 'line_time': '1661551006'}, Reading('100.0.99', 8192, ...) if compact
+        """
+        if self.compact:
+            return record.Reading(id, status, None, line_time, status)
+        return {'id': id, 'value': str(status), 'unit': None, 'line_time': str(line_time)}
+
     def _parse_list3_new(self):
         """
         Metcom_new
@@ -148,41 +315,18 @@ class Parser:
         Unit: 16 printable characters maximum except for (, ), / and !.
         """
 
-        # Data line = data set * N
-        re_id = re.compile('^(.+?)[(]')
-        re_value1 = re.compile('[(]([0-9]+\\.?[0-9]*)\\*?.*[)]')
-        re_value2 = re.compile('^.+?[(](\w+)[)]$')
-        re_unit = re.compile('.+?[(].+\\*(.*)[)]')
-
         pre_parsed = self._find_data_blocks()
 
         if pre_parsed.get('P.99'):
-            self._parseP99(pre_parsed['P.99'])
+            self.parsed_data.extend(self._log_line(pre_parsed['P.99']))
         if pre_parsed.get('P.01'):
-            self._parseP01(pre_parsed['P.01'])
+            for line in pre_parsed['P.01']:
+                self.parsed_data.extend(self._profile_line(line))
         if pre_parsed.get('list'):
             for line in pre_parsed['list']:
-                parsed_line = {
-                    'id': None,
-                    'value': None,
-                    'unit': None
-                }
-                try:
-                    parsed_line['id'] = re_id.search(line).groups()[0]
-                    if re_value1.search(line):
-                        # TODO: WARNING re matches 'C.90.2(70D4EF6C)' value as '70'
-                        value = re_value1.search(line).groups()[0]
-                    else:
-                        value = re_value2.search(line).groups()[0]
-                    parsed_line['value'] = value
-                    if re_unit.search(line):
-                        unit = re_unit.search(line).groups()[0]
-                        parsed_line['unit'] = unit
+                parsed_line = self._parse_data_set(line, keep_prefix=True)
+                if parsed_line:
                     self.parsed_data.append(parsed_line)
-                except Exception as e:
-                    self.log('ERROR', f'{e} while processing {line}')
-                    continue
-
 
     def _parse_list1(self):
         """
@@ -238,45 +382,22 @@ class Parser:
             !
         :return:
         """
-        pre_parsed = self._find_data_blocks()
-
-        if pre_parsed.get('list'):
-            for line in pre_parsed['list']:
-                parsed_line = {
-                    'id': None,
-                    'value': None,
-                    'unit': None
-                }
-                try:
-                    # re_id may return one or two groups - actual OBIS would be in the last
-                    parsed_line['id'] = Parser.re_id.search(line).groups()[-1]
-
-                    if '*' in parsed_line['id']:
-                        # Skip history data like
-                        # 0.1.2*12(2211010000)\r\n
-                        # 0.1.2*11(2210010000)\r\n
-                        # 0.1.2*10(2209010000)\r\n
-                        # 1.6.1(0.50262*kW)(2211120730)\r\n
-                        # 1.6.1*12(0.39912*kW)(2210130900)\r\n
-                        # 1.6.1*11(0.74906*kW)(2209281400)\r\n
-                        # 1.6.1*10(0.49578*kW)(2208111330)\r\n
-                        continue
-
-                    if Parser.re_value1.search(line):
-                        # TODO: WARNING re matches 'C.90.2(70D4EF6C)' value as '70'
-                        # TODO: WARNING re matches '0.0.0(1EMH0010134075)' value as '1'
-                        value = Parser.re_value1.search(line).groups()[0]
-                    else:
-                        value = Parser.re_value2.search(line).groups()[0]
-                    parsed_line['value'] = value
-                    if Parser.re_unit.search(line):
-                        unit = Parser.re_unit.search(line).groups()[0]
-                        parsed_line['unit'] = unit
-                    self.parsed_data.append(parsed_line)
-                except Exception as e:
-                    self.log('ERROR', f'{e} while processing {line}')
-                    continue
-
+        for line in self.unparsed_data.split(b'\n'):
+            self.parsed_data.extend(self._list1_line(line))
+
+    def _list1_line(self, line: bytes):
+        # Skip history data like
+        # 0.1.2*12(2211010000)\r\n
+        # 0.1.2*11(2210010000)\r\n
+        # 0.1.2*10(2209010000)\r\n
+        # 1.6.1(0.50262*kW)(2211120730)\r\n
+        # 1.6.1*12(0.39912*kW)(2210130900)\r\n
+        # 1.6.1*11(0.74906*kW)(2209281400)\r\n
+        # 1.6.1*10(0.49578*kW)(2208111330)\r\n
+        parsed_line = self._list_line(line, history=False)
+        if parsed_line is None:
+            return []
+        return [parsed_line]
 
     def _parse_list2(self):
         """
@@ -303,47 +424,178 @@ class Parser:
         1-0:81.7.2(-120.1*deg)^M
         1-0:14.7.0(0.04995*kHz)^M
 
-        TODO: 1-0:1.8.0(00000391.3*Wh)^M\r\n
+        1-0:1.8.0(00000391.3*Wh)^M\r\n
 
-
-        
         :return:
         """
-        pre_parsed = self._find_data_blocks()
+        for line in self.unparsed_data.split(b'\n'):
+            self.parsed_data.extend(self._list2_line(line))
+
+    def _list2_line(self, line: bytes):
+        parsed_line = self._list_line(line)
+        if parsed_line is None:
+            return []
+
+        # Filter out results with '..', '/', count('.') > 2 [not used]
+        if '..' in parsed_line['id'] or '/' in parsed_line['id']:
+            # The obis code is incorect
+            self.log('ERROR', f'Incorrect OBIS code {parsed_line["id"]} in {line}')
+            return []
+        return [parsed_line]
+
+    def _list_line(self, line: bytes, history: bool = True):
+        """
+        One line of a list readout, same rules as _find_data_blocks()
+        :param history: keep history values like 1.8.0*12
+        :return: {'id': '32.7.0', 'value': '57.90', 'unit': 'V'} or None if the line is not a data set
+        """
+        if self._done:
+            return None
+        line = line.rstrip(b'\r')
+        self._lines += 1
+
+        if self._lines == 1:
+            # Table 1 provides F.F error register in the first line,
+            # Other tables may provide meter name
+            # In some Metcom meters (j) name goes last and 1st line is actually meaningful
+            if self.use_first_line:
+                # It's explicitly enabled in DB per meter, skip this step
+                self.log('DEBUG', f'self.use_first_line = {self.use_first_line}, skipping')
+            elif b'F.F' in line:
+                self.log('DEBUG', f'F.F in line "{line}", skipping ')
+            else:
+                return None
 
-        if pre_parsed.get('list'):
-            for line in pre_parsed['list']:
-                parsed_line = {
-                    'id': None,
-                    'value': None,
-                    'unit': None
-                }
-                try:
-                    # re_id may return one or two groups - actual OBIS would be in the last
-                    # Filter out results with '..', '/', count('.') > 2 [not used]
-                    
-                    id_line = Parser.re_id.search(line).groups()[-1]
-
-                    if '..' in id_line or '/' in id_line:
-                        # The obis code is incorect - raise and continue
-                        raise BaseException
-                    else:
-                        parsed_line['id'] = id_line
-    
-                    if Parser.re_value1.search(line):
-                        # TODO: WARNING re matches 'C.90.2(70D4EF6C)' value as '70'
-                        # TODO: WARNING re matches '0.0.0(1EMH0010134075)' value as '1'
-                        value = Parser.re_value1.search(line).groups()[0]
-                    else:
-                        value = Parser.re_value2.search(line).groups()[0]
-                    parsed_line['value'] = value
-                    if Parser.re_unit.search(line):
-                        unit = Parser.re_unit.search(line).groups()[0]
-                        parsed_line['unit'] = unit
-                    self.parsed_data.append(parsed_line)
-                except Exception as e:
-                    self.log('ERROR', f'{e} while processing {line}')
-                    continue
+        if line.startswith(b'/'):
+            # Skip header
+            self.log('DEBUG', f'Skipping header {line}')
+            return None
+        elif len(line) < 5 and b'!' in line:
+            # Probably the end of the message
+            self.log('DEBUG', f'End of the message found in {line}')
+            self._done = True
+            return None
+        elif line.startswith(b'P.99'):
+            # P.99 and P.01 blocks are parsed for list3 only
+            return None
+        elif line.startswith(b'P.01'):
+            self._done = True
+            return None
+        elif Parser.re_list_line.search(line):
+            return self._parse_data_set(line, history=history)
+        return None
+
+    @staticmethod
+    def obis_set(codes):
+        """
+        OBIS filter of the meter profile, a list or a comma separated string as stored in the DB
+        Any spelling is accepted, the codes are matched by Obis.key, E defaults to 0: '1.5.0' and '1-0:1.5.0'
+        match the EMH P.01 channel '1.5' as well. A code with the channel A-B: matches only this channel
+        of the multi-channel profiles, '1-2:1.29' doesn't match '1-1:1.29', a code without it matches all of them
+
+        '1-0:1.8.0, 32.7.0,1.8.0*12' => frozenset({(('1', '0'), '1.8.0', None), (None, '32.7.0', None), (None, '1.8.0', '12')})
+        History values '*NN' are only kept if they are listed
+
+        :param codes: list, str or None
+        :return: frozenset of filter_key() or None if there is no filter
+        """
+        if not codes:
+            return None
+        if isinstance(codes, str):
+            codes = codes.split(',')
+        return frozenset(Parser.filter_key(code.strip()) for code in codes if code.strip())
+
+    @staticmethod
+    def filter_key(code) -> tuple:
+        """
+        b'1-1:1.29' => (('1', '1'), '1.29.0', None), '1.8.0*12' => (None, '1.8.0', '12')
+        """
+        obis = Obis.parse(code)
+        return (obis.a, obis.b) if obis.a is not None else None, obis.key[1], obis.f
+
+    @staticmethod
+    def filter_match(code, obis_filter: frozenset) -> bool:
+        """
+        True if the code passes the OBIS filter, see obis_set()
+        """
+        channel, cde, f = Parser.filter_key(code)
+        if (None, cde, f) in obis_filter:
+            return True
+        if channel is None:
+            # '1.5' of EMH P.01 has no channel, it matches the code with any channel
+            return any(key[1:] == (cde, f) for key in obis_filter)
+        return (channel, cde, f) in obis_filter
+
+    def _wanted_columns(self, ids: list):
+        """
+        Indexes of the profile channels which pass the OBIS filter
+        ['1.5', '1-1:2.5', '5.5'] with filter '1.5.0,2.5.0' => [0, 1]
+        """
+        if self.obis_filter is None:
+            return list(range(len(ids)))
+        return [i for i, id in enumerate(ids) if Parser.filter_match(id, self.obis_filter)]
+
+    @staticmethod
+    def split_id(line: bytes):
+        """
+        Identifier scan, nothing after the first parenthesis is touched
+        b'1-0:1.6.1*12(0.39912*kW)(2210130900)' => (b'1-0:', b'1.6.1*12', 12)
+
+        :return: (prefix, id, position of the first parenthesis), None if there is no identifier
+        """
+        start = line.find(b'(')
+        if start < 1:
+            return None
+        colon = line.find(b':', 0, start)
+        return line[:colon + 1], line[colon + 1:start], start
+
+    @staticmethod
+    def tokenize(line: bytes):
+        """
+        Splits a data set line in one scan
+        Identifier is everything before the first parenthesis, value groups are matched from there on
+
+        b'1-0:1.6.1*12(0.39912*kW)(2210130900)' => (b'1-0:', b'1.6.1*12', [(b'0.39912', b'kW'), (b'2210130900', b'')])
+        b'C.90.2(70D4EF6C)' => (b'', b'C.90.2', [(b'70D4EF6C', b'')])
+
+        :param line: bytes
+        :return: (prefix, id, [(value, unit), ...]), None if there is no identifier
+        """
+        scanned = Parser.split_id(line)
+        if scanned is None:
+            return None
+        prefix, obis, start = scanned
+        return prefix, obis, Parser.re_data_set.findall(line, start)
+
+    def _parse_data_set(self, line: bytes, keep_prefix: bool = False, history: bool = True):
+        """
+        :param line: b'1-0:32.7.0(57.90*V)'
+        :param keep_prefix: keep medium/channel prefix '1-0:' in the id
+        :param history: keep history values like 1.8.0*12
+        :return: {'id': '32.7.0', 'value': '57.90', 'unit': 'V'} or None if the line is not a valid data set
+        Only the first value group is emitted, further groups (like the time of the maximum) are ignored
+        Lines dropped by the id (history, OBIS filter) are not scanned for values at all
+        """
+        scanned = Parser.split_id(line)
+        if scanned is None:
+            self.log('ERROR', f'No value found while processing {line}')
+            return None
+        prefix, obis, start = scanned
+        if not history and b'*' in obis:
+            return None
+        if self.obis_filter is not None and not Parser.filter_match(obis, self.obis_filter):
+            return None
+
+        groups = Parser.re_data_set.findall(line, start)
+        if not groups or not groups[0][0]:
+            self.log('ERROR', f'No value found while processing {line}')
+            return None
+        value, unit = groups[0]
+        return self._record(
+            (prefix + obis if keep_prefix else obis).decode(Parser.encoding),
+            value.decode(Parser.encoding),
+            unit.decode(Parser.encoding) if unit else None
+        )
 
     def _parseErrorLog(self):
         """
@@ -358,18 +610,18 @@ class Parser:
         if self.manufacturer == 'emh':
 
             line = self.unparsed_data.strip()
-            if '\r\n' in line:
+            if b'\r\n' in line:
                 self.log('ERROR', f'Meter returned something unexpected in F.F log: "{line}"')
                 sys.exit(1)
-            elif 'F.F' not in line:
+            elif b'F.F' not in line:
                 self.log('ERROR', f'Meter returned something unexpected in F.F log: "{line}"')
                 sys.exit(1)
             else:
                 try:
                     # F.F(00000000)
-                    log_record = line.split('(')[1].strip(')')
+                    log_record = line.split(b'(')[1].strip(b')').decode(Parser.encoding)
 
-                    self.parsed_data.append({'id': 'F.F', 'value': log_record, 'unit': 'log'})
+                    self.parsed_data.append(self._record('F.F', log_record, 'log'))
                 except Exception as e:
                     self.log('ERROR', f'Something went wrong when parsing ErrorLog {line}')
                     sys.exit(1)
@@ -430,125 +682,10 @@ class Parser:
 
         """
 
-        if self.manufacturer == 'emh':
-
-            # P.98(1041007095703)(00002000)()(0) find 1041007095703
-            re_log_ts = re.compile('^P.98[(](\d+?)[)]')
-            # P.98(1041007095703)(00002000)()(0) find 00002000
-            # EMH
-            re_log_record = re.compile('^.+[(]\d+?[)][(](\d+?)[)]')
-
-            for log_line in self.unparsed_data.split('\r\n'):
-                try:
-                    log_line = log_line.strip()
-
-                    # Parse only lines starting from "^P.98"
-                    if not log_line.startswith('P.98'):
-                        continue
-                    else:
-
-                        # This part didn't work well on some new EMH logs like:
-                        # P.98(1220829235716)(00008020)()(2)(0.9.1)()(0.9.2)()(1235706)(1220829)
-                        # Patch using split instead of re
-
-                        # P.98(1041007095703)(00002000)()(0)
-                        # log_ts = 1041007095703
-                        # log_record = 00002000
-                        # log_ts = re_log_ts.search(log_line).groups()[0][1:]     # strip left-most digit (usually '1')
-                        # log_record = re_log_record.search(log_line).groups()[0]
-
-                        log_ts = log_line.split('(')[1].strip(')')[1:]
-                        log_record = log_line.split('(')[2].strip(')')
-
-                        # Take meter TZ and make timestamp UTC
-                        log_ts_parsed = datetime.datetime.strptime(f"{log_ts} {self.offset}", self.time_format)
-
-                        parsed_line = {
-                            'id': Parser.log_obis['emh_p98'],
-                            'value': log_record,
-                            'unit': None,
-                            'line_time': (log_ts_parsed).strftime('%s')
-                        }
-                        self.parsed_data.append(parsed_line)
-                except Exception as e:
-                    self.log('ERROR', f'Exception "{e}" during P98 line parsing "{log_line}"')
-                    sys.exit(1)
-
-            # [
-            #   {'id': '100.0.98', 'value': '00002000', 'unit': None, 'line_time': '1097135823'}, 
-            #   {'id': '100.0.98', 'value': '00004000', 'unit': None, 'line_time': '1097135823'}, 
-            #   {'id': '100.0.98', 'value': '00000100', 'unit': None, 'line_time': '1097135887'}, 
-            #   {'id': '100.0.98', 'value': '00000080', 'unit': None, 'line_time': '1097135954'}
-            # ]
-            # There may be a situation where two log events would happen in the same time.
-            # I will add one second to one of them
-
-            result = []
-            for parsed_line in self.parsed_data:
-                ts = parsed_line['line_time']
-                if ts in result:
-                    # This time already exists in the result
-                    # Remove the line and increase by one, fingers crossed
-                    self.parsed_data.remove(parsed_line)
-                    parsed_line['line_time'] = f"{int(parsed_line['line_time'])+1}"
-                    self.parsed_data.append(parsed_line)
-                else:
-                    result.append(ts)
-
-            return
-
-        elif self.manufacturer == 'metcom':
-            # Metcom
-            # P.98(1220906234907)(00)()(2)(0-0:C.11.0)()(0-0:C.11.10)()(5)(0)
-            # P.98(1220919161837)(00)()(2)(0-0:C.11.0)()(0-0:C.11.10)()(17)(1)
-            re_log_ts = re.compile('^P.98[(](\d+?)[)]')
-
-            for log_line in self.unparsed_data.split('\r\n'):
-                try:
-                    log_line = log_line.strip()
-
-                    # Parse only lines starting from "^P.98"
-                    if not log_line.startswith('P.98'):
-                        continue
-                    else:
-
-                        # P.98(1220906234907)(00)()(2)(0-0:C.11.0)()(0-0:C.11.10)()(5)(0)
-                        # log_ts = 1220906234907
-                        # log_data_1 = 5
-                        # log_data_2 = 0
-                        log_ts = re_log_ts.search(log_line).groups()[0][1:]     # strip left-most digit (usually '1')
-                        log_record_1 = log_line.split('(')[-2].strip(')')
-                        log_record_2 = log_line.split('(')[-1].strip(')')
-
-                        # Take meter TZ and make timestamp UTC
-                        log_ts_parsed = datetime.datetime.strptime(f"{log_ts} {self.offset}", self.time_format)
-
-                        parsed_line_1 = {
-                            'id': Parser.log_obis['metcom_p98_1'],
-                            'value': log_record_1,
-                            'unit': None,
-                            'line_time': (log_ts_parsed).strftime('%s')
-                        }
-                        parsed_line_2 = {
-                            'id': Parser.log_obis['metcom_p98_2'],
-                            'value': log_record_2,
-                            'unit': None,
-                            'line_time': (log_ts_parsed).strftime('%s')
-                        }
-                        self.parsed_data.extend([parsed_line_1, parsed_line_2])
-                except Exception as e:
-                    self.log('ERROR', f'Exception "{e}" during P98 line parsing "{log_line}"')
-                    sys.exit(1)
+        self._parse_log()
 
-        else:
-            self.log('ERROR', f'Unknown manufacturer {self.manufacturer}, expecting one of ["emh", "metcom"]')
-            sys.exit(1)            
-
-    def _parseP99(self, raw_line):
+    def _parseP99(self):
         """
-        :param raw_line:
-        :return: [{id: '8.8.0', value: '00008.423', unit: 'kvarh'}...]
-
         P.99(1201021132243)(00002000)()(0)
         1. Entry without value
         P.99([z]YYMMDDhhmmss)(SSSSSSSS)()(0)(< identifier>)<CR><LF>
@@ -568,41 +705,195 @@ class Parser:
         Old value:  Value before change
         New value:  Value after change
         """
+        self._parse_log()
 
-        re_log_ts = re.compile('^.+[(](\d+?)[)]')
-        re_log_record = re.compile('^.+[(]\d+?[)][(](\d+?)[)]')
-        result = []
+    def _parseP200(self):
+        self._parse_log()
 
-        try:
-            log_ts = re_log_ts.search(raw_line).groups()[0]
-            log_record = re_log_record.search(raw_line).groups()[0]
+    def _parseP210(self):
+        self._parse_log()
+
+    def _parseP211(self):
+        self._parse_log()
+
+    def _parse_log(self):
+        for log_line in self.unparsed_data.split(b'\n'):
+            self.parsed_data.extend(self._log_line(log_line))
 
-            # print('{0:b}'.format(int('2000', base=16)))
-            # print(f'{int(log_record[:4], base=16):b}')
-            # print(f'{int(log_record[4:], base=16):b}')
-            pre_bin_log = bin(int(log_record, base=16))[2:]
-            bin_log = '0' * (32 - len(pre_bin_log)) + pre_bin_log
+    def _log_line(self, log_line: bytes):
+        """
+        One logbook entry, records are made according to Parser.log_layouts
+
+        EMH     P.98(1220826235646)(00008020)()(2)(0.9.1)()(0.9.2)()(1235703)(1220826)
+                => [{'id': '100.0.98', 'value': '00008020', 'unit': None, 'line_time': '1661551006'}]
+        Metcom  P.98(1220906234907)(00)()(2)(0-0:C.11.0)()(0-0:C.11.10)()(5)(0)
+                => [{'id': '101.1.98', 'value': '5', ...}, {'id': '101.2.98', 'value': '0', ...}]
 
-            for i in range(32):
-                log_bit = {'id': f'p99_bit{i}', 'value': bin_log[::-1][i], 'unit': None}
-                self.parsed_data.append(log_bit)
-            return result
+        Lines of other log types than requested in data_type and broken lines are skipped
+        :return: list of records
+        """
+        log_line = log_line.strip()
+        if not log_line.startswith(b'P.'):
+            return []
+        kz = log_line[:log_line.find(b'(')].decode(Parser.encoding)
+        if self.data_type not in ['list3', kz, kz.replace('.', '').lower()]:
+            return []
+
+        layouts = Parser.log_layouts.get(self.manufacturer)
+        if layouts is None:
+            self.log('ERROR', f'Unknown manufacturer {self.manufacturer}, expecting one of {list(Parser.log_layouts.keys())}')
+            return []
+        layout = layouts.get(kz)
+        if layout is None:
+            self.log('ERROR', f'Log {kz} not implemented. Available types are {list(layouts.keys())}')
+            return []
 
+        try:
+            groups = Parser.re_log_group.findall(log_line)
+            # z: Season-codes: 0 = normal time, 1 = summer time, 2 = UTC
+            log_ts = datetime.datetime.strptime(groups[0][1:].decode(Parser.encoding), self.time_format_no_tz)
+            line_time = self._season_epoch(groups[0][:1], log_ts)
+            status = groups[1].decode(Parser.encoding)
+            if any(item[0] == 'status_word' for item in layout):
+                status_word = int(status, base=16)
+            k = int(groups[3] or 0)
+            identifiers = groups[4:4 + 2 * k:2]
+            units = groups[5:5 + 2 * k:2]
+            values = groups[4 + 2 * k:4 + 3 * k]
         except Exception as e:
-            self.log('ERROR', f'{e} while processing "{raw_line}"')
-            return None
+            # Truncated or broken entry, the rest of the logbook is kept
+            # P.98(12208
+            # P.98(1220828235723)(0000
+            self.log('ERROR', f'Exception "{e}" during {kz} line parsing "{log_line}", line skipped')
+            return []
+
+        line_time = self._log_unique_ts(kz, line_time)
+
+        records = []
+        for item in layout:
+            if item[0] == 'status':
+                records.append(self._record(Parser.log_obis[item[1]], status, None, line_time))
+            elif item[0] == 'status_word':
+                records.append(self._status_record(Parser.log_obis[item[1]], status_word, line_time))
+            elif item[0] == 'value':
+                if item[1] >= len(values):
+                    self.log('ERROR', f'Expected {item[1] + 1} values in {kz} line "{log_line}"')
+                    continue
+                records.append(self._record(Parser.log_obis[item[2]], values[item[1]].decode(Parser.encoding), None, line_time))
+            elif item[0] == 'values':
+                prefix = kz.replace('.', '').lower()
+                for n in range(len(values)):
+                    records.append(self._record(
+                        f'{prefix}-{identifiers[n].decode(Parser.encoding)}',
+                        values[n].decode(Parser.encoding),
+                        units[n].decode(Parser.encoding) or None,
+                        line_time
+                    ))
+        return records
+
+    def _season_epoch(self, season: bytes, ts: datetime.datetime) -> int:
+        """
+        z: Season-codes: 0 = normal time, 1 = summer time, 2 = UTC
+        The season code decides the ambiguous hour after the switch to normal time:
+        CET 221030023000 => 1667089800 with z=1, 1667093400 with z=0
+        """
+        if season == b'2':
+            return int(pytz.utc.localize(ts).timestamp())
+        return int(self.dt_tz.localize(ts, is_dst=season == b'1').timestamp())
 
-    def _parseP200(self, raw_line):
-        
-        return
+    def _log_unique_ts(self, kz: str, ts: int):
+        """
+        There may be a situation where two log events would happen in the same time.
+        The later one gets the next free second.
+        seen maps a used second to a candidate for the next free one, the chain is shortened on every lookup,
+        so even thousands of entries with the same timestamp after an outage stay linear
+        """
+        seen = self._log_seen.setdefault(kz, dict())
+        path = []
+        while ts in seen:
+            path.append(ts)
+            ts = seen[ts]
+        for used in path:
+            seen[used] = ts + 1
+        seen[ts] = ts + 1
+        return ts
+
+    def _parse_profile_header(self, line: bytes):
+        """
+        P.01(1220823161500)(00000000)(15)(6)(1.5)(kW)(2.5)(kW)(5.5)(kvar)(6.5)(kvar)(7.5)(kvar)(8.5)(kvar)
+        P.02(0231122000000)(00)(1440)(6)(1-0:1.8.0)(kWh)(1-0:2.8.0)(kWh)(1-0:5.8.0)(kvarh)(1-0:6.8.0)(kvarh)(1-0:7.8.0)(kvarh)(1-0:8.8.0)(kvarh)
 
-    def _parseP210(self, raw_line):
-        
-        return
+        :param line: header line
+        :return: (start, status, rp, z, ids, units)
+            start - epoch of the first line in the block
+            status - profile status word as int
+            rp - registration period in seconds
+            z - amount of values in a line
+            ids, units - lists of z strings
+        """
+        line = line.split(b'(')
+        kz = line[0]
+
+        # Take meter TZ and make timestamp UTC
+        # Switch from static TZ to DB based TZ
+        # zsts13 = datetime.datetime.strptime(f"{line[1].strip(')')[1:]} {self.offset}", self.time_format)
+        if kz == b'P.02':
+            # Daily values, time of the day is dropped
+            time_line = line[1].strip(b')')[1:-6].decode(Parser.encoding) # 231122
+            zsts13 = datetime.datetime.strptime(time_line, '%y%m%d')
+        else:
+            zsts13 = datetime.datetime.strptime(line[1].strip(b')')[1:].decode(Parser.encoding), self.time_format_no_tz)
+        # Epoch of the meter local time, the following lines are start + rp * line_number
+        # '1221030023000)' - the season code is the first digit, as in the logbooks
+        start = self._season_epoch(line[1][:1], zsts13)
+
+        # Metcom
+        # '08)' => 0b00001000
+        # '0A)' => 0b00001010
+        # Bit
+        # 7 PDN Power down
+        # 6 RSV Reserved
+        # 5 CAD Clock adjusted
+        # 4 RSV Reserved
+        # 3 DST Daylight saving
+        # 2 DNV Data not valid
+        # 1 CIV Clock invalid
+        # 0 ERR Critical error
+        # EMH
+        # '00000000)'
+        status = int(line[2].strip(b')'), 16)
+
+        # '15)'
+        rp = int(line[3].strip(b')')) * 60
+
+        # '6)' - amount of values in a line
+        z = int(line[4].strip(b')'))
+
+        # Any z, P.01 is usually 6 or 8, P.06 harmonics and M-Bus profiles differ
+        if z < 1 or len(line) < 5 + z * 2:
+            raise ValueError(f'Header with z={z} has {(len(line) - 5) // 2} identifiers')
+
+        ids = list()
+        units = list()
+
+        # Values in line with index 0-4 are a constant prefix like
+        # ['P.01', '1221002001500)', '00000000)', '15)', '8)',
+        # Values with index 5+ are a variable key list like
+        # '1-1:1.29)', 'kWh)', '1-1:2.29)', 'kWh)', '1-1:5.29)', 'kvarh)', '1-1:6.29)', 'kvarh)', '1-1:7.29)', 'kvarh)', '1-1:8.29)', 'kvarh)', '1-2:1.29)', 'kWh)', '1-3:2.29)', 'kWh)'
+        # z = 6 => range(5,16,2)
+        # z = 8 => range(5,20,2)
+        for i in range(5,4+z*2,2):
+            if self.manufacturer == 'metcom':
+                # '1-0:1.5.0)' => '1.5.0'
+                ids.append(Obis.parse(line[i].strip().strip(b')')).short)
+            else:
+                # 'emh'
+                # '1.5)' or '1-1:1.29)'
+                ids.append(line[i].strip().strip(b')').decode(Parser.encoding))
+            # 'kW)'
+            units.append(line[i+1].strip().strip(b')').decode(Parser.encoding))
 
-    def _parseP211(self, raw_line):
-        
-        return                
+        return start, status, rp, z, ids, units
 
     def _parseP01(self):
         """
@@ -634,158 +925,11 @@ class Parser:
         Mwn         Measured values
         """
         
-        # TODO: Parse P01 with error
-        #
-        #  Ends with <CR><LF>(0.03746)(0.00000)(0.00000)(0.00000)(0.00000)(0.00926)<CR><LF>(0.04063)(0.00000)(0.00000)(0.00000)(0.00000)(0.00918)<CR><LF>(0.03770)(0.
-        #    00000)(0.00000)(0.00000)(0.00000)(0.00923)<CR><LF><ETX>~<SOH>B0<ETX>
-
-        # TODO: Parse P01 with another error
-        # 2023-09-22 12:06:42,266 __main__     DEBUG    10132380 10.179.31.196:5000 Meter -> HHU (Tr = 4): 
-        # "<STX>P.01(1230920203000)(08)(15)(6)(1-0:1.5.0)(kW)(1-0:2.5.0)(kW)(1-0:5.5.0)(kvar)(1-0:6.5.0)(kvar)(1-0:7.5.0)(kvar)(1-0:8.5.0)(kvar)<CR><LF>
-        # (0.26)(0.00)(0.00)(0.00)(0.00)(0.05)<CR><LF>
-        # (0.17)(0.00)(0.03)(0.00)(0.00)(0.00)<CR><LF>
-        # (0.17)(0.00"
-        # Terminated by timeout prematurely
-        # (0.10)(0.00)(0.01)(0.00)(0.00)(0.05)^M
+        # Readout terminated by timeout prematurely, the complete rows are kept and resume_ts is the last of them
         # (0.22)(0.00)(0.01)(0.00)(0.00)(0.03)^M
         # (0.17)(0.00
-        # 2023-09-22 12:06:42,268 __main__     ERROR    10132380 Expected z=6 values, found 2 in line "['0.17)', '0.00']"
-        # Stop parsing and return last date
 
-        data = self.unparsed_data.split('\n')
-        for line in data:
-
-            if line[0:4] in self.load_profiles:
-                # Parse header line
-                # Metcom
-                # [
-                #   'P.01', 
-                #   '1220403160000)', 
-                #   '08)', 
-                #   '15)', 
-                #   '6)', 
-                #   '1-0:1.5.0)', 'kW)', 
-                #   '1-0:2.5.0)', 'kW)', 
-                #   '1-0:5.5.0)', 'kvar)', 
-                #   '1-0:6.5.0)', 'kvar)', 
-                #   '1-0:7.5.0)', 'kvar)', 
-                #   '1-0:8.5.0)', 'kvar)'
-                # ]
-                # 
-                # EMH meter
-                # P.01(1220823161500)(00000000)(15)(6)(1.5)(kW)(2.5)(kW)(5.5)(kvar)(6.5)(kvar)(7.5)(kvar)(8.5)(kvar)
-                # P.01([z]YYMMDDhhmmss)(SSSSSSSS)(r)(k)(K1)(E1)..[(Kk)(Ek)](x...x)...[(y...y)]
-                # Or
-                # P.01(1221005001500)(00000000)(15)(8)(1-1:1.29)(kWh)(1-1:2.29)(kWh)(1-1:5.29)(kvarh)(1-1:6.29)(kvarh)(1-1:7.29)(kvarh)(1-1:8.29)(kvarh)(1-2:1.29)(kWh)(1-3:2.29)(kWh)^M
-                
-                line_number = 0
-                try:
-                    line = line.split('(')
-                    kz = line[0]
-
-                    # Take meter TZ and make timestamp UTC
-                    # Switch from static TZ to DB based TZ
-                    # zsts13 = datetime.datetime.strptime(f"{line[1].strip(')')[1:]} {self.offset}", self.time_format)
-                    zsts13 = datetime.datetime.strptime(f"{line[1].strip(')')[1:]}", self.time_format_no_tz)
-                    zsts13 = self.dt_tz.localize(zsts13)
-
-                    if self.manufacturer == 'metcom':
-                        # '08)' => '00001000'
-                        # '0A)' => '00001010'
-                        # Bit
-                        # 7 PDN Power down
-                        # 6 RSV Reserved
-                        # 5 CAD Clock adjusted
-                        # 4 RSV Reserved
-                        # 3 DST Daylight saving
-                        # 2 DNV Data not valid
-                        # 1 CIV Clock invalid
-                        # 0 ERR Critical error
-
-                        s = format(int(line[2].strip(')'), 16), '08b')
-                    else:
-                        # 'emh'
-                        # '00000000)'
-                        s =  line[2].strip(')')
-
-                    # '15)'
-                    rp = datetime.timedelta(minutes=int(line[3].strip(')')))
-
-                    # '6)' - amount of values in a line
-                    z = int(line[4].strip(')'))
-
-                    if z != 6 and z != 8:
-                        self.log('WARN', f'Not expecting z other than 6 or 8, z={z} received. Update the parser code. {line}')
-                        sys.exit(1)
-                    
-                    ids = list()
-                    units = list()
-                    
-
-                    # Values in line with index 0-4 are a constant prefix like
-                    # ['P.01', '1221002001500)', '00000000)', '15)', '8)',
-                    # Values with index 5+ are a variable key list like
-                    # '1-1:1.29)', 'kWh)', '1-1:2.29)', 'kWh)', '1-1:5.29)', 'kvarh)', '1-1:6.29)', 'kvarh)', '1-1:7.29)', 'kvarh)', '1-1:8.29)', 'kvarh)', '1-2:1.29)', 'kWh)', '1-3:2.29)', 'kWh)'
-                    if self.manufacturer == 'metcom':
-                        # z = 6 => range(5,16,2)
-                        # z = 8 => range(5,20,2)
-                        for i in range(5,4+z*2,2):
-                            # '1.5)'
-                            # 'kW)'
-                            ids.append(line[i].strip().strip(')').split(':')[1])
-                            units.append(line[i+1].strip().strip(')'))
-                    else:
-                        # 'emh'
-                        # z = 6 => range(5,16,2)
-                        # z = 8 => range(5,20,2)
-                        for i in range(5,4+z*2,2):
-                        
-                            # '1-0:1.5.0)'
-                            # 'kW)'
-                            ids.append(line[i].strip().strip(')'))
-                            units.append(line[i+1].strip().strip(')'))                        
-
-                except Exception as e:
-                    self.log('ERROR', f'Exception "{e}" during P01 header parsing "{line}"')
-                    sys.exit(1)
-            else:
-                try:
-                    # Parse data line
-                    # (0.00063)(0.00000)(0.00023)(0.00000)(0.00000)(0.00000)
-                    # or 
-                    # # (0.00000)(0.04088)(0.00000)(0.00358)(0.00000)(0.00000)(0.00000)(0.00000)
-
-                    if len(line) < 2:
-                        self.log('DEBUG', f'Line "{line}" to short, skipping')
-                        # Probably, end of message
-                        return
-
-                    line = line.split('(')
-                    line.pop(0)
-
-                    if len(line) != z:
-                        self.log('ERROR', f'Expected z={z} values, found {len(line)} in line "{line}"')
-                        sys.exit(1)
-                    
-                    for i in range(z):
-                        parsed_line = {
-                            'id': ids[i],
-                            'value': line[i].strip().strip(')'),
-                            'unit': units[i],
-                            'line_time': (zsts13 + rp * line_number).strftime('%s')
-                        }
-
-                        # Match parsed_line['value'] with regex \d+\.\d+\. and skip incorrect value
-                        if not re.match(r'(\d+\.\d+$)', parsed_line['value']):
-                            self.log('ERROR', f'Expected float value, found "{parsed_line["value"]}" in line "{line}"')
-                            # sys.exit(1)
-                            continue
-                        
-                        self.parsed_data.append(parsed_line)
-                    line_number += 1
-                except Exception as e:
-                    self.log('ERROR', f'Exception "{e}" during P01 line parsing "{line}"')
-                    sys.exit(1)
+        self._parse_profile()
 
     def _parseP02(self):
         """
@@ -813,134 +957,213 @@ class Parser:
         Mwn         Measured values
         """
 
-        data = self.unparsed_data.split('\n')
-        for line in data:
+        self._parse_profile()
 
-            if line[0:4] in self.load_profiles:
-                # Parse header line
-                # Metcom
-                # [
-                #   'P.02', 
-                #   '0231122000000)', 
-                #   '00)', 
-                #   '1440)', 
-                #   '6)', 
-                #   '1-0:1.8.0)', 'kW)', 
-                #   '1-0:2.8.0)', 'kW)', 
-                #   '1-0:5.8.0)', 'kvar)', 
-                #   '1-0:6.8.0)', 'kvar)', 
-                #   '1-0:7.8.0)', 'kvar)', 
-                #   '1-0:8.8.0)', 'kvar)'
-                # ]
+    def _parse_profile(self):
+        """
+        P.01..P.10, see _parseP01()
+        Whatever could be parsed is kept, a broken header or line is logged and skipped,
+        self.resume_ts is the epoch of the last complete interval
+        """
+        for line in self.unparsed_data.split(b'\n'):
+            self.parsed_data.extend(self._profile_line(line))
+
+    def _profile_line(self, line: bytes):
+        """
+        One line of a load profile, header or values, see _parseP01()
+        The header may change in the middle of the readout, the following lines use the new layout
+        :return: list of records
+        """
+        if line[0:4] in self.load_profiles:
+            # Parse header line
+            # Metcom
+            # [
+            #   'P.01', 
+            #   '1220403160000)', 
+            #   '08)', 
+            #   '15)', 
+            #   '6)', 
+            #   '1-0:1.5.0)', 'kW)', 
+            #   '1-0:2.5.0)', 'kW)', 
+            #   '1-0:5.5.0)', 'kvar)', 
+            #   '1-0:6.5.0)', 'kvar)', 
+            #   '1-0:7.5.0)', 'kvar)', 
+            #   '1-0:8.5.0)', 'kvar)'
+            # ]
+            # 
+            # EMH meter
+            # P.01(1220823161500)(00000000)(15)(6)(1.5)(kW)(2.5)(kW)(5.5)(kvar)(6.5)(kvar)(7.5)(kvar)(8.5)(kvar)
+            # P.01([z]YYMMDDhhmmss)(SSSSSSSS)(r)(k)(K1)(E1)..[(Kk)(Ek)](x...x)...[(y...y)]
+            # Or
+            # P.01(1221005001500)(00000000)(15)(8)(1-1:1.29)(kWh)(1-1:2.29)(kWh)(1-1:5.29)(kvarh)(1-1:6.29)(kvarh)(1-1:7.29)(kvarh)(1-1:8.29)(kvarh)(1-2:1.29)(kWh)(1-3:2.29)(kWh)^M
+
+            self._line_number = 0
+            try:
+                start, status, rp, z, ids, units = self._parse_profile_header(line)
+            except Exception as e:
+                # Lines up to the next header can not be placed in time
+                self.log('ERROR', f'Exception "{e}" during profile header parsing "{line}", skipping the block')
+                self._profile = None
+                return []
+
+            # P.02..P.10 reuse the P.01 obis, 'p02-1.8.0'
+            kz = line[0:4].decode(Parser.encoding)
+            prefix = columnar.id_prefix(kz)
+            columns = self._wanted_columns(ids)
+            ids = [f'{prefix}{i}' for i in ids]
+            # Only the validity flags of the status are recorded, DST and the manufacturer bits are not
+            status &= columnar.status_flags(self.manufacturer)
+            self._profile = (start, rp, z, ids, units, status, columns, columnar.status_id(kz))
+            return []
+
+        # Parse data line
+        # (0.00063)(0.00000)(0.00023)(0.00000)(0.00000)(0.00000)
+        # or 
+        # # (0.00000)(0.04088)(0.00000)(0.00358)(0.00000)(0.00000)(0.00000)(0.00000)
+
+        line = line.strip()
+        if len(line) < 2:
+            self.log('DEBUG', f'Line "{line}" to short, skipping')
+            return []
+
+        if self._profile is None:
+            self.log('ERROR', f'Data line without a valid profile header "{line}", skipping')
+            return []
+
+        start, rp, z, ids, units, status, columns, status_id = self._profile
+        line_number = self._line_number
+        # The line takes its registration period even when it is broken
+        self._line_number += 1
+
+        records = []
+        try:
+            values = line.split(b'(')
+            values.pop(0)
+
+            if len(values) != z or line[-1:] != b')':
+                # Usually the last line of a readout terminated by timeout, "(0.17)(0.00"
+                self.log('ERROR', f'Expected z={z} values, found {len(values)} in line "{line}", skipping')
+                return []
+
+            line_ts = start + rp * line_number
+            line_time = str(line_ts)
+            for i in columns:
+                value = values[i].strip().strip(b')')
+
+                # Match value with regex and skip incorrect value
+                if not Parser.re_profile_value.match(value):
+                    self.log('ERROR', f'Expected numeric value, found "{value}" in line "{line}"')
+                    continue
+
+                if self.compact:
+                    parsed_line = record.Reading(ids[i], float(value), units[i], line_ts, status)
+                else:
+                    parsed_line = {
+                        'id': ids[i],
+                        'value': value.decode(Parser.encoding),
+                        'unit': units[i],
+                        'line_time': line_time
+                    }
+                records.append(parsed_line)
+        except Exception as e:
+            self.log('ERROR', f'Exception "{e}" during profile line parsing "{line}", skipping')
+            return []
+
+        if status:
+            # PDN, CAD, DNV... validity flags of the interval, no record means none of them is set
+            records.append(self._status_record(status_id, status, line_ts))
+        self.resume_ts = line_ts
+        return records
+
+    def _parse_profile_columnar(self):
+        """
+        Same input as _parseP01/_parseP02, one row per registration period instead of one dict per value
+        Channels are collected over all blocks, a channel which appears in a later header gets a new column
+
+        :return: columnar.LoadProfile
+        """
+        kz = Parser.profile_types[self.data_type].decode(Parser.encoding)
+        obis = list()
+        units = list()
+        columns = dict()
 
+        rows = list()
+        row_columns = list()
+        block_columns = None
+        layouts = list()
+        # Timestamp and status word per row
+        row_ts = list()
+        row_status = list()
+
+        for line in self.unparsed_data.split(b'\n'):
+
+            if line[0:4] in self.load_profiles:
                 line_number = 0
                 try:
-                    line = line.split('(')
-                    kz = line[0]
-
-                    # Take meter TZ and make timestamp UTC
-                    
-                    time_line = line[1].strip(')')[1:-6] # 231122
-                    time_format = '%y%m%d'
-                    zsts13 = datetime.datetime.strptime(time_line, time_format)
-                    zsts13 = self.dt_tz.localize(zsts13)
-
-                    if self.manufacturer == 'metcom':
-                        # '08)' => '00001000'
-                        # Bit
-                        # 7 PDN Power down
-                        # 6 RSV Reserved
-                        # 5 CAD Clock adjusted
-                        # 4 RSV Reserved
-                        # 3 DST Daylight saving
-                        # 2 DNV Data not valid
-                        # 1 CIV Clock invalid
-                        # 0 ERR Critical error
-                        s = format((int(line[2].strip(')'))), '08b')
-                    else:
-                        # 'emh'
-                        # '00000000)'
-                        s =  line[2].strip(')')
-
-                    # '1440)'
-                    rp = datetime.timedelta(minutes=int(line[3].strip(')')))
-
-                    # '6)' - amount of values in a line
-                    z = int(line[4].strip(')'))
-
-                    if z != 6 and z != 8:
-                        self.log('WARN', f'Not expecting z other than 6 or 8, z={z} received. Update the parser code. {line}')
-                        sys.exit(1)
-                    
-                    ids = list()
-                    units = list()
-                    
-
-                    # Values in line with index 0-4 are a constant prefix like
-                    # ['P.01', '1221002001500)', '00000000)', '15)', '8)',
-                    # Values with index 5+ are a variable key list like
-                    # '1-1:1.29)', 'kWh)', '1-1:2.29)', 'kWh)', '1-1:5.29)', 'kvarh)', '1-1:6.29)', 'kvarh)', '1-1:7.29)', 'kvarh)', '1-1:8.29)', 'kvarh)', '1-2:1.29)', 'kWh)', '1-3:2.29)', 'kWh)'
-                    if self.manufacturer == 'metcom':
-                        # z = 6 => range(5,16,2)
-                        # z = 8 => range(5,20,2)
-                        for i in range(5,4+z*2,2):
-                            # '1.5)'
-                            # 'kW)'
-                            ids.append(line[i].strip().strip(')').split(':')[1])
-                            units.append(line[i+1].strip().strip(')'))
-                    else:
-                        # 'emh'
-                        # z = 6 => range(5,16,2)
-                        # z = 8 => range(5,20,2)
-                        for i in range(5,4+z*2,2):
-                        
-                            # '1-0:1.5.0)'
-                            # 'kW)'
-                            ids.append(line[i].strip().strip(')'))
-                            units.append(line[i+1].strip().strip(')'))                        
-
+                    kz = line[0:4].decode(Parser.encoding)
+                    start, block_status, rp, z, ids, block_units = self._parse_profile_header(line)
                 except Exception as e:
-                    self.log('ERROR', f'Exception "{e}" during P01 header parsing "{line}"')
-                    sys.exit(1)
+                    self.log('ERROR', f'Exception "{e}" during {kz} header parsing "{line}", skipping the block')
+                    block_columns = None
+                    continue
+
+                # Metcom ids lose the channel prefix, '1-1:1.29' and '1-2:1.29' are both '1.29'
+                # Repeated ids in one header are separate columns
+                block_columns = list()
+                wanted = self._wanted_columns(ids)
+                for i in wanted:
+                    key = (ids[i], ids[:i].count(ids[i]))
+                    if key not in columns:
+                        columns[key] = len(obis)
+                        obis.append(ids[i])
+                        units.append(block_units[i])
+                    block_columns.append(columns[key])
+                layouts.append(block_columns)
             else:
-                try:
-                    # Parse data line
-                    # (0.00063)(0.00000)(0.00023)(0.00000)(0.00000)(0.00000)
-                    # or 
-                    # # (0.00000)(0.04088)(0.00000)(0.00358)(0.00000)(0.00000)(0.00000)(0.00000)
-
-                    if len(line) < 2:
-                        self.log('DEBUG', f'Line "{line}" to short, skipping')
-                        # Probably, end of message
-                        return
-
-                    line = line.split('(')
-                    line.pop(0)
-
-                    if len(line) != z:
-                        self.log('ERROR', f'Expected z={z} values, found {len(line)} in line "{line}"')
-                        sys.exit(1)
-                    
-                    for i in range(z):
-                        # We need to separate P02 data from others, cause obis is reused
-                        parsed_line = {
-                            'id': f'p02-{ids[i]}',
-                            'value': line[i].strip().strip(')'),
-                            'unit': units[i],
-                            'line_time': (zsts13 + rp * line_number).strftime('%s')
-                        }
-
-                        # Match parsed_line['value'] with regex \d+\.\d+\. and skip incorrect value
-                        if not re.match(r'(\d+\.\d+$)', parsed_line['value']):
-                            self.log('ERROR', f'Expected float value, found "{parsed_line["value"]}" in line "{line}"')
-                            # sys.exit(1)
-                            continue
-                        
-                        self.parsed_data.append(parsed_line)
-                    line_number += 1
-                except Exception as e:
-                    self.log('ERROR', f'Exception "{e}" during P01 line parsing "{line}"')
-                    sys.exit(1)
+                # (0.00063)(0.00000)(0.00023)(0.00000)(0.00000)(0.00000)
+                line = line.strip()
+                if len(line) < 2:
+                    self.log('DEBUG', f'Line "{line}" to short, skipping')
+                    continue
+
+                if block_columns is None:
+                    self.log('ERROR', f'Data line without a valid profile header "{line}", skipping')
+                    continue
+
+                line_number += 1
+                # Values are kept as bytes and converted by numpy at once
+                row = line.replace(b')', b'').split(b'(')[1:]
+                if len(row) != z or line[-1:] != b')':
+                    self.log('ERROR', f'Expected z={z} values, found {len(row)} in line "{line}", skipping')
+                    continue
+
+                if len(wanted) < z:
+                    # Channels dropped by the OBIS filter
+                    row = [row[i] for i in wanted]
+
+                if not Parser.re_profile_line.match(line):
+                    for i in range(len(row)):
+                        if not Parser.re_profile_value.match(row[i]):
+                            self.log('ERROR', f'Expected numeric value, found "{row[i]}" in line "{line}"')
+                            row[i] = b'nan'
+
+                rows.append(row)
+                row_columns.append(block_columns)
+                row_ts.append(start + rp * (line_number - 1))
+                row_status.append(block_status)
+
+        if all(c == list(range(len(obis))) for c in layouts):
+            # All blocks have the same channels in the same order, rows are the matrix already
+            values = numpy.array(rows, dtype=numpy.bytes_).astype(numpy.float64).reshape(len(rows), len(obis))
+        else:
+            values = numpy.full((len(rows), len(obis)), numpy.nan)
+            for n, row in enumerate(rows):
+                values[n, row_columns[n]] = numpy.array(row, dtype=numpy.bytes_).astype(numpy.float64)
+
+        if row_ts:
+            self.resume_ts = row_ts[-1]
+
+        return columnar.LoadProfile(kz, row_ts, values, obis, units, row_status, columnar.status_flags(self.manufacturer))
 
 
     def _find_data_blocks(self):
@@ -956,7 +1179,7 @@ class Parser:
         1-0:14.7.0(0.04995*kHz)
         
         '''
-        splitted_data = self.unparsed_data.split('\r\n')
+        splitted_data = self.unparsed_data.split(b'\r\n')
         
         # Table 1 provides F.F error register in the first line,
         # Other tables may provide meter name
@@ -964,47 +1187,43 @@ class Parser:
         if self.use_first_line:
             # It's explicitly enabled in DB per meter, skip this step
             self.log('DEBUG', f'self.use_first_line = {self.use_first_line}, skipping')
-            print(f'SD = {splitted_data}')
-        elif 'F.F' in splitted_data[0]:
+        elif b'F.F' in splitted_data[0]:
             self.log('DEBUG', f'F.F in line "{splitted_data[0]}", skipping ')
         else:
             splitted_data = splitted_data[1:]
         # if not 'F.F' in splitted_data[0]:
         #     splitted_data = splitted_data[1:]
 
-        print(f'SD = {splitted_data}')
-
         pre_parsed = dict()
         
         # Old pattern
         # re_list_pattern1 = re.compile('^\w+\\.\w.*?[(].*?[)]')
 
-        re_list_pattern1 = re.compile('^(.+?-.+?:)?\w+\\.\w.*?[(].*?[)]')
         p01_started = False
 
         try:
             for line in splitted_data:
-                if line.startswith('/'):
+                if line.startswith(b'/'):
                     # Skip header
                     self.log('DEBUG', f'Skipping header {line}')
                     continue
-                elif len(line) < 5 and '!' in line:
+                elif len(line) < 5 and b'!' in line:
                     # Probably the end of the message
                     self.log('DEBUG', f'Blocks found: {list(pre_parsed.keys())}')
                     self.log('DEBUG', pre_parsed)
                     self.log('DEBUG', f'End of the message found in {line}')
                     return pre_parsed
-                elif line.startswith('P.99'):
+                elif line.startswith(b'P.99'):
                     pre_parsed['P.99'] = line
                 elif p01_started:
                     pre_parsed['P.01'].append(line)
-                elif line.startswith('P.01'):
+                elif line.startswith(b'P.01'):
                     p01_started = True
                     if pre_parsed.get('P.01'):
                         pre_parsed['P.01'].append(line)
                     else:
                         pre_parsed['P.01'] = [line]
-                elif re_list_pattern1.search(line):
+                elif Parser.re_list_line.search(line):
                     if pre_parsed.get('list'):
                         pre_parsed['list'].append(line)
                     else:
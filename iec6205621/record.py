@@ -0,0 +1,98 @@
+import re
+import sys
+import json
+import decimal
+from collections.abc import Mapping
+
+
+class Reading(Mapping):
+    """
+    Compact parsed value, Parser(..., compact=True) returns these instead of dicts
+
+    P.01 (0.18374) of 1.5 [kW] at 1661264100
+        Reading('1.5', 0.18374, 'kW', 1661264100, status=0)
+    List 0.9.1(14:45:59)
+        Reading('0.9.1', '14:45:59')
+
+    id and unit are interned, so thousands of readings share one string per channel
+    value is a float for the decimal values, hex and alphanumeric values stay str ('00002000', '14:45:59')
+    line_time is int epoch or None for the list values
+    status is the profile status word of the block, not part of the dict view
+
+    Works as a read only dict for the existing consumers:
+        reading['value'], reading.get('unit'), 'line_time' in reading, dict(reading)
+    """
+    __slots__ = ('id', 'value', 'unit', 'line_time', 'status')
+
+    # Float values only, '00002000' status words and '2211010000' timestamps are kept as they are
+    re_decimal = re.compile(r'-?\d+\.\d+$')
+
+    def __init__(self, id: str, value, unit: str = None, line_time: int = None, status: int = None):
+        self.id = sys.intern(id)
+        if isinstance(value, str) and Reading.re_decimal.match(value):
+            value = float(value)
+        self.value = value
+        self.unit = sys.intern(unit) if unit else None
+        self.line_time = line_time
+        self.status = status
+
+    def keys(self):
+        if self.line_time is None:
+            return ('id', 'value', 'unit')
+        return ('id', 'value', 'unit', 'line_time')
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, key):
+        if key in self.keys():
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __repr__(self):
+        return f'Reading({self.id!r}, {self.value!r}, {self.unit!r}, {self.line_time!r}, status={self.status!r})'
+
+    def to_row(self) -> list:
+        """
+        ['1.5', 0.18374, 'kW', 1661264100] or ['1.5', 0.18374, 'kW', 1661264100, 0] with the status
+        """
+        if self.status is None:
+            return [self.id, self.value, self.unit, self.line_time]
+        return [self.id, self.value, self.unit, self.line_time, self.status]
+
+
+def text(value) -> str:
+    """
+    Value as stored in the DB text column, float values of the Readings without the exponent
+        1e-05 => '0.00001', 0.18374 => '0.18374', 1281.6601 => '1281.6601'
+    Leading and trailing zeros of the meter text are not kept: (00000391.3) => '391.3', (0.00000) => '0.0'
+    str values are returned as they are
+    """
+    if isinstance(value, float):
+        return format(decimal.Decimal(repr(value)), 'f')
+    return str(value)
+
+
+def dumps(records) -> str:
+    """
+    JSON for Redis, Readings are stored as rows
+        [{"id": "1.5", "value": "0.18374", "unit": "kW", "line_time": "1661264100"}]  - dicts, as before
+        [["1.5",0.18374,"kW",1661264100,0]]                                            - Readings
+    """
+    if records and isinstance(records[0], Reading):
+        return json.dumps([r.to_row() for r in records], separators=(',', ':'))
+    return json.dumps(records)
+
+
+def loads(data) -> list:
+    """
+    Reverse of dumps(), both formats are accepted
+    :return: list of dicts or Readings, consumers use them as dicts
+    """
+    records = json.loads(data)
+    if records and isinstance(records[0], list):
+        return [Reading(*row) for row in records]
+    return records
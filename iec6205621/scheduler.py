@@ -0,0 +1,183 @@
+import heapq
+import time
+import zlib
+
+
+class Scheduler:
+    """
+    Next-due queue of meters, the main loops sleep until the earliest deadline instead of scanning every meter
+
+    A meter is due at every multiple of its interval, the same slots as time.time() // interval:
+    interval 900 => :00, :15, :30, :45. A new meter is due right away.
+
+    scheduler = Scheduler()
+    scheduler.sync(meters_in_db, lambda meter: meter['p01'])    # after every DB refresh
+    for meter in scheduler.due():                               # meters due now, each is rescheduled to its next slot
+        ...
+    time.sleep(scheduler.wait())                                # seconds until the next one
+
+    Entries are updated in place by sync(): a changed interval moves the next slot,
+    a changed profile is returned by the next due(), meters missing in the DB response are dropped.
+    update() and remove() do the same for a few changed meters, the rest of the schedule is not touched
+
+    Any items can be scheduled with a key function, one entry per meter and data type:
+    scheduler.sync([(meter, 'p01'), (meter, 'p98')], lambda job: job[0][job[1]], key=lambda job: (job[0]['meter_id'], job[1]))
+
+    Scheduler(spread=300) moves every meter to its own second within 300s after the slot, so the fleet
+    doesn't start at the same second. The offset is crc32 of meter_id, the same on every restart and for all data types
+    of a meter, and never before the slot, when the profile interval is complete:
+    interval 900, offset 137 => :02:17, :17:17, :32:17, :47:17. New meters start within the spread window as well.
+    """
+
+    def __init__(self, spread: int = 0):
+        # (due, key), entries replaced by sync() stay in the heap and are skipped when popped
+        self.heap = []
+        # key => [due, interval, meter, last run, phase], key is meter_id by default
+        self.entries = dict()
+        self.spread = spread
+
+    def offset(self, entry) -> int:
+        """
+        Seconds after the slot, less than the interval
+        """
+        if not self.spread:
+            return 0
+        return entry[4] % min(self.spread, entry[1])
+
+    def next_slot(self, entry, after: float) -> float:
+        """
+        First slot of the entry later than after
+        """
+        offset = self.offset(entry)
+        return ((after - offset) // entry[1] + 1) * entry[1] + offset
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sync(self, meters: list, interval, now: float = None, key=None):
+        """
+        :param meters: list of meter dicts with 'meter_id'
+        :param interval: seconds, or a function meter => seconds. Meters with interval 0 are not scheduled
+        :param key: function meter => hashable key, meter['meter_id'] by default
+            The spread offset is taken from the key, or from its first item for tuples like (meter_id, data_id)
+        """
+        seen = self.update(meters, interval, now, key)
+        self.remove(set(self.entries) - seen)
+
+    def update(self, meters: list, interval, now: float = None, key=None) -> set:
+        """
+        Adds or updates only these meters, the other entries stay as they are. Same arguments as sync()
+        A meter with interval 0 is removed
+        :return: keys of the scheduled meters
+        """
+        now = time.time() if now is None else now
+        seen = set()
+        for meter in meters:
+            meter_id = key(meter) if key else meter['meter_id']
+            seconds = int(interval(meter) if callable(interval) else interval)
+            if seconds <= 0:
+                self.entries.pop(meter_id, None)
+                continue
+            seen.add(meter_id)
+
+            entry = self.entries.get(meter_id)
+            if entry is None:
+                source = meter_id[0] if isinstance(meter_id, tuple) else meter_id
+                entry = [now, seconds, meter, None, zlib.crc32(str(source).encode())]
+                # Right away, or spread over the window after a restart
+                entry[0] = now + self.offset(entry)
+                self.entries[meter_id] = entry
+                heapq.heappush(self.heap, (entry[0], meter_id))
+                continue
+
+            entry[2] = meter
+            if entry[1] != seconds:
+                # Next slot of the new interval after the last run, right away if it's already passed
+                entry[1] = seconds
+                due = now if entry[3] is None else max(self.next_slot(entry, entry[3]), now)
+                if due != entry[0]:
+                    entry[0] = due
+                    heapq.heappush(self.heap, (due, meter_id))
+        return seen
+
+    def remove(self, keys):
+        """
+        Drops the entries, unknown keys are ignored
+        """
+        for meter_id in keys:
+            self.entries.pop(meter_id, None)
+
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            # Too many replaced entries, rebuild
+            self.heap = [(entry[0], meter_id) for meter_id, entry in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def due(self, now: float = None) -> list:
+        """
+        Meters due by now, each one is moved to its next slot
+        :return: list of meter dicts
+        """
+        now = time.time() if now is None else now
+        meters = []
+        while self.heap and self.heap[0][0] <= now:
+            due, meter_id = heapq.heappop(self.heap)
+            entry = self.entries.get(meter_id)
+            if entry is None or entry[0] != due:
+                # Removed or rescheduled by sync()
+                continue
+            meters.append(self._run(meter_id, entry, now))
+        return meters
+
+    def take(self, key, until: float, now: float = None):
+        """
+        Runs one entry now if it's due by until, to read it in the same session with the due ones
+        :return: the item or None
+        """
+        now = time.time() if now is None else now
+        entry = self.entries.get(key)
+        if entry is None or entry[0] > until:
+            return None
+        # Its heap item is skipped as replaced
+        return self._run(key, entry, now)
+
+    def _run(self, key, entry, now: float):
+        # Next slot after now, or after its own slot if it's taken before it
+        entry[3] = now
+        entry[0] = self.next_slot(entry, max(now, entry[0]))
+        heapq.heappush(self.heap, (entry[0], key))
+        return entry[2]
+
+    def postpone(self, key, due: float):
+        """
+        Moves the next run of one entry, the following ones are on the regular slots again
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] == due:
+            return
+        entry[0] = due
+        heapq.heappush(self.heap, (due, key))
+
+    def advance(self, key, due: float) -> bool:
+        """
+        Runs one entry earlier, a retry before its next slot. Nothing changes if the next slot comes first
+        :return: True if moved
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= due:
+            return False
+        entry[0] = due
+        heapq.heappush(self.heap, (due, key))
+        return True
+
+    def wait(self, now: float = None, limit: float = 60) -> float:
+        """
+        :return: seconds until the earliest deadline, limit if there is nothing scheduled
+        """
+        now = time.time() if now is None else now
+        while self.heap:
+            due, meter_id = self.heap[0]
+            entry = self.entries.get(meter_id)
+            if entry is not None and entry[0] == due:
+                return min(max(due - now, 0), limit)
+            heapq.heappop(self.heap)
+        return limit
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import gzip
+import io
+import logging
+import os
+import sys
+import tarfile
+import zipfile
+import numpy
+from iec6205621 import parser as p
+from iec6205621 import record
+
+# Re-parses captured raw readouts in parallel
+#
+# Readouts are files named {meter_id}_{data_id}_{manufacturer}[_{epoch}][.ext]
+#   10067967_p01_metcom_1661264100.raw
+#   08354050_list1_emh.bin
+# in a directory (searched recursively) or in a .tar[.gz|.bz2|.xz] / .zip archive
+# epoch is the time of the readout, it is the timestamp of list values. File mtime is used if it's missing
+#
+# COPY-ready CSV, one file for all the readouts, gzip compressed if the name ends with .gz
+#   python3 parse_archive.py /data/captures.tar.gz --format csv --output /tmp/readouts.csv.gz
+#
+#   CREATE TABLE staging (meter_id varchar(20), ts timestamptz, obis varchar(40), value varchar(40), unit varchar(20));
+#   \copy staging FROM PROGRAM 'zcat /tmp/readouts.csv.gz' WITH (FORMAT csv, HEADER true)
+#
+# Compressed columnar files, one .npz per readout
+#   python3 parse_archive.py /data/captures/ --format npz --output /tmp/readouts/
+#
+#   Load profiles: meter_id, kz, ts int64[n], values float64[n, z], status uint32[n], obis[z], units[z]
+#   Other data:    meter_id, ts int64[n], obis[n], value[n] (str), units[n]
+
+logger = logging.getLogger('parse_archive')
+
+CSV_HEADER = ['meter_id', 'ts', 'obis', 'value', 'unit']
+
+
+def parse_tags(name: str):
+    """
+    'captures/10067967_p01_metcom_1661264100.raw' => {'meter_id': '10067967', 'data_id': 'p01', 'manufacturer': 'metcom', 'ts': 1661264100}
+    :return: dict or None if the name is not tagged
+    """
+    parts = os.path.basename(name).split('.')[0].split('_')
+    if len(parts) < 3:
+        return None
+    tags = {'meter_id': parts[0], 'data_id': parts[1].lower(), 'manufacturer': parts[2].lower(), 'ts': None}
+    if len(parts) > 3 and parts[3].isdigit():
+        tags['ts'] = int(parts[3])
+    return tags
+
+
+def iter_readouts(source: str):
+    """
+    Yields (name, data, mtime), data is None for the files in a directory, workers read them on their own
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                yield path, None, int(os.path.getmtime(path))
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                mtime = int(datetime.datetime(*member.date_time).timestamp())
+                yield member.filename, archive.read(member), mtime
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, 'r:*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                yield member.name, archive.extractfile(member).read(), int(member.mtime)
+    else:
+        raise ValueError(f'{source} is not a directory, tar or zip archive')
+
+
+def _utc(ts: int, cache: dict):
+    # Many values share one timestamp
+    text = cache.get(ts)
+    if text is None:
+        text = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S+00')
+        cache[ts] = text
+    return text
+
+
+def parse_readout(name: str, raw_data, mtime: int, output_format: str, output: str, timezone: str):
+    """
+    Worker, runs in a separate process
+    :return: (name, amount of values, csv text or npz file name, error or None)
+    """
+    tags = parse_tags(name)
+    if tags is None:
+        logger.warning(f'{name} is not tagged as meter_data_manufacturer, skipping')
+        return name, 0, None, None
+    if raw_data is None:
+        with open(name, 'rb') as f:
+            raw_data = f.read()
+
+    meter = {'meter_id': tags['meter_id'], 'manufacturer': tags['manufacturer'], 'timezone': timezone}
+    read_ts = tags['ts'] or mtime
+    try:
+        parser = p.Parser(raw_data, tags['data_id'], logger, compact=True, **meter)
+        if output_format == 'npz':
+            target = os.path.join(output, os.path.basename(name).split('.')[0] + '.npz')
+            if tags['data_id'] in p.Parser.profile_types:
+                profile = parser.parse_columnar()
+                numpy.savez_compressed(target, meter_id=tags['meter_id'], kz=profile.kz, ts=profile.ts, values=profile.values,
+                                       status=profile.status, obis=profile.ids, units=profile.units)
+                return name, int(numpy.count_nonzero(~numpy.isnan(profile.values))), target, None
+            readings = parser.parse()
+            numpy.savez_compressed(
+                target,
+                meter_id=tags['meter_id'],
+                ts=numpy.array([r.line_time or read_ts for r in readings], dtype=numpy.int64),
+                obis=numpy.array([r.id for r in readings], dtype=str),
+                value=numpy.array([record.text(r.value) for r in readings], dtype=str),
+                units=numpy.array([r.unit or '' for r in readings], dtype=str)
+            )
+            return name, len(readings), target, None
+
+        readings = parser.parse()
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        cache = dict()
+        for r in readings:
+            writer.writerow([tags['meter_id'], _utc(r.line_time or read_ts, cache), r.id, record.text(r.value), r.unit or ''])
+        return name, len(readings), text.getvalue(), None
+    except SystemExit:
+        # Parser gave up on the readout, the reason is in its log
+        return name, 0, None, 'parser exit'
+    except Exception as e:
+        return name, 0, None, str(e)
+
+
+def main(args=None):
+    arg_parser = argparse.ArgumentParser(description='Parse captured raw readouts in parallel')
+    arg_parser.add_argument('source', help='directory, .tar[.gz] or .zip with {meter_id}_{data_id}_{manufacturer}[_{epoch}] files')
+    arg_parser.add_argument('--format', dest='output_format', choices=['csv', 'npz'], default='csv')
+    arg_parser.add_argument('--output', required=True, help='CSV file (.csv or .csv.gz) or npz directory')
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='parser processes, default CPU count')
+    arg_parser.add_argument('--timezone', default='CET', help='meter timezone')
+    arg_parser.add_argument('--severity', default='ERROR', choices=['DEBUG', 'INFO', 'WARN', 'ERROR'])
+    args = arg_parser.parse_args(args)
+
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+    logger.setLevel(args.severity.replace('WARN', 'WARNING'))
+
+    if args.output_format == 'npz':
+        os.makedirs(args.output, exist_ok=True)
+        out = None
+    elif args.output.endswith('.gz'):
+        out = gzip.open(args.output, 'wt', newline='')
+    else:
+        out = open(args.output, 'w', newline='')
+    if out:
+        csv.writer(out, lineterminator='\n').writerow(CSV_HEADER)
+
+    readouts = values = failed = 0
+
+    def collect(future):
+        nonlocal readouts, values, failed
+        name, count, result, error = future.result()
+        readouts += 1
+        if error:
+            failed += 1
+            logger.error(f'{name} {error}')
+            return
+        values += count
+        if out and result:
+            out.write(result)
+        logger.debug(f'{name} {count} values')
+
+    # Archives are read by the main process, only a few readouts per worker are kept in memory
+    max_pending = args.workers * 4
+    pending = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for name, raw_data, mtime in iter_readouts(args.source):
+            pending.add(executor.submit(parse_readout, name, raw_data, mtime, args.output_format, args.output, args.timezone))
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+        for future in concurrent.futures.as_completed(pending):
+            collect(future)
+
+    if out:
+        out.close()
+    print(f'{readouts} readouts, {values} values, {failed} failed', file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
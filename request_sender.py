@@ -1,9 +1,17 @@
 import iec6205621.client as client
 import iec6205621.parser as p
 import iec6205621.inserter as i
+from iec6205621.scheduler import Scheduler
+from iec6205621.cluster import Cluster
+from iec6205621.limiter import AIMD
+from iec6205621.breaker import Breaker
 import time
 import sqlalchemy
 import concurrent.futures
+import collections
+import functools
+import threading
+import socket
 import logging
 import configparser
 import sys
@@ -21,6 +29,10 @@ import json
 # TODO: meter locking?
 # TODO: statistics counters
 
+# Data types in the order they are read in one meter session, see process_session()
+# Lists are read in the data readout mode, the rest share one programming mode sign on
+DATA_TYPES = ['list1', 'list2', 'list3', 'list4', 'error', 'p01', 'p02', 'p98', 'p99', 'p200', 'p210', 'p211']
+
 
 def create_logger(filename, severity_code: str = 'ERROR', log_stdout: bool = True):
     if severity_code == 'DEBUG':
@@ -85,6 +97,56 @@ class MyMeter(client.Meter):
         elif severity == 'DEBUG':
             self.logger.debug(f'{self.meter_id} {self.url[9:]} {logstring}')
 
+class StreamInserter:
+    """
+    Parses the readout while it is received from the meter and inserts the records in batches
+    One batch = one Redis key org:meterId_ts:data_id:part, so R2PG can pick up the first records
+    while the rest of the profile is still on the wire
+
+    m.on_data = stream.on_data
+    m.readLoadProfile(profile_number='1')
+    stream.close()
+    """
+    batch_size = 1000
+
+    def __init__(self, parser: p.Parser, inserter: i.Inserter, batch_size: int = None):
+        self.parser = parser
+        self.inserter = inserter
+        self.batch_size = batch_size or StreamInserter.batch_size
+        self.records = []
+        self.part = 0
+        self.received = 0
+        self.inserted = 0
+        self.failed = False
+        # Last inserted record, P.01 resumes from its line_time
+        self.last_record = None
+
+    def on_data(self, chunk):
+        self.received += len(chunk)
+        self.records.extend(self.parser.feed(chunk))
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        if self.inserter.insert(self.records, part=self.part):
+            self.inserted += len(self.records)
+            self.last_record = self.records[-1]
+        else:
+            self.failed = True
+        self.part += 1
+        self.records = []
+
+    def close(self):
+        """
+        :return: True if all the batches were inserted
+        """
+        self.records.extend(self.parser.close())
+        self.flush()
+        return not self.failed
+
+
 class MeterDB:
 
     def __init__(self, system_logger, **config):
@@ -100,10 +162,29 @@ class MeterDB:
         log_db_name = f'postgresql://{pg_user}:********@{pg_host}/{pg_db}'
 
 
+        # pg_listen = true: meter changes are pushed by the triggers in listen(), no full reload every minute
+        self.pg_listen = str(config.get('pg_listen') or '').lower() in ('1', 'true', 'yes')
+        self.listener = None
+        # Cash file name => hash of the last written meter list
+        self.cash_hash = dict()
+        # (meter_id, 'p01_from') => epoch or None, written by flush(), the last update of a field wins
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+
+        # Every query checks out its own connection, safe from any thread
+        # A connection dropped by the DB is found by pre_ping and replaced, the next query reconnects
+        self.engine = None
         try:
-            engine = sqlalchemy.create_engine(db_name)
-            self.conn = engine.connect()
-            self.logger.info(f'Connected to the DB {log_db_name}')
+            self.engine = sqlalchemy.create_engine(
+                db_name,
+                pool_size=int(config.get('pg_pool_size') or 5),
+                max_overflow=int(config.get('pg_max_overflow') or 5),
+                pool_timeout=int(config.get('pg_pool_timeout') or 10),
+                pool_recycle=3600,
+                pool_pre_ping=True,
+            )
+            with self.engine.connect():
+                self.logger.info(f'Connected to the DB {log_db_name}')
         except Exception as e:
             self.logger.error(f'Error "{e}" while connecting to the DB {log_db_name}')
             
@@ -118,7 +199,10 @@ class MeterDB:
         """
         self.logger.debug(f'{meter} P01 action = "{action}"')
 
-        if isinstance(time_from, datetime.datetime):
+        if isinstance(time_from, int):
+            # Exact epoch, no round trip through the local time
+            now = f"to_timestamp({time_from})"
+        elif isinstance(time_from, datetime.datetime):
             now = f"to_timestamp(\'{time_from.strftime('%s')}\')"
         else:
             now = f"to_timestamp(\'{datetime.datetime.now().strftime('%s')}\')"
@@ -131,7 +215,8 @@ class MeterDB:
             self.logger.warn(f'Unknown method "{action}" provided')
 
         try:
-            self.conn.execute(query)
+            with self.engine.begin() as conn:
+                conn.execute(query)
             self.logger.debug(f'Executed {query}')
         except Exception as e:
             self.logger.error(f'Error "{e}" during meter from_p01 update, last query = "{query}"')
@@ -143,6 +228,8 @@ class MeterDB:
         """
         Updates meter SQL profile with p01_from or p98_from request ts
         If request was successfull - reset the ts
+        Thread safe, the update is queued and written by the next flush() of the main loop
+        :param time_from: datetime, int epoch (Parser.resume_ts) or None for now
         """
 
         if data_type not in ['p01_from', 'p98_from']:
@@ -151,34 +238,75 @@ class MeterDB:
 
         self.logger.debug(f'{meter} {data_type} action = "{action}"')
 
-        if isinstance(time_from, datetime.datetime):
-            now = f"to_timestamp(\'{time_from.strftime('%s')}\')"
-        else:
-            now = f"to_timestamp(\'{datetime.datetime.now().strftime('%s')}\')"
-
         if action == 'set':
-            query = f"UPDATE {self.pg_schema}.meters SET {data_type}={now} WHERE meters.meter_id = '{meter}';"
+            if isinstance(time_from, int):
+                ts = time_from
+            elif isinstance(time_from, datetime.datetime):
+                ts = int(time_from.timestamp())
+            else:
+                ts = int(time.time())
         elif action == 'delete':
-            query = f"UPDATE {self.pg_schema}.meters SET {data_type}=NULL WHERE meters.meter_id = '{meter}';"
+            ts = None
         else:
-            self.logger.warn(f'Unknown method "{action}" provided')
+            self.logger.warning(f'Unknown method "{action}" provided')
+            return
+
+        with self.pending_lock:
+            self.pending[(meter, data_type)] = ts
+
+    def flush(self):
+        """
+        Writes the queued update_from_field() values, one UPDATE per field for all meters:
+
+        UPDATE meters.meters SET p01_from = to_timestamp(v.ts) FROM (VALUES
+            ('10067967', 1700507700), ('08354050', NULL)
+        ) AS v(meter_id, ts) WHERE meters.meter_id = v.meter_id;
+
+        Not written values are queued again unless a newer one is there already
+        """
+        with self.pending_lock:
+            pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+
+        for data_type in ['p01_from', 'p98_from']:
+            updates = [(meter, ts) for (meter, field), ts in pending.items() if field == data_type]
+            # At most 1000 meters per statement
+            for start in range(0, len(updates), 1000):
+                self._update_from_values(data_type, updates[start:start + 1000])
+
+    def _update_from_values(self, data_type, updates):
+        params = dict()
+        values = []
+        for n, (meter, ts) in enumerate(updates):
+            params[f'm{n}'] = meter
+            params[f't{n}'] = ts
+            values.append(f'(CAST(:m{n} AS text), CAST(:t{n} AS double precision))')
+        query = f"UPDATE {self.pg_schema}.meters SET {data_type} = to_timestamp(v.ts) FROM (VALUES {', '.join(values)}) \
+        AS v(meter_id, ts) WHERE meters.meter_id = v.meter_id;"
 
         try:
-            self.conn.execute(query)
-            self.logger.debug(f'Executed {query}')
+            with self.engine.begin() as conn:
+                conn.execute(sqlalchemy.text(query), params)
+            self.logger.debug(f'{len(updates)} meters {data_type} updated')
         except Exception as e:
-            self.logger.error(f'Error "{e}" during meter {data_type} update, last query = "{query}"')
+            self.logger.error(f'Error "{e}" during {len(updates)} meters {data_type} update')
+            with self.pending_lock:
+                for meter, ts in updates:
+                    self.pending.setdefault((meter, data_type), ts)
 
-        return
-    
-    def get_meters_from_pg(self, request):
+    def get_meters_from_pg(self, request, ids=None):
         """
+        :argument request: one data type, a comma separated list 'p01,p98,list4' or 'all'
+        A meter is returned if it has a nonzero interval in {schema}.queries for at least one of them
         Get only meters, which shall be queried for load profile or list/table
         Return list of meters
         If the database is not available - return a list from file cash, if exists
         :param pg_password: pass
         :param pg_user: user
         :argument request: str like 'p01', 'p98', 'list1' etc
+        :argument ids: meters.id of the changed meters from changed_meters(), only these rows are selected,
+            a missing one is deleted, deactivated or has no more queries. None is returned if the DB is not available
         :returns list of dicts [{
                             'interval': 900, 'manufacturer': 'MetCom',
                             'meter_id': '1MCS0010045438', 'ip': '192.168.121.101',
@@ -186,28 +314,38 @@ class MeterDB:
                             'last_run': 0...
                             }, {} ...]
         """
+        if request == 'all':
+            # Every interval column of {schema}.queries, meters without any are skipped by the scheduler
+            condition = 'true'
+        else:
+            condition = ' or '.join(f'queries.{data_id.strip()} > 0' for data_id in request.split(','))
+        if ids:
+            # Notification payloads are text
+            condition = f'({condition}) and meters.id::text = any(:ids)'
         query = f'SELECT row_to_json(m) FROM (\
-        SELECT * FROM {self.pg_schema}.meters INNER JOIN {self.pg_schema}.queries ON meters.id = queries.id WHERE queries.{request} > 0 and meters.is_active = True) m;'
+        SELECT * FROM {self.pg_schema}.meters INNER JOIN {self.pg_schema}.queries ON meters.id = queries.id WHERE ({condition}) and meters.is_active = True) m;'
         cash_file_name = f'/tmp/meters_{self.pg_schema}_{request}'
 
         try:
-            self.logger.info(f'Query: {query}')
-            query_result = self.conn.execute(query).fetchall()
+            self.logger.debug(f'Query: {query}')
+            params = {'ids': list(ids)} if ids else {}
+            with self.engine.connect() as conn:
+                query_result = conn.execute(sqlalchemy.text(query), params).fetchall()
             result = []
             for meter in query_result:
                 meter = meter[0]
                 result.append(meter)
-            self.logger.info(f'{len(result)} meters found in DB:')
+            self.logger.info(f'{len(result)} meters found in DB')
             for i in result:
-                self.logger.info(i)
+                self.logger.debug(i)
 
-            # Write result into file cash
-            with open(cash_file_name, 'w') as cash_file:
-                self.logger.info(f'Writing cash file {cash_file_name}')
-                cash_file.write(json.dumps(result))
+            if not ids:
+                self.write_cash(request, result)
             return result
         except Exception as e:
             self.logger.error(e)
+            if ids:
+                return None
             # Check if cash file exists
             if os.path.isfile(cash_file_name):
                 with open(cash_file_name, 'r') as cash_file:
@@ -219,10 +357,337 @@ class MeterDB:
                 self.logger.info(f'Cash file NOT found at {cash_file_name}')
                 sys.exit(1)
 
+    def write_cash(self, request, meters: list):
+        """
+        Rewrites /tmp/meters_{schema}_{request} only if the meter list has changed since the last write
+        """
+        cash_file_name = f'/tmp/meters_{self.pg_schema}_{request}'
+        data = json.dumps(meters, sort_keys=True)
+        data_hash = hash(data)
+        if self.cash_hash.get(cash_file_name) == data_hash:
+            return
+        try:
+            with open(cash_file_name, 'w') as cash_file:
+                self.logger.info(f'Writing cash file {cash_file_name}')
+                cash_file.write(data)
+            self.cash_hash[cash_file_name] = data_hash
+        except Exception as e:
+            self.logger.error(f'Error "{e}" while writing cash file {cash_file_name}')
+
+    def stats(self):
+        """
+        INFO DB pool size 5, checked out 1, overflow -4, checked in 4
+        """
+        if self.engine is None:
+            return
+        pool = self.engine.pool
+        self.logger.info(f'DB pool size {pool.size()}, checked out {pool.checkedout()}, overflow {pool.overflow()}, checked in {pool.checkedin()}')
+
+    def listen(self) -> bool:
+        """
+        LISTEN meters_{schema} on its own autocommit connection, the triggers send meters.id of every changed row
+        Installed once per schema:
+
+        CREATE OR REPLACE FUNCTION {schema}.notify_meters() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('meters_{schema}', OLD.id::text);
+            ELSE
+                PERFORM pg_notify('meters_{schema}', NEW.id::text);
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        CREATE TRIGGER notify_meters AFTER INSERT OR DELETE ON {schema}.meters
+            FOR EACH ROW EXECUTE FUNCTION {schema}.notify_meters();
+        CREATE TRIGGER notify_meters_update AFTER UPDATE ON {schema}.meters
+            FOR EACH ROW WHEN (to_jsonb(OLD) - 'p01_from' - 'p98_from' IS DISTINCT FROM to_jsonb(NEW) - 'p01_from' - 'p98_from')
+            EXECUTE FUNCTION {schema}.notify_meters();
+        CREATE TRIGGER notify_queries AFTER INSERT OR UPDATE OR DELETE ON {schema}.queries
+            FOR EACH ROW EXECUTE FUNCTION {schema}.notify_meters();
+
+        p01_from and p98_from written by flush() don't notify, process_data() keeps them in the meter dict itself
+        """
+        channel = f'meters_{self.pg_schema}'
+        try:
+            # Out of the pool, it's never returned
+            self.listener = self.engine.raw_connection()
+            self.listener.detach()
+            self.listener.set_session(autocommit=True)
+            cursor = self.listener.cursor()
+            cursor.execute(f'LISTEN {channel};')
+            cursor.close()
+            self.logger.info(f'Listening to {channel}')
+            return True
+        except Exception as e:
+            self.logger.error(f'Error "{e}" while listening to {channel}')
+            self.listener = None
+            return False
+
+    def changed_meters(self):
+        """
+        :return: set of meters.id notified since the last call, None if there is no listener
+        """
+        if self.listener is None:
+            return None
+        try:
+            self.listener.poll()
+            ids = {notify.payload for notify in self.listener.notifies}
+            self.listener.notifies.clear()
+            return ids
+        except Exception as e:
+            # Lost connection, the next full reload listens again
+            self.logger.error(f'Error "{e}" while reading meter notifications')
+            self.listener = None
+            return None
+
+
+class MeterPool:
+    """
+    Long-lived worker pool for process_session()
+    A due meter is started as soon as a worker is free, a meter stuck in connect timeouts
+    holds only its own worker and doesn't delay the next interval of the other meters.
+    A meter is never queried twice at the same time, an interval which comes while the previous query
+    is still running is skipped.
+
+    The number of parallel sessions adapts to the network, see AIMD: the whole pool and every endpoint group
+    (the meter IP by default, meters behind one gateway or APN) have their own limit, up to max_workers.
+    Failed sessions halve the limit, healthy ones raise it by one per round. A throttled group waits,
+    the meters of the other groups are started meanwhile, and its further failures don't lower the pool limit.
+
+    pool = MeterPool(logger, max_workers=50)
+    pool.submit('10067967', process_session, group='192.168.121.101', meter=meter, logger=logger, data_ids=['p01', 'p98'], db=db)
+    pool.poll(0.05)     # collects finished queries, starts the waiting ones
+    pool.stats()        # INFO Workers 12/50, limit 37, 2 groups throttled, utilization 23%, started 40, completed 38, failed 1, skipped 0, waiting 0, max wait 0.0s
+    """
+
+    def __init__(self, logger, max_workers: int = None, min_workers: int = 1):
+        self.logger = logger
+        # Same default as ThreadPoolExecutor
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.min_workers = min_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='meter')
+        # future => (meter_id, group, adaptive, start time, fn, kwargs)
+        self.running = dict()
+        # (meter_id, group, adaptive, queued time, fn, kwargs) waiting for a free worker
+        self.waiting = collections.deque()
+        # Meter ids either running or waiting
+        self.busy_meters = set()
+
+        self.limit = AIMD(self.max_workers, minimum=min_workers)
+        # group => AIMD, group => running sessions
+        self.group_limits = dict()
+        self.group_running = collections.Counter()
+
+        self.stats_start = time.monotonic()
+        self.busy_time = 0.0
+        self.started = self.completed = self.failed = self.skipped = 0
+        self.max_wait = 0.0
+
+    def submit(self, meter_id, fn, group=None, adaptive: bool = True, **kwargs) -> bool:
+        """
+        :param group: endpoint group of the meter for its own concurrency limit, None for the pool limit only
+        :param adaptive: False if the result doesn't change the limits, probes of parked meters
+        :return: False if the previous query of the meter is not finished yet
+        """
+        if meter_id in self.busy_meters:
+            self.skipped += 1
+            self.logger.warning(f'{meter_id} previous query is still running, skipping this interval')
+            return False
+        self.busy_meters.add(meter_id)
+        self.waiting.append((meter_id, group, adaptive, time.monotonic(), fn, kwargs))
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        # Never more jobs in the executor than the current limit, the rest waits here in the order it became due
+        blocked = []
+        while self.waiting and self.limit.allows(len(self.running)):
+            item = self.waiting.popleft()
+            meter_id, group, adaptive, queued, fn, kwargs = item
+            if group is not None:
+                if group not in self.group_limits:
+                    self.group_limits[group] = AIMD(self.max_workers, minimum=1)
+                if not self.group_limits[group].allows(self.group_running[group]):
+                    blocked.append(item)
+                    continue
+                self.group_running[group] += 1
+            now = time.monotonic()
+            self.max_wait = max(self.max_wait, now - queued)
+            self.running[self.executor.submit(fn, **kwargs)] = (meter_id, group, adaptive, now, fn, kwargs)
+            self.started += 1
+        # Throttled groups keep their place in the queue
+        self.waiting.extendleft(reversed(blocked))
+
+    def poll(self, timeout: float) -> list:
+        """
+        Waits up to timeout seconds for a query to finish, collects the finished ones and starts the waiting meters
+        Replaces the idle sleep of the main loop
+        :return: finished queries [(meter_id, fn, kwargs, exception or None)]
+        """
+        if not self.running:
+            time.sleep(timeout)
+            return []
+        done, _ = concurrent.futures.wait(self.running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        now = time.monotonic()
+        finished = []
+        for future in done:
+            meter_id, group, adaptive, started, fn, kwargs = self.running.pop(future)
+            self.busy_meters.discard(meter_id)
+            self.busy_time += now - max(started, self.stats_start)
+            self.completed += 1
+            error = future.exception()
+            if error is not None:
+                self.failed += 1
+                if not isinstance(error, SystemExit):
+                    # process_data() logs its own errors before sys.exit()
+                    self.logger.error(f'{meter_id} Query failed: "{error}"')
+
+            # Only a timeout, no answer or NAK is the network, the meter answered to the other errors
+            ok = not isinstance(error, client.NoAnswer)
+            group_limit = self.group_limits.get(group)
+            if adaptive and (ok or group_limit is None or not group_limit.throttled):
+                # A dead gateway throttles its own group, not the whole pool
+                self.limit.done(ok, started, now)
+            if group_limit is not None:
+                self.group_running[group] -= 1
+                if adaptive:
+                    group_limit.done(ok, started, now)
+            finished.append((meter_id, fn, kwargs, error))
+        self._dispatch()
+        return finished
+
+    def shutdown(self):
+        """
+        Drops the waiting queries and waits for the running ones
+        """
+        self.waiting.clear()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        """
+        Logs utilization since the previous call and resets the counters
+        utilization = worker busy time / (max_workers * elapsed time)
+        """
+        now = time.monotonic()
+        elapsed = max(now - self.stats_start, 0.001)
+        busy = self.busy_time + sum(now - max(started, self.stats_start) for _, _, _, started, _, _ in self.running.values())
+        utilization = busy / (self.max_workers * elapsed)
+        throttled = sum(1 for limit in self.group_limits.values() if limit.throttled)
+        self.logger.info(
+            f'Workers {len(self.running)}/{self.max_workers}, limit {int(self.limit.limit)}, {throttled} groups throttled, '
+            f'utilization {utilization:.0%}, '
+            f'started {self.started}, completed {self.completed}, failed {self.failed}, skipped {self.skipped}, '
+            f'waiting {len(self.waiting)}, max wait {self.max_wait:.1f}s'
+        )
+        self.stats_start = now
+        self.busy_time = 0.0
+        self.started = self.completed = self.failed = self.skipped = 0
+        self.max_wait = 0.0
+        return utilization
+
+
+def process_session(meter, logger: logging.Logger, data_ids: list, db: MeterDB = None):
+    """
+    Reads several data types of one meter over one connection
+    ['p98', 'list4', 'p01'] => list4 (data readout), then P.01 and P.98 with one programming mode sign on
+    A failed read doesn't stop the session, the next data type is read over a new connection
+    The failed data types are the SystemExit code, main() retries only them. A meter which gave no data at all exits
+    with the client code, whether the connect or the reads timed out: a reconnect failing after a successful read
+    fails the rest of the data types
+    client.NoAnswer if any of them timed out or got <NAK>, a parser error or an (ERROR) answer is a plain SystemExit
+    """
+    meter_id = meter['meter_id']
+    session = None
+    failed = []
+    no_answer = False
+    ordered = sorted(data_ids, key=DATA_TYPES.index)
+    try:
+        for n, data_id in enumerate(ordered):
+            if session is None:
+                try:
+                    session = MyMeter(logger=logger, timeout=4, **meter)
+                except client.NoAnswer:
+                    if len(failed) == n:
+                        # Nothing read, the meter is not reachable
+                        raise
+                    failed.extend(ordered[n:])
+                    no_answer = True
+                    break
+            try:
+                process_data(meter, logger, data_id, db, session=session)
+            except (SystemExit, Exception) as e:
+                if not isinstance(e, SystemExit):
+                    # Parser or inserter error raised while the data was received
+                    logger.error(f'{meter_id} {data_id} failed: "{e}"')
+                no_answer = no_answer or isinstance(e, client.NoAnswer)
+                # The reason is logged by process_data(), meter state is unknown - reconnect
+                failed.append(data_id)
+                session.close()
+                session = None
+    finally:
+        if session:
+            session.close()
+
+    if failed:
+        logger.warning(f'{meter_id} {failed} failed in session {data_ids}')
+        if no_answer and len(failed) == len(ordered):
+            # Connected but nothing read, a modem without the meter behind it is as unreachable as a closed port
+            raise client.NoAnswer(1)
+        if no_answer:
+            raise client.NoAnswer(failed)
+        sys.exit(failed)
+
+
+def session_finished(meter_id, kwargs: dict, error, now: float, breaker: Breaker, scheduler: Scheduler, logger: logging.Logger):
+    """
+    Result of a process_session() from MeterPool.poll(), decides about the retries and the breaker
+    :param error: None, SystemExit with the failed data types or the client code, any other exception
+    """
+    if error is None:
+        breaker.succeeded(meter_id, kwargs['data_ids'])
+        return
+    if isinstance(error, SystemExit) and not isinstance(error.code, list):
+        # process_session() exits with the client code if nothing was read, the meter is not reachable
+        retry = breaker.failed(meter_id, now, kwargs['meter'])
+        if retry is None:
+            logger.warning(f'{meter_id} failed {breaker.meters[meter_id][0]} times in a row, parked for {breaker.meters[meter_id][3]}s')
+            return
+        for d in kwargs['data_ids']:
+            if scheduler.advance((meter_id, d), retry):
+                logger.debug(f'{meter_id} {d} retry in {retry - now:.0f}s')
+        return
+    # The meter answered, only the failed data types are retried and the breaker stays closed
+    failed = error.code if isinstance(error, SystemExit) else kwargs['data_ids']
+    read = [d for d in kwargs['data_ids'] if d not in failed]
+    if read:
+        breaker.succeeded(meter_id, read)
+    for d in failed:
+        retry = breaker.retry((meter_id, d), now)
+        if scheduler.advance((meter_id, d), retry):
+            logger.debug(f'{meter_id} {d} retry in {retry - now:.0f}s')
+
+
+def probe_meter(meter, logger: logging.Logger, timeout: int = 4):
+    """
+    Cheap check of a parked meter: one TCP connect to the port or the backup port, nothing is sent
+    client.NoAnswer if neither answers
+    """
+    for port in [meter.get('port'), meter.get('backup_port')]:
+        if not port:
+            continue
+        try:
+            with socket.create_connection((meter['ip_address'], int(port)), timeout=timeout):
+                logger.debug(f'{meter["meter_id"]} probe {meter["ip_address"]}:{port} OK')
+                return True
+        except OSError as e:
+            logger.debug(f'{meter["meter_id"]} probe {meter["ip_address"]}:{port} failed "{e}"')
+    raise client.NoAnswer(1)
+
 
-def process_data(meter, logger: logging.Logger, data_id, db: MeterDB =None):
+def process_data(meter, logger: logging.Logger, data_id, db: MeterDB =None, session: MyMeter = None):
     """
     Query the meter, parse the data, push to pg
+    :param session: connected MyMeter of process_session(), a new connection is made if None
     """
     meter_id = meter['meter_id']
 
@@ -277,8 +742,27 @@ def process_data(meter, logger: logging.Logger, data_id, db: MeterDB =None):
             # Set p98_from field in SQL meter profile if not set
             db.update_from_field(meter_id, data_type='p98_from', action='set', time_from=time_from)
 
+    # ['org', '10067967', 1649100604, 'p01']
+    meter_ts = [meter["org"].lower(), meter_id, int(time.time()), data_id]
+    inserter = i.Inserter(logger=logger, meter_ts=meter_ts)
+
+    # Records are parsed and inserted while the data is received
     try:
-        m = MyMeter(logger=logger, timeout=4, **meter)
+        parser = p.Parser(b'', data_type=data_id, logger=logger, compact=True, **meter)
+        stream = StreamInserter(parser, inserter, batch_size=meter.get('stream_batch_size'))
+    except Exception as e:
+        logger.error(f'{meter_id} Error during parsing: "{e}"')
+        sys.exit(1)
+
+    try:
+        if session is None:
+            m = MyMeter(logger=logger, timeout=4, **meter)
+        else:
+            # p01_from and p98_from may be set above
+            m = session
+            m.p01_from = meter.get('p01_from') or None
+            m.p98_from = meter.get('p98_from') or None
+        m.on_data = stream.on_data
     except Exception as e:
         logger.error(e)
         sys.exit(1)
@@ -306,47 +790,43 @@ def process_data(meter, logger: logging.Logger, data_id, db: MeterDB =None):
         logger.warning(f'Unknown data_id = {data_id}')
         sys.exit(1)
 
-    # Parse data
     try:
-        parser = p.Parser(raw_data, data_type=data_id, logger=logger, **meter)
-        parsed_data = parser.parse()
-        logger.debug(f'{meter_id} Parsed data: {parsed_data}')
-        # P.01 
-        # [
-        #   {'id': '1.5.0', 'value': '0.00709', 'unit': 'kW', 'line_time': '1700507700'}, 
-        #   {'id': '2.5.0', 'value': '0.00000', 'unit': 'kW', 'line_time': '1700507700'}, 
-        #   {'id': '5.5.0', 'value': '0.00157', 'unit': 'kvar', 'line_time': '1700507700'}, 
-        #   {'id': '6.5.0', 'value': '0.00000', 'unit': 'kvar', 'line_time': '1700507700'}, 
-        #   {'id': '7.5.0', 'value': '0.00000', 'unit': 'kvar', 'line_time': '1700507700'}
-        # ]
-        if data_id == 'p01':
-            last_ts_e = parsed_data[-1]['line_time']
-            # Convert unixtime to datetime object
-            last_ts = datetime.datetime.fromtimestamp(int(last_ts_e))
-            last_ts_str = f"{datetime.datetime.fromtimestamp(int(last_ts_e)).strftime('%Y-%m-%dT%H:%M:%S%z')}+02:00"
-            logger.debug(f'Last ts: {last_ts_e} = {last_ts_str}')
-
+        if stream.received == 0 and raw_data:
+            # The response was not streamed
+            stream.on_data(raw_data)
+        inserted = stream.close()
+        logger.debug(f'{meter_id} {stream.inserted} records inserted in {stream.part} parts')
     except Exception as e:
         logger.error(f'{meter_id} Error during parsing: "{e}"')
         sys.exit(1)
-    # Push data somewhere
-    if len(parsed_data) > 0:
 
-        # ['org', '10067967', 1649100604, 'p01']
-        meter_ts = [meter["org"].lower(), meter_id, int(time.time()), data_id]
-        inserter = i.Inserter(logger=logger, meter_ts=meter_ts)
-        if inserter.insert(parsed_data):
+    # P.01 
+    # [
+    #   {'id': '1.5.0', 'value': '0.00709', 'unit': 'kW', 'line_time': '1700507700'}, 
+    #   {'id': '2.5.0', 'value': '0.00000', 'unit': 'kW', 'line_time': '1700507700'}, 
+    #   {'id': '5.5.0', 'value': '0.00157', 'unit': 'kvar', 'line_time': '1700507700'}, 
+    #   {'id': '6.5.0', 'value': '0.00000', 'unit': 'kvar', 'line_time': '1700507700'}, 
+    #   {'id': '7.5.0', 'value': '0.00000', 'unit': 'kvar', 'line_time': '1700507700'}
+    # ]
+    if stream.inserted > 0:
+        if inserted:
             if data_id == 'p01':
                 # # All good - unset p01_from field in SQL meter profile
                 # db.update_from_field(meter_id, data_type='p01_from', action='delete')
                 
-                # All good - set p01_from field to the last parsed line_time.
-                # This allows to dealt with a problem, when meter doesn't return full requested dataset.
+                # All good - set p01_from field to the last complete interval.
+                # This allows to dealt with a problem, when meter doesn't return full requested dataset:
+                # a readout cut by timeout keeps its complete rows, the next request starts from the last of them
+                last_ts = int(parser.resume_ts or stream.last_record['line_time'])
+                logger.debug(f'{meter_id} last complete interval {last_ts} = {datetime.datetime.fromtimestamp(last_ts)}')
                 db.update_from_field(meter_id, data_type='p01_from',action='set', time_from=last_ts)
+                # The DB triggers don't notify watermark updates, the next session takes it from here
+                meter['p01_from'] = datetime.datetime.fromtimestamp(last_ts, datetime.timezone.utc).isoformat()
                 
             if data_id == 'p98':
                 # All good - unset p98_from field in SQL meter profile
                 db.update_from_field(meter_id, data_type='p98_from', action='delete')                
+                meter['p98_from'] = None
     else:
         logger.debug(f'{meter_id} nothing to insert')
     return
@@ -358,6 +838,14 @@ def read_cfg(config_file):
     return config
 
 
+def without_watermarks(meters: dict) -> dict:
+    """
+    meters.id => meter without p01_from and p98_from, for the comparison of two meter lists
+    """
+    return {meter_db_id: {k: v for k, v in meter.items() if k not in ('p01_from', 'p98_from')}
+            for meter_db_id, meter in meters.items()}
+
+
 def select_meters(meters_from_db, meters_to_process):
     """
     Merge existing meters with the new DB response
@@ -397,79 +885,218 @@ def main(config_file):
 
     log_stdout = config['DEFAULT'].get('log_stdout') or False
     logger = create_logger(filename=config['DEFAULT']['logfile'], severity_code=config['DEFAULT']['severity'], log_stdout=log_stdout)
-    data_id = config['DEFAULT']['data_id'].lower()
+    # One process for several data types: data_id = p01,p98,list4 or data_id = all
+    data_id = config['DEFAULT']['data_id'].lower().replace(' ', '')
+    data_ids = DATA_TYPES if data_id == 'all' else data_id.split(',')
+    unknown = [d for d in data_ids if d not in DATA_TYPES]
+    if unknown:
+        logger.error(f'Incorrect data_id {unknown}, expecting one of {DATA_TYPES} or all')
+        sys.exit(1)
 
-    last_runs = dict()
+    # Next run of every meter and data type, refreshed from the DB every minute
+    # Meters are spread over spread_window seconds after the slot instead of starting at the same second
+    scheduler = Scheduler(spread=int(config['DEFAULT'].get('spread_window') or 0))
+    # Data types due at the same time are read in one session, this many seconds later ones are added
+    coalesce_window = int(config['DEFAULT'].get('coalesce_window') or 0)
 
     db = MeterDB(logger, **config['DB'])
 
-    while True:
-
-        if time.time() // 60 > config_timer:
-            # Re-read config every minute
-            config = read_cfg(config_file)
-            try:
-                logger.setLevel(config['DEFAULT']['severity'])
-            except Exception as e:
-                print(f'Error {e}')
-                sys.exit(1)
-                
-            # Re-read meters from DB every minute
+    # Pool size is taken once at start, stats are logged every stats_interval seconds
+    # Parallel sessions adapt between min_workers and max_workers, per endpoint group as well
+    max_workers = config['DEFAULT'].get('max_workers')
+    pool = MeterPool(logger, max_workers=int(max_workers) if max_workers else None,
+                     min_workers=int(config['DEFAULT'].get('min_workers') or 1))
+    # Meter field of the endpoint group, meters behind one gateway share its IP
+    group_by = config['DEFAULT'].get('group_by') or 'ip_address'
+    # Failed sessions are retried after retry_delay, 2 * retry_delay... seconds,
+    # breaker_threshold failures in a row park the meter for breaker_cooldown seconds until a probe connects
+    breaker = Breaker(
+        retry_delay=int(config['DEFAULT'].get('retry_delay') or 30),
+        threshold=int(config['DEFAULT'].get('breaker_threshold') or 5),
+        cooldown=int(config['DEFAULT'].get('breaker_cooldown') or 3600),
+        max_cooldown=int(config['DEFAULT'].get('breaker_max_cooldown') or 86400),
+    )
+    stats_interval = int(config['DEFAULT'].get('stats_interval') or 60)
+    stats_timer = time.time() // stats_interval
+    # p01_from and p98_from of the finished sessions are written together every flush_interval seconds
+    flush_interval = int(config['DB'].get('flush_interval') or 5)
+    flush_timer = time.time() // flush_interval
+
+    # With a [CLUSTER] section the meters are shared with the other collectors of the same schema and data_id
+    cluster = None
+    if config.has_section('CLUSTER'):
+        cluster = Cluster(logger, f'{db.pg_schema}:{data_id}', **config['CLUSTER'])
+    rebalance = False
+
+    # meters.id => meter, from the full reload and the rows changed since
+    meters = dict()
+    # Full reload every minute, with [DB] pg_listen only every meters_reload seconds in case a notification is lost
+    meters_reload = int(config['DEFAULT'].get('meters_reload') or 3600)
+    meters_timer = 0
+    # Meters changed since the last cash file write
+    cash_changed = False
+    cash_timer = 0
+    # One scheduler entry per meter and data type
+    job_key = lambda job: (job[0]['meter_id'], job[1])
 
-            if 'db' in locals() or 'db' in globals():
-                # Variable is defined - use instanse method
-                meters_in_db = db.get_meters_from_pg(data_id)
-            else:
-                # Variable not defined - DB object instantination issues - read file
-                cash_file_name = f'/tmp/meters_{config["DB"]["pg_schema"]}_{data_id}'
-                if os.path.isfile(cash_file_name):
-                    with open(cash_file_name, 'r') as cash_file:
-                        logger.info(f'Cash file found at {cash_file_name}')
-                        meters_in_db = json.loads(cash_file.read())
-                else:
-                    logger.info(f'DB not available and no cash file found at {cash_file_name}')
+    try:
+        while True:
+
+            if time.time() // 60 > config_timer:
+                # Re-read config every minute
+                config = read_cfg(config_file)
+                try:
+                    logger.setLevel(config['DEFAULT']['severity'])
+                except Exception as e:
+                    print(f'Error {e}')
                     sys.exit(1)
+                config_timer = time.time() // 60
 
-            config_timer = time.time() // 60
+            if time.time() - meters_timer >= (meters_reload if db.listener is not None else 60):
+                if db.pg_listen and db.listener is None:
+                    # Before the full reload, a change in between is not lost
+                    db.listen()
 
-        try:
-            if len(meters_in_db) < 1:
-                logger.info('No meters found')
-                # sys.exit(1)
-                time.sleep(10)
-                continue
+                if 'db' in locals() or 'db' in globals():
+                    # Variable is defined - use instanse method
+                    meters_in_db = db.get_meters_from_pg(data_id)
+                else:
+                    # Variable not defined - DB object instantination issues - read file
+                    cash_file_name = f'/tmp/meters_{config["DB"].get("pg_schema") or "meters"}_{data_id}'
+                    if os.path.isfile(cash_file_name):
+                        with open(cash_file_name, 'r') as cash_file:
+                            logger.info(f'Cash file found at {cash_file_name}')
+                            meters_in_db = json.loads(cash_file.read())
+                    else:
+                        logger.info(f'DB not available and no cash file found at {cash_file_name}')
+                        sys.exit(1)
+
+                # The scheduler is synced only if something has changed
+                # p01_from and p98_from are kept up to date by process_data(), they are not a change
+                fresh = {str(meter['id']): meter for meter in meters_in_db}
+                if without_watermarks(fresh) != without_watermarks(meters):
+                    meters = fresh
+                    rebalance = True
+                else:
+                    meters_in_db = list(meters.values())
+                meters_timer = time.time()
+                # Written by get_meters_from_pg()
+                cash_changed = False
+            else:
+                # Only the rows notified by the DB triggers, see MeterDB.listen()
+                changed = db.changed_meters()
+                if changed:
+                    rows = db.get_meters_from_pg(data_id, ids=changed)
+                    if rows is None:
+                        # DB not available, full reload with the cash file fallback
+                        meters_timer = 0
+                    else:
+                        logger.info(f'{len(changed)} meters changed in DB, {len(rows)} to be queried')
+                        # Deleted, deactivated or without queries are not returned
+                        removed = [meters.pop(meter_db_id) for meter_db_id in changed if meter_db_id in meters]
+                        meters.update((str(meter['id']), meter) for meter in rows)
+                        meters_in_db = list(meters.values())
+                        # Only the changed meters are rescheduled, a data type with interval 0 is dropped
+                        owned = [meter for meter in rows if cluster is None or cluster.owns(meter['meter_id'])]
+                        jobs = [(meter, d) for meter in owned for d in data_ids]
+                        scheduled = scheduler.update(jobs, lambda job: job[0].get(job[1]) or 0, key=job_key)
+                        scheduler.remove({(meter['meter_id'], d) for meter in removed for d in data_ids} - scheduled)
+                        breaker.remove({meter['meter_id'] for meter in removed} - {meter['meter_id'] for meter in owned})
+                        cash_changed = True
+
+            if cash_changed and time.time() - cash_timer >= 60:
+                # The cash file is only a fallback, rewritten at most once a minute
+                db.write_cash(data_id, meters_in_db)
+                cash_changed = False
+                cash_timer = time.time()
+
+            if cluster is not None and cluster.heartbeat():
+                # A collector joined or died
+                rebalance = True
+
+            if rebalance:
+                # Only our own meters are scheduled, the ones moved to another collector are dropped
+                owned = [meter for meter in meters_in_db if cluster is None or cluster.owns(meter['meter_id'])]
+                if cluster is not None:
+                    logger.info(f'{cluster.node_id} owns {len(owned)}/{len(meters_in_db)} meters')
+                # New meters are due right away, changed intervals move the next run
+                jobs = [(meter, d) for meter in owned for d in data_ids if meter.get(d)]
+                scheduler.sync(jobs, lambda job: job[0][job[1]], key=job_key)
+                breaker.prune(meter['meter_id'] for meter in owned)
+                rebalance = False
 
-        except Exception as e:
-            print(f'Something went wrong: "{e}"')
-            sys.exit(1)
+            try:
+                if len(meters_in_db) < 1:
+                    logger.info('No meters found')
+                    # sys.exit(1)
+                    time.sleep(10)
+                    continue
 
-        meters_to_process = []                  # These meters will be subject to processing 
-        
-        # Iterate over meter list
-        # Pick ones to be processed in current cycle
-        for meter in meters_in_db:
-            meter_id = meter['meter_id']
-            check = time.time() // meter[data_id]
-
-            if last_runs.get(meter_id):
-                # Meter in last_runs - it was processed already
-                if check > last_runs[meter_id]:
-                    logger.debug(f'{meter_id} Interval: {meter[data_id]}, Last_run: {last_runs[meter_id]}, Check {check}')
-                    last_runs[meter_id] = check
-                    meters_to_process.append(meter)
-            else:
-                # Meter not in last_runs - it was not processed before
-                logger.debug(f'{meter_id} Interval: {meter[data_id]}, Last_run: 0, Check {check}')
-                meters_to_process.append(meter)
-                last_runs[meter_id] = check
-
-        if len(meters_to_process) > 0:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                for meter in meters_to_process:
-                    executor.submit(process_data, meter=meter, logger=logger, data_id=data_id, db=db)
-        else:
-            # To decrease CPU usage
-            time.sleep(0.05)
+            except Exception as e:
+                print(f'Something went wrong: "{e}"')
+                sys.exit(1)
+
+            # Due data types are grouped per meter, one session per meter is handed over to the pool
+            # The loop never waits for the running sessions
+            now = time.time()
+            sessions = dict()
+            for meter, d in scheduler.due(now):
+                sessions.setdefault(meter['meter_id'], (meter, []))[1].append(d)
+            if coalesce_window:
+                # Data types of the same meter due a bit later are read now
+                for meter_id, (meter, session_ids) in sessions.items():
+                    for d in data_ids:
+                        if d not in session_ids and scheduler.take((meter_id, d), now + coalesce_window, now):
+                            session_ids.append(d)
+
+            for meter_id, (meter, session_ids) in sessions.items():
+                if not breaker.allows(meter_id):
+                    # Parked, the probe decides when it's read again
+                    logger.debug(f'{meter_id} {session_ids} skipped, meter is parked')
+                    continue
+                if meter_id in pool.busy_meters:
+                    # Previous session is still running, read after it
+                    logger.debug(f'{meter_id} {session_ids} postponed, previous session is still running')
+                    for d in session_ids:
+                        scheduler.postpone((meter_id, d), time.time() + 5)
+                    continue
+                logger.debug(f'{meter_id} Session: {session_ids}')
+                # In a cluster the session holds the meter lease, a meter is never read by two collectors at once
+                session = process_session if cluster is None else functools.partial(cluster.leased, meter_id, process_session)
+                pool.submit(meter_id, session, group=meter.get(group_by), meter=meter, logger=logger, data_ids=session_ids, db=db)
+
+            for meter in breaker.probes(now):
+                logger.info(f'{meter["meter_id"]} cooldown is over, probing')
+                if not pool.submit(meter['meter_id'], probe_meter, group=meter.get(group_by), adaptive=False, meter=meter, logger=logger):
+                    breaker.probed(meter['meter_id'], False, now)
+
+            # Sleep until the next meter is due, returns earlier when a query is finished
+            # At most 1s, the config, meter list and stats timers are checked here as well
+            for meter_id, fn, kwargs, error in pool.poll(scheduler.wait(limit=1)):
+                now = time.time()
+                if fn is probe_meter:
+                    breaker.probed(meter_id, error is None, now)
+                    if error is None:
+                        # Trial session right away
+                        logger.info(f'{meter_id} probe OK, reading')
+                        for d in data_ids:
+                            scheduler.advance((meter_id, d), now)
+                    continue
+                session_finished(meter_id, kwargs, error, now, breaker, scheduler, logger)
+
+            if time.time() // flush_interval > flush_timer:
+                db.flush()
+                flush_timer = time.time() // flush_interval
+
+            if time.time() // stats_interval > stats_timer:
+                pool.stats()
+                db.stats()
+                logger.info('Meters ' + ', '.join(f'{name} {count}' for name, count in breaker.stats().items()))
+                stats_timer = time.time() // stats_interval
+    finally:
+        # Ctrl+C or sys.exit(), the running sessions finish and the queued p01_from and p98_from are written
+        pool.shutdown()
+        db.flush()
 
 
 if __name__ == '__main__':
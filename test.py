@@ -48,7 +48,7 @@ class IECTest(unittest.TestCase):
         m = client.Meter(**IECTest.meter_in)
         m.readLoadProfile(1)
         print(m.data)
-        self.assertIn('P.01', m.data, 'No data received')
+        self.assertIn(b'P.01', m.data, 'No data received')
         
         #self.assertIsInstance(test_response, dict, '\nAPI response is not a dict')
         #self.assertIn('dt', test_response, '\nNo "dt" section in API response')
@@ -57,13 +57,13 @@ class IECTest(unittest.TestCase):
         m = client.Meter(**IECTest.meter_in)
         m.readErrorLog()
         print(m.data)
-        self.assertIn('F.F', m.data, 'No data received')
+        self.assertIn(b'F.F', m.data, 'No data received')
 
     def test_readTable1(self):
         m = client.Meter(**IECTest.meter_in)
         m.readList('1')
         print(m.data)
-        self.assertIn('F.F', m.data, 'No data received')
+        self.assertIn(b'F.F', m.data, 'No data received')
           
 
 if __name__ == '__main__':
@@ -0,0 +1,67 @@
+import unittest
+from iec6205621.breaker import Breaker
+
+
+class BreakerTest(unittest.TestCase):
+
+    meter = {'meter_id': '10067967', 'ip_address': '192.168.121.101', 'port': 8000}
+
+    def test_retry(self):
+        breaker = Breaker(retry_delay=30, threshold=3)
+        now = 1661264100
+        self.assertEqual(breaker.failed('10067967', now, BreakerTest.meter), now + 30)
+        self.assertEqual(breaker.failed('10067967', now + 30), now + 30 + 60)
+        self.assertTrue(breaker.allows('10067967'))
+        # Success resets the backoff
+        breaker.succeeded('10067967')
+        self.assertEqual(breaker.failed('10067967', now + 100), now + 100 + 30)
+
+    def test_data_type_retry(self):
+        breaker = Breaker(retry_delay=30, threshold=2)
+        now = 1661264100
+        # The meter answers, P.98 fails: backoff of its own, never parked
+        for n in range(4):
+            self.assertEqual(breaker.retry(('10067967', 'p98'), now), now + 30 * 2 ** n)
+        self.assertTrue(breaker.allows('10067967'))
+        self.assertEqual(breaker.retry(('10067967', 'p01'), now), now + 30)
+        breaker.succeeded('10067967', ['p98'])
+        self.assertEqual(breaker.retry(('10067967', 'p98'), now), now + 30)
+        breaker.prune([])
+        self.assertEqual(breaker.backoff, {})
+
+    def test_breaker(self):
+        breaker = Breaker(retry_delay=30, threshold=3, cooldown=3600, max_cooldown=5000)
+        now = 1661264100
+        for n in range(2):
+            breaker.failed('10067967', now, BreakerTest.meter)
+        self.assertIsNone(breaker.failed('10067967', now), 'Not parked after 3 failures')
+        self.assertFalse(breaker.allows('10067967'))
+        self.assertEqual(breaker.probes(now + 3599), [])
+
+        # Probe failed - twice the cooldown, up to max_cooldown
+        self.assertEqual(breaker.probes(now + 3600), [BreakerTest.meter])
+        self.assertFalse(breaker.allows('10067967'), 'Sessions while probing')
+        breaker.probed('10067967', False, now + 3600)
+        self.assertEqual(breaker.probes(now + 3600 + 4999), [])
+        self.assertEqual(breaker.probes(now + 3600 + 5000), [BreakerTest.meter])
+
+        # Probe OK - trial session, its failure parks the meter again
+        breaker.probed('10067967', True, now + 8600)
+        self.assertTrue(breaker.allows('10067967'))
+        self.assertIsNone(breaker.failed('10067967', now + 8610))
+        breaker.probes(now + 8610 + 5000)
+        breaker.probed('10067967', True, now + 8610 + 5000)
+        breaker.succeeded('10067967')
+        self.assertEqual(breaker.failed('10067967', now + 20000), now + 20000 + 30)
+
+        stats = breaker.stats()
+        self.assertEqual((stats['retry'], stats['opened'], stats['probes'], stats['parked']), (1, 3, 3, 2))
+        breaker.failed('08354050', now + 20000)
+        breaker.remove(['08354050'])
+        self.assertEqual(breaker.stats()['retry'], 1)
+        breaker.prune([])
+        self.assertEqual(breaker.stats()['retry'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
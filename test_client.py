@@ -0,0 +1,53 @@
+import socket
+import threading
+import unittest
+from unittest import mock
+from iec6205621 import client
+
+
+class ClientTest(unittest.TestCase):
+
+    meter = {'meter_id': '10067967', 'manufacturer': 'EMH', 'ip_address': '127.0.0.1', 'use_id': False}
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+
+    def tearDown(self):
+        self.sock.close()
+
+    def _meter(self, answer: bytes):
+        """
+        Meter answering every request with answer, nothing for b''
+        """
+        def serve():
+            conn, _ = self.sock.accept()
+            with conn:
+                while conn.recv(64):
+                    if answer:
+                        conn.sendall(answer)
+
+        threading.Thread(target=serve, daemon=True).start()
+        return client.Meter(timeout=4, port=self.sock.getsockname()[1], **ClientTest.meter)
+
+    def test_on_chunk_error(self):
+        m = self._meter(b'/EMH5\\@01LZQJL0014F\r\n')
+
+        def on_chunk(chunk):
+            raise ValueError('Broken data set')
+
+        # Parser errors are not the network
+        with self.assertRaises(ValueError):
+            m._sendcmd(b'/?!\r\n', etx=m.LF, on_chunk=on_chunk)
+        m.close()
+
+    def test_no_answer(self):
+        m = self._meter(b'')
+        with mock.patch.object(client.Meter, 'Tr', 0.2):
+            with self.assertRaises(client.NoAnswer):
+                m._sendcmd(b'/?!\r\n', etx=m.LF)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import logging
+import unittest
+from unittest import mock
+from iec6205621 import cluster
+from iec6205621.cluster import HashRing
+
+logger = logging.getLogger()
+
+
+class FakeRedis:
+    """
+    Commands of Cluster on dicts shared by every node like one Redis server, zsets as member => score
+    """
+    data = dict()
+
+    def __init__(self, **config):
+        pass
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def zadd(self, key, mapping):
+        FakeRedis.data.setdefault(key, dict()).update(mapping)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = FakeRedis.data.get(key, dict())
+        for member in [m for m, score in zset.items() if score <= high]:
+            del zset[member]
+
+    def zrange(self, key, start, end):
+        zset = FakeRedis.data.get(key, dict())
+        return [m.encode() for m in sorted(zset, key=lambda m: (zset[m], m))]
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in FakeRedis.data:
+            return None
+        FakeRedis.data[key] = value
+        return True
+
+    def register_script(self, script):
+        # The lease release script: deletes the key only if it holds our node id
+        def release(keys, args):
+            if FakeRedis.data.get(keys[0]) == args[0]:
+                del FakeRedis.data[keys[0]]
+                return 1
+            return 0
+        return release
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class HashRingTest(unittest.TestCase):
+
+    meters = [str(10067967 + n) for n in range(10000)]
+
+    def test_balance(self):
+        ring = HashRing([f'collector{n}' for n in range(1, 5)])
+        owners = [ring.owner(meter_id) for meter_id in HashRingTest.meters]
+        for node in ring.nodes:
+            self.assertGreater(owners.count(node), 1500, f'{node} owns too few meters')
+            self.assertLess(owners.count(node), 3500, f'{node} owns too many meters')
+        self.assertIsNone(HashRing([]).owner('10067967'))
+        # Same owner on every node and after a restart
+        self.assertEqual(owners, [HashRing(reversed(ring.nodes)).owner(m) for m in HashRingTest.meters])
+
+    def test_rebalance(self):
+        ring = HashRing([f'collector{n}' for n in range(1, 5)])
+        joined = HashRing([f'collector{n}' for n in range(1, 6)])
+        moved = [m for m in HashRingTest.meters if ring.owner(m) != joined.owner(m)]
+        # Only the new node takes meters, about 1/5 of them
+        self.assertEqual({joined.owner(m) for m in moved}, {'collector5'})
+        self.assertLess(len(moved), 3500)
+
+        # Meters of a dead node go to the others, the rest stay
+        died = HashRing(['collector1', 'collector2', 'collector4'])
+        moved = [m for m in HashRingTest.meters if ring.owner(m) != died.owner(m)]
+        self.assertEqual({ring.owner(m) for m in moved}, {'collector3'})
+        self.assertEqual(len(moved), [ring.owner(m) for m in HashRingTest.meters].count('collector3'))
+
+
+class ClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeRedis.data = dict()
+        patcher = mock.patch.object(cluster, 'Redis', FakeRedis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def node(self, node_id):
+        return cluster.Cluster(logger, 'meters:all', node_id=node_id, heartbeat=10, node_ttl=30)
+
+    def test_heartbeat(self):
+        now = 1661264100
+        node1, node2 = self.node('collector1'), self.node('collector2')
+        self.assertTrue(node1.heartbeat(now))
+        self.assertEqual(node1.ring.nodes, ['collector1'])
+        self.assertTrue(node2.heartbeat(now + 1))
+        self.assertFalse(node2.heartbeat(now + 5), 'Heartbeat before the interval')
+        self.assertTrue(node1.heartbeat(now + 10))
+        self.assertEqual(node1.ring.nodes, ['collector1', 'collector2'])
+        self.assertEqual([node1.owns(m) for m in HashRingTest.meters[:100]], [not node2.owns(m) for m in HashRingTest.meters[:100]])
+
+        # collector2 died, dropped after node_ttl without a heartbeat, collector1 takes its meters
+        self.assertFalse(node1.heartbeat(now + 30))
+        self.assertTrue(node1.heartbeat(now + 40))
+        self.assertEqual(node1.ring.nodes, ['collector1'])
+        self.assertTrue(all(node1.owns(m) for m in HashRingTest.meters[:100]))
+
+    def test_lease(self):
+        node1, node2 = self.node('collector1'), self.node('collector2')
+        self.assertTrue(node1.acquire('10067967'))
+        self.assertFalse(node2.acquire('10067967'))
+        self.assertIsNone(node2.leased('10067967', lambda: 'read twice'))
+        # Only the holder releases the lease
+        node2.release('10067967')
+        self.assertFalse(node2.acquire('10067967'))
+        node1.release('10067967')
+        self.assertEqual(node2.leased('10067967', lambda: 'read'), 'read')
+        self.assertNotIn('lease:meters:all:10067967', FakeRedis.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
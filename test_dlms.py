@@ -0,0 +1,250 @@
+import datetime
+import socket
+import struct
+import sys
+import threading
+import unittest
+from unittest import mock
+from iec6205621 import client
+from iec6205621 import dlms
+from iec6205621 import parser
+import logging
+
+Log_Format = "%(levelname)s %(asctime)s - %(message)s"
+
+logging.basicConfig(stream=sys.stdout,
+                    format=Log_Format,
+                    level=logging.DEBUG)
+logger = logging.getLogger()
+
+
+class DlmsStandInServer(threading.Thread):
+    """
+    Local stand-in for a mode E capable meter
+    Answers the IEC 62056-21 handshake, then HDLC/DLMS requests for the P.01 profile generic object
+    Small segment and block sizes force HDLC segmentation and GET block transfer
+    """
+
+    max_info = 64
+    block_size = 100
+    # False - the meter doesn't confirm DISC with UA
+    answer_disc = True
+
+    channels = ['1-0:1.29.0.255', '1-0:2.29.0.255', '1-0:5.29.0.255', '1-0:6.29.0.255', '1-0:7.29.0.255', '1-0:8.29.0.255']
+    units = [30, 30, 32, 32, 32, 32]
+
+    def __init__(self, rows):
+        super().__init__(daemon=True)
+        self.rows = rows
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.address = None
+        self.pending = []
+        self.blocks = []
+        self.send_sequence = 0
+        self.receive_sequence = 0
+        self.requests = []
+
+    def _frame(self, control, info=b'', segmented=False):
+        return dlms.hdlc_frame(self.client_address, self.address, control, info, segmented)
+
+    def _send_pdu(self, pdu):
+        info = dlms.LLC_RESPONSE + pdu
+        segments = [info[i:i + self.max_info] for i in range(0, len(info), self.max_info)]
+        self.pending = []
+        for index, segment in enumerate(segments):
+            control = (self.receive_sequence << 5) | 0x10 | (self.send_sequence << 1)
+            self.send_sequence = (self.send_sequence + 1) % 8
+            self.pending.append(self._frame(control, segment, segmented=index < len(segments) - 1))
+        self.conn.sendall(self.pending.pop(0))
+
+    def _get_response(self, data):
+        if len(data) <= self.block_size:
+            return b'\xc4\x01\xc1\x00' + data
+        self.blocks = [data[i:i + self.block_size] for i in range(0, len(data), self.block_size)]
+        return self._next_block(1)
+
+    def _next_block(self, number):
+        block = self.blocks[number - 1]
+        last = number == len(self.blocks)
+        return b'\xc4\x02\xc1' + bytes([last]) + struct.pack('>I', number) + b'\x00' + dlms.encode_length(len(block)) + block
+
+    def _attribute(self, class_id, obis, attribute, access):
+        if class_id == dlms.CLASS_PROFILE_GENERIC and attribute == 3:
+            capture_objects = [(dlms.CLASS_CLOCK, dlms.CLOCK_OBIS), (dlms.CLASS_DATA, '0-0:96.10.1.255')]
+            capture_objects += [(dlms.CLASS_REGISTER, c) for c in self.channels]
+            return dlms.encode_data(dlms.ARRAY, [(dlms.STRUCTURE, [
+                (dlms.LONG_UNSIGNED, c), (dlms.OCTET_STRING, dlms.obis_to_bytes(o)), (dlms.INTEGER, 2), (dlms.LONG_UNSIGNED, 0)
+            ]) for c, o in capture_objects])
+        elif class_id == dlms.CLASS_PROFILE_GENERIC and attribute == 4:
+            return dlms.encode_data(dlms.DOUBLE_LONG_UNSIGNED, 900)
+        elif class_id == dlms.CLASS_PROFILE_GENERIC and attribute == 2:
+            _, time_from, time_to, _ = dlms.decode_data(access, 1)[0]
+            time_from = dlms.decode_datetime(time_from)[0]
+            time_to = dlms.decode_datetime(time_to)[0]
+            rows = []
+            for ts, status, values in self.rows:
+                if time_from <= ts <= time_to:
+                    rows.append((dlms.STRUCTURE, [(dlms.OCTET_STRING, dlms.encode_datetime(ts)), (dlms.UNSIGNED, status)] +
+                                 [(dlms.DOUBLE_LONG_UNSIGNED, v) if v is not None else (dlms.NULL, None) for v in values]))
+            return dlms.encode_data(dlms.ARRAY, rows)
+        elif class_id == dlms.CLASS_REGISTER and attribute == 3:
+            unit = self.units[self.channels.index(dlms.obis_to_str(dlms.obis_to_bytes(obis)) + '.255')]
+            return dlms.encode_data(dlms.STRUCTURE, [(dlms.INTEGER, 0), (dlms.ENUM, unit)])
+        return None
+
+    def _apdu(self, pdu):
+        self.requests.append(pdu)
+        if pdu[0] == dlms.AARQ:
+            body = b'\xa1\x09\x06\x07\x60\x85\x74\x05\x08\x01\x01\xa2\x03\x02\x01\x00\xa3\x05\xa1\x03\x02\x01\x00'
+            body += b'\xbe\x10\x04\x0e\x08\x00\x06\x5f\x1f\x04\x00\x00\x10\x14\x04\x00\x00\x07'
+            return bytes([dlms.AARE]) + dlms.encode_length(len(body)) + body
+        elif pdu[0] == dlms.RLRQ:
+            return b'\x63\x03\x80\x01\x00'
+        elif pdu[:2] == b'\xc0\x02':
+            return self._next_block(struct.unpack('>I', pdu[3:7])[0] + 1)
+        elif pdu[:2] == b'\xc0\x01':
+            class_id = struct.unpack('>H', pdu[3:5])[0]
+            logical_name = pdu[5:11]
+            obis = f'{logical_name[0]}-{logical_name[1]}:' + '.'.join(str(i) for i in logical_name[2:])
+            access = pdu[13:] if pdu[12] else None
+            data = self._attribute(class_id, obis, pdu[11], access)
+            if data is None:
+                return b'\xc4\x01\xc1\x01\x04'
+            return self._get_response(data)
+
+    def _read_frame(self, buffer):
+        while len(buffer) < 3 or len(buffer) < (struct.unpack('>H', buffer[1:3])[0] & 0x07FF) + 2:
+            chunk = self.conn.recv(1024)
+            if not chunk:
+                return None, b''
+            buffer += chunk
+        length = (struct.unpack('>H', buffer[1:3])[0] & 0x07FF) + 2
+        return dlms.parse_hdlc_frame(buffer[:length]), buffer[length:]
+
+    def run(self):
+        self.conn, _ = self.sock.accept()
+        buffer = b''
+        while not buffer.endswith(b'!\r\n'):
+            buffer += self.conn.recv(64)
+        self.conn.sendall(b'/MCS5\\2@0050010067967\r\n')
+
+        buffer = b''
+        while not buffer.endswith(b'\r\n'):
+            buffer += self.conn.recv(64)
+        self.mode_select = buffer
+        self.conn.sendall(buffer)
+
+        buffer = b''
+        while True:
+            frame, buffer = self._read_frame(buffer)
+            if frame is None:
+                break
+            self.address = frame['dest']
+            self.client_address = frame['src']
+            control = frame['control']
+            if control == dlms.SNRM:
+                self.conn.sendall(self._frame(dlms.UA))
+            elif control == dlms.DISC:
+                if self.answer_disc:
+                    self.conn.sendall(self._frame(dlms.UA))
+                break
+            elif control & 0x0F == 0x01:
+                # RR - next segment
+                self.conn.sendall(self.pending.pop(0))
+            elif not control & 0x01:
+                self.receive_sequence = (self.receive_sequence + 1) % 8
+                self._send_pdu(self._apdu(frame['info'][3:]))
+        self.conn.close()
+        self.sock.close()
+
+
+class DlmsTest(unittest.TestCase):
+
+    meter = {
+            'id': 9,
+            'manufacturer': 'metcom',
+            'meter_id': '10067967',
+            'ip_address': '127.0.0.1',
+            'port': 8000,
+            'use_id': False,
+            'password': None,
+            'timezone': 'CET',
+            'p01_from': '2024-03-01T00:00:00+0100',
+            'mode_e': True,
+            }
+
+    rows = [
+        (datetime.datetime(2024, 3, 1, 0, 15), 0, [183, 0, 6, 0, 0, 24]),
+        (datetime.datetime(2024, 3, 1, 0, 30), 0, [168, 0, 0, 0, 0, 26]),
+        (datetime.datetime(2024, 3, 1, 0, 45), 8, [172, 1, 0, 0, 0, 27]),
+        (datetime.datetime(2024, 3, 1, 1, 0), 8, [166, 0, 0, 0, 0, 25]),
+        (datetime.datetime(2024, 3, 1, 1, 30), 8, [171, 0, 0, 0, 0, 22]),
+        (datetime.datetime(2024, 3, 1, 23, 0), 0, [150, 0, 0, 0, 0, 20]),
+        ]
+
+    def test_crc16(self):
+        self.assertEqual(dlms.crc16(b'123456789'), 0x906E, 'CRC-16/X.25 check value failed')
+
+    def test_hdlc_frame(self):
+        frame = dlms.hdlc_frame(dlms.encode_address(0x11, 1), dlms.encode_address(0x10), 0x10, b'\xe6\xe6\x00\x60\x00')
+        parsed = dlms.parse_hdlc_frame(frame)
+        self.assertEqual(parsed['info'], b'\xe6\xe6\x00\x60\x00', 'HDLC frame roundtrip failed')
+        self.assertEqual(parsed['control'], 0x10, 'HDLC frame roundtrip failed')
+
+    def test_snrm_frame(self):
+        # Well known SNRM frame, client 0x10, server 0x01 (one byte address)
+        frame = dlms.hdlc_frame(b'\x03', dlms.encode_address(0x10), dlms.SNRM)
+        self.assertEqual(frame.hex(), '7ea0070321930f017e', 'SNRM frame encoding failed')
+
+    def test_readLoadProfileModeE(self):
+        server = DlmsStandInServer(DlmsTest.rows)
+        server.start()
+        meter = dict(DlmsTest.meter, port=server.port)
+        m = client.Meter(timeout=4, **meter)
+        raw_data = m.readLoadProfile(profile_number='1')
+        server.join(5)
+
+        self.assertEqual(server.mode_select, b'\x06252\r\n', 'Mode E option select not sent')
+        # Row at 23:00 is outside of the requested range
+        self.assertEqual(raw_data.count(b'P.01('), 3, 'New header expected on status change and gap')
+        self.assertIn(b'(1-0:1.29.0)(kWh)', raw_data, 'Channel header not rendered')
+
+        p = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **meter)
+        parsed_data = p.parse()
+        # Status 8 is DST, not a p01-status record
+        self.assertEqual(len(parsed_data), 30, 'Parse mode E P01 failed')
+        self.assertEqual(parsed_data[0]['value'], '0.18300', 'Scaler/unit not applied')
+        self.assertEqual(parsed_data[0]['id'], '1.29.0', 'Channel OBIS not rendered')
+
+    def test_readLoadProfileModeE_null(self):
+        # NULL-data value of 1-0:2.29.0 at 00:30, no UA for DISC after the profile is read
+        rows = list(DlmsTest.rows)
+        rows[1] = (rows[1][0], rows[1][1], [168, None, 0, 0, 0, 26])
+        server = DlmsStandInServer(rows)
+        server.answer_disc = False
+        server.start()
+        meter = dict(DlmsTest.meter, port=server.port)
+        m = client.Meter(timeout=4, **meter)
+        with mock.patch.object(client.Meter, 'Tr', 0.5):
+            raw_data = m.readLoadProfile(profile_number='1')
+        server.join(5)
+
+        self.assertIn(b'(0.16800)()(0.00000)', raw_data, 'NULL value expected empty')
+        parsed_data = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **meter).parse()
+        self.assertEqual(len(parsed_data), 29, 'Profile lost without UA for DISC')
+
+    def test_render_profile_null_status(self):
+        profile = {
+            'capture_period': 900,
+            'columns': [(dlms.CLASS_CLOCK, dlms.CLOCK_OBIS, 2), (dlms.CLASS_DATA, '0-0:96.10.1.255', 2), (dlms.CLASS_REGISTER, '1-0:1.29.0.255', 2)],
+            'scaler_units': {2: (0, 30)},
+            'rows': [[dlms.encode_datetime(datetime.datetime(2024, 3, 1, 0, 15)), None, None]],
+        }
+        self.assertEqual(dlms.render_profile('P.01', profile, 2).split(b'\r\n')[1], b'()')
+
+
+if __name__ == '__main__':
+    unittest.main()
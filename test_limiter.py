@@ -0,0 +1,46 @@
+import unittest
+from iec6205621.limiter import AIMD
+
+
+class AIMDTest(unittest.TestCase):
+
+    def test_increase(self):
+        limit = AIMD(4, maximum=8)
+        self.assertTrue(limit.allows(3))
+        self.assertFalse(limit.allows(4))
+        # One more session after about a full round of healthy ones
+        for n in range(5):
+            limit.done(True, 100.0 + n, 110.0 + n)
+        self.assertEqual(int(limit.limit), 5)
+        for n in range(100):
+            limit.done(True, 200.0 + n, 210.0 + n)
+        self.assertEqual(limit.limit, 8, 'Above maximum')
+        self.assertFalse(limit.throttled)
+
+    def test_decrease(self):
+        limit = AIMD(32, minimum=2)
+        limit.done(False, 100.0, 112.0)
+        self.assertEqual(limit.limit, 16)
+        # The same storm of timeouts, sessions started before the decrease
+        for n in range(10):
+            limit.done(False, 101.0 + n, 113.0 + n)
+        self.assertEqual(limit.limit, 16)
+        self.assertTrue(limit.throttled)
+        # Next round
+        limit.done(False, 120.0, 130.0)
+        self.assertEqual(limit.limit, 8)
+        for n in range(10):
+            limit.done(False, 200.0 + 20 * n, 210.0 + 20 * n)
+        self.assertEqual(limit.limit, 2, 'Below minimum')
+
+    def test_slow(self):
+        limit = AIMD(4, maximum=8)
+        limit.done(True, 100.0, 110.0)
+        value = limit.limit
+        # 30s session against 10s average, the network is getting slower
+        limit.done(True, 200.0, 230.0)
+        self.assertEqual(limit.limit, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from iec6205621.obis import Obis
+
+
+class ObisTest(unittest.TestCase):
+
+    def test_parse(self):
+        obis = Obis.parse('1-0:1.8.0*12')
+        self.assertEqual((obis.a, obis.b, obis.c, obis.d, obis.e, obis.f), ('1', '0', '1', '8', '0', '12'))
+        self.assertEqual(obis.short, '1.8.0*12')
+        self.assertEqual(Obis.parse('1-1:1.29').short, '1.29')
+        self.assertEqual(Obis.parse(b'1-0:81.7.26').short, '81.7.26')
+        self.assertEqual((Obis.parse('p02-1.8.0').prefix, Obis.parse('p02-1.8.0').short), ('p02', '1.8.0'))
+        self.assertEqual(Obis.parse('0.9.1-value').suffix, 'value')
+        self.assertEqual((Obis.parse('C.90.2').c, Obis.parse('F.F').d), ('C', 'F'))
+
+        # Not an OBIS code, kept as it is
+        obis = Obis.parse('p99_bit3')
+        self.assertIsNone(obis.c)
+        self.assertEqual(obis.short, 'p99_bit3')
+
+    def test_interned(self):
+        self.assertIs(Obis.parse('1-0:1.8.0'), Obis.parse(b'1-0:1.8.0'))
+        self.assertIs(Obis.parse(Obis.parse('1.8.0')), Obis.parse('1.8.0'))
+        # Dict keyed by Obis is found by the plain string as well
+        cache = {Obis.parse('1.8.0'): 12}
+        self.assertEqual(cache['1.8.0'], 12)
+        self.assertIn(Obis.parse('1.8.0'), cache)
+
+    def test_metadata(self):
+        for spelling in ['1.5.0', '1-0:1.5.0', '1.5', '1-1:1.5.0*12']:
+            obis = Obis.parse(spelling)
+            self.assertEqual(obis.zabbix_key, 'positiveActiveDemand', spelling)
+            self.assertEqual(obis.transform, 'totalFactor', spelling)
+            self.assertEqual(obis.table_description, 'Positive active demand', spelling)
+
+        self.assertEqual(Obis.parse('bill-1.5.0').zabbix_key, 'Z-1-1.1.29.0')
+        self.assertEqual(Obis.parse('bill-1.5.0').transform, 'totalFactor')
+        self.assertEqual(Obis.parse('p02-1-0:1.8.0').description, 'Positive active energy (A+) total [kWh]')
+        self.assertEqual(Obis.parse('0.9.1').transform, 'None')
+        self.assertEqual(Obis.parse('32.25').zabbix_key, 'voltagePhaseL1')
+        self.assertEqual(Obis.parse('99.99.99').zabbix_key, None)
+        self.assertEqual(Obis.parse('p99_bit3').description, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
+import os
 import sys
+import time
 import unittest
 from time import sleep
 from iec6205621 import parser
+from iec6205621 import record
 import logging
 
 Log_Format = "%(levelname)s %(asctime)s - %(message)s"
@@ -110,8 +113,14 @@ class IECTest(unittest.TestCase):
         p = parser.Parser(raw_data=IECTest.P01_data_2, data_type='P.01', logger=logger, **IECTest.meter_emh)
         p._parseP01()
         p.log('DEBUG', f'\n\n{p.parsed_data}')
+        # Block status (08) is DST only, no p01-status records
         self.assertEqual(len(p.parsed_data), 24, 'Parse Metcom P01 failed')
 
+        # Power down in summer time (88), DST is masked out
+        raw_data = IECTest.P01_data_2.replace('(08)', '(88)', 1)
+        parsed_data = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **IECTest.meter_metcom).parse()
+        self.assertEqual([r['value'] for r in parsed_data if r['id'] == 'p01-status'], ['128'] * 4, 'PDN flag expected')
+
     def test_parseP01_3(self):
         p = parser.Parser(raw_data=IECTest.P01_data_3, data_type='P.01', logger=logger, **IECTest.meter_emh)
         p._parseP01()
@@ -123,7 +132,9 @@ class IECTest(unittest.TestCase):
         p.log('DEBUG', f'\n\nParsing {IECTest.P01_data_4}\n\n')
         p._parseP01()
         p.log('DEBUG', f'\n\nParsed data: {p.parsed_data}\n\n')
-        self.assertEqual(len(p.parsed_data), 36, 'Parse EMH P01 set 4 failed')
+        # 36 values and the power down (80) status of the first interval
+        self.assertEqual(len(p.parsed_data), 37, 'Parse EMH P01 set 4 failed')
+        self.assertEqual(p.parsed_data[6], {'id': 'p01-status', 'value': '128', 'unit': None, 'line_time': '1699866900'})
 
     def test_parseP98_1(self):
         p = parser.Parser(raw_data=IECTest.P98_data_1, data_type='P.98', logger=logger, **IECTest.meter_emh)
@@ -165,6 +176,268 @@ class IECTest(unittest.TestCase):
         p.log('DEBUG', f'\n\n{p.parsed_data}')
         self.assertEqual(len(p.parsed_data), 31, 'Parse MCS Table2 failed')
 
+    def test_tokenize(self):
+        tokens = parser.Parser.tokenize(b'1-0:1.6.1*12(0.39912*kW)(2210130900)')
+        self.assertEqual(tokens, (b'1-0:', b'1.6.1*12', [(b'0.39912', b'kW'), (b'2210130900', b'')]), 'Tokenize data set failed')
+
+    def test_parseHexAndAlphanumericValues(self):
+        raw_data = 'F.F(00000000)\r\nC.90.2(70D4EF6C)\r\n0.0.0(1EMH0010134075)\r\n1.6.1(0.50262*kW)(2211120730)\r\n0.9.1(14:45:59)\r\n!\r\n'
+        p = parser.Parser(raw_data=raw_data, data_type='list1', logger=logger, **IECTest.meter_emh)
+        p._parse_list1()
+        self.assertEqual(p.parsed_data, [
+            {'id': 'F.F', 'value': '00000000', 'unit': None},
+            {'id': 'C.90.2', 'value': '70D4EF6C', 'unit': None},
+            {'id': '0.0.0', 'value': '1EMH0010134075', 'unit': None},
+            {'id': '1.6.1', 'value': '0.50262', 'unit': 'kW'},
+            {'id': '0.9.1', 'value': '14:45:59', 'unit': None},
+            ], 'Parse hex and alphanumeric values failed')
+
+    def test_parseP01_columnar(self):
+        p = parser.Parser(raw_data=IECTest.P01_data_3, data_type='p01', logger=logger, **IECTest.meter_emh)
+        profile = p.parse_columnar()
+        self.assertEqual(profile.values.shape, (2, 8), 'Columnar EMH P01 failed')
+        self.assertEqual(profile.ts[1] - profile.ts[0], 900, 'Columnar EMH P01 timestamps failed')
+        self.assertEqual(profile.obis[7], '1-3:2.29', 'Columnar EMH P01 header failed')
+
+        records = profile.to_records()
+        parsed_data = parser.Parser(raw_data=IECTest.P01_data_3, data_type='p01', logger=logger, **IECTest.meter_emh).parse()
+        self.assertEqual([(r['id'], float(r['value']), r['unit'], r['line_time']) for r in records],
+                         [(r['id'], float(r['value']), r['unit'], r['line_time']) for r in parsed_data],
+                         'Columnar to_records() differs from parse()')
+
+    def test_parseP01_timestamps(self):
+        # 2022-08-23 16:15 CEST = 14:15 UTC, independent from the process timezone
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            p = parser.Parser(raw_data=IECTest.P01_data_1, data_type='p01', logger=logger, **IECTest.meter_emh)
+            parsed_data = p.parse()
+            profile = parser.Parser(raw_data=IECTest.P01_data_1, data_type='p01', logger=logger, **IECTest.meter_emh).parse_columnar()
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+        self.assertEqual(parsed_data[0]['line_time'], '1661264100', 'P01 timestamp is not timezone correct')
+        self.assertEqual(parsed_data[-1]['line_time'], '1661265000', 'P01 timestamp is not timezone correct')
+        self.assertEqual(profile.ts.tolist(), [1661264100, 1661265000], 'Columnar P01 timestamps failed')
+
+    def test_parseP01_dst(self):
+        # 2022-10-30 02:30 CET happens twice, the season code of the header decides like in the logbooks
+        for season, line_time in [(b'1', 1667089800), (b'0', 1667093400)]:
+            raw_data = b'P.01(' + season + b'221030023000)(00000000)(15)(1)(1.5)(kW)\r\n(0.1)\r\n'
+            p = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **IECTest.meter_emh)
+            self.assertEqual(p.parse()[0]['line_time'], str(line_time), f'P01 season {season} failed')
+            profile = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **IECTest.meter_emh).parse_columnar()
+            self.assertEqual(profile.ts.tolist(), [line_time], f'Columnar P01 season {season} failed')
+            log = parser.Parser(raw_data=b'P.98(' + season + b'221030023000)(00000010)()(0)\r\n', data_type='p98', logger=logger, **IECTest.meter_emh)
+            self.assertEqual(log.parse()[0]['line_time'], str(line_time), f'P98 season {season} failed')
+
+    def test_parseP01_columnar_header_change(self):
+        raw_data = IECTest.P01_data_2 + 'P.01(1220823160000)(08)(15)(8)(1-0:1.5.0)(kW)(1-0:2.5.0)(kW)(1-0:5.5.0)(kvar)(1-0:6.5.0)(kvar)(1-0:7.5.0)(kvar)(1-0:8.5.0)(kvar)(1-0:1.29.0)(kWh)(1-0:2.29.0)(kWh)\r\n(0.00000)(0.12683)(0.00000)(0.11411)(0.00000)(0.00000)(0.00000)(0.03171)\r\n'
+        p = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **IECTest.meter_metcom)
+        profile = p.parse_columnar()
+        self.assertEqual(profile.values.shape, (5, 8), 'Columnar header change failed')
+        self.assertEqual(profile.status.tolist(), [8] * 5, 'Columnar status failed')
+        self.assertTrue(all(v != v for v in profile.values[:4, 7]), 'Missing channel expected as NaN')
+        self.assertEqual(len(profile.to_records()), 32, 'NaN values are not records')
+
+
+    def test_parseProfile_generic(self):
+        # z=3 P.03 average values, layout change, broken line and a truncated last line
+        raw_data = (
+            b'P.03(1220823161500)(00000000)(15)(3)(1.5)(kW)(32.5)(V)(81.5)(deg)\r\n'
+            b'(0.18374)(230.1)(-12.5)\r\n'
+            b'(0.18)(0.00)\r\n'
+            b'P.03(1220823164500)(00000000)(15)(2)(1.5)(kW)(13.5)()\r\n'
+            b'(0.16832)(0.98)\r\n'
+            b'(0.17)(0.9'
+        )
+        p = parser.Parser(raw_data=raw_data, data_type='p03', logger=logger, **IECTest.meter_emh)
+        parsed_data = p.parse()
+        self.assertEqual(len(parsed_data), 5, 'Parse generic profile failed')
+        self.assertEqual(parsed_data[2], {'id': 'p03-81.5', 'value': '-12.5', 'unit': 'deg', 'line_time': '1661264100'})
+        self.assertEqual(p.resume_ts, 1661265900, 'Resume timestamp is not the last complete interval')
+
+        profile = parser.Parser(raw_data=raw_data, data_type='p03', logger=logger, **IECTest.meter_emh).parse_columnar()
+        self.assertEqual(profile.ts.tolist(), [1661264100, 1661265900])
+        self.assertEqual(profile.to_records(), [dict(r, value=str(float(r['value']))) for r in parsed_data])
+
+    def test_parseP01_truncated(self):
+        # Readout cut by timeout, copied from the log as it is rendered by client.normalize_log()
+        raw_data = IECTest.P01_data_4.replace('\r\n', '<CR><LF>')
+        raw_data = '<STX>' + raw_data + '(0.21'
+        p = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **IECTest.meter_metcom)
+        self.assertEqual(len(p.parse()), 37, 'Complete rows of a truncated readout are lost')
+        # 2023-11-13 11:30:00 CET, the 5th row of the second block
+        self.assertEqual(p.resume_ts, 1699871400, 'Resume timestamp is not the last complete interval')
+
+        # The same readout as received, fed in chunks
+        stream = parser.Parser(b'', data_type='p01', logger=logger, compact=True, **IECTest.meter_metcom)
+        data = parser.Parser.unrender(raw_data.encode() + b'<CR><LF><ETX>~<SOH>B0<ETX>')
+        readings = list(stream.stream(data[i:i + 64] for i in range(0, len(data), 64)))
+        self.assertEqual(len(readings), 37)
+        self.assertEqual(stream.resume_ts, p.resume_ts)
+
+    def test_obis_filter(self):
+        meter = dict(IECTest.meter_metcom, obis_filter='1-0:1.8.0, 1.6.1*12,32.7.0')
+        p = parser.Parser(raw_data=IECTest.Table1_data, data_type='list1', logger=logger, **meter)
+        self.assertEqual([r['id'] for r in p.parse()], ['1.8.0'], 'List1 filter failed')
+        p = parser.Parser(raw_data=IECTest.Table2_data_1, data_type='list2', logger=logger, **meter)
+        self.assertEqual([(r['id'], r['value']) for r in p.parse()], [('32.7.0', '57.90')], 'List2 filter failed')
+
+        meter = dict(IECTest.meter_metcom, obis_filter=['1.5.0', '8.5.0'])
+        parsed_data = parser.Parser(raw_data=IECTest.P01_data_2, data_type='p01', logger=logger, **meter).parse()
+        self.assertEqual([r['id'] for r in parsed_data], ['1.5.0', '8.5.0'] * 4, 'P01 filter failed')
+        profile = parser.Parser(raw_data=IECTest.P01_data_2, data_type='p01', logger=logger, **meter).parse_columnar()
+        self.assertEqual(profile.ids, ['1.5.0', '8.5.0'])
+        self.assertEqual([dict(r, value=float(r['value'])) for r in profile.to_records()],
+                         [dict(r, value=float(r['value'])) for r in parsed_data])
+
+    def test_obis_filter_emh(self):
+        # EMH short channel ids '1.5', '1-1:1.29' match any spelling of the filter
+        meter = dict(IECTest.meter_emh, obis_filter='1.5.0, 1-0:2.5.0')
+        parsed_data = parser.Parser(raw_data=IECTest.P01_data_1, data_type='p01', logger=logger, **meter).parse()
+        self.assertEqual([r['id'] for r in parsed_data], ['1.5', '2.5'] * 2, 'EMH P01 filter failed')
+        profile = parser.Parser(raw_data=IECTest.P01_data_1, data_type='p01', logger=logger, **meter).parse_columnar()
+        self.assertEqual(profile.ids, ['1.5', '2.5'])
+
+        meter = dict(IECTest.meter_emh, obis_filter=['1.29.0', '1-2:1.29'])
+        parsed_data = parser.Parser(raw_data=IECTest.P01_data_3, data_type='p01', logger=logger, **meter).parse()
+        self.assertEqual(len(parsed_data), 4, 'EMH P01 channel filter failed')
+
+        # Two channels of the same C.D, only the listed one
+        meter = dict(IECTest.meter_emh, obis_filter='1-2:1.29')
+        parsed_data = parser.Parser(raw_data=IECTest.P01_data_3, data_type='p01', logger=logger, **meter).parse()
+        self.assertEqual([r['id'] for r in parsed_data], ['1-2:1.29'] * 2, 'EMH P01 A-B channel filter failed')
+        profile = parser.Parser(raw_data=IECTest.P01_data_3, data_type='p01', logger=logger, **meter).parse_columnar()
+        self.assertEqual(profile.ids, ['1-2:1.29'])
+
+        # History values only if listed
+        meter = dict(IECTest.meter_metcom, obis_filter='1.6.1')
+        parsed_data = parser.Parser(raw_data=IECTest.Table1_data, data_type='list1', logger=logger, **meter).parse()
+        self.assertEqual([r['id'] for r in parsed_data], ['1.6.1'])
+
+    def test_parseProfile_bad_header(self):
+        raw_data = b'P.01(1220823161500)(00000000)(15)(6)(1.5)(kW)\r\n(0.1)(0.2)\r\nP.01(1220823163000)(00000000)(15)(1)(1.5)(kW)\r\n(0.3)\r\n'
+        p = parser.Parser(raw_data=raw_data, data_type='p01', logger=logger, **IECTest.meter_emh)
+        self.assertEqual([(r['value'], r['line_time']) for r in p.parse()], [('0.3', '1661265000')], 'Block after a broken header is lost')
+
+    def test_compact(self):
+        for data, data_type, meter in [
+                (IECTest.P01_data_3, 'p01', IECTest.meter_emh),
+                (IECTest.P98_data_2, 'p98', IECTest.meter_metcom),
+                (IECTest.Table1_data, 'list1', IECTest.meter_metcom)]:
+            parsed_data = parser.Parser(raw_data=data, data_type=data_type, logger=logger, **meter).parse()
+            readings = parser.Parser(raw_data=data, data_type=data_type, logger=logger, compact=True, **meter).parse()
+            self.assertEqual(len(readings), len(parsed_data), f'Compact {data_type} failed')
+            for r, d in zip(readings, parsed_data):
+                self.assertEqual(set(r.keys()), set(d.keys()))
+                self.assertEqual((r['id'], r['unit'], str(r.get('line_time', 'None'))), (d['id'], d['unit'], d.get('line_time', 'None')))
+                if isinstance(r.value, float):
+                    self.assertEqual(r.value, float(d['value']))
+                else:
+                    self.assertEqual(r.value, d['value'])
+
+            # Redis payload
+            self.assertEqual(record.loads(record.dumps(readings)), readings)
+            self.assertLess(len(record.dumps(readings)), len(record.dumps(parsed_data)) * 0.7)
+        self.assertEqual(record.loads(record.dumps(parsed_data)), parsed_data, 'Dict payload changed')
+
+        reading = readings[1]
+        self.assertIs(reading.id, sys.intern('0.0.0'))
+        self.assertEqual(reading, {'id': '0.0.0', 'value': '10067967', 'unit': None})
+        self.assertFalse(hasattr(reading, '__dict__'))
+        # DB text of the float values, no exponent
+        self.assertEqual([record.text(v) for v in [1e-05, 1281.6601, '00002000']], ['0.00001', '1281.6601', '00002000'])
+
+    def test_generated_payloads(self):
+        import bench_parser
+        for manufacturer in ['emh', 'metcom']:
+            g = bench_parser.Generator(manufacturer)
+            meter = bench_parser.meters[manufacturer]
+            p01 = g.p01(z=8 if manufacturer == 'emh' else 6, days=2)
+            parsed_data = parser.Parser(raw_data=p01, data_type='p01', logger=logger, **meter).parse()
+            self.assertEqual(len(parsed_data), 2 * 96 * (8 if manufacturer == 'emh' else 6), f'Generated {manufacturer} P01 failed')
+            self.assertEqual(len({r['line_time'] for r in parsed_data}), 2 * 96, 'Generated P01 intervals overlap')
+
+            parsed_data = parser.Parser(raw_data=g.malformed(p01), data_type='p01', logger=logger, **meter).parse()
+            self.assertLess(len(parsed_data), 2 * 96 * 8)
+            p = parser.Parser(raw_data=g.truncated(p01), data_type='p01', logger=logger, **meter)
+            self.assertTrue(p.parse())
+            self.assertIsNotNone(p.resume_ts)
+
+            parsed_data = parser.Parser(raw_data=g.p98(entries=500), data_type='p98', logger=logger, **meter).parse()
+            self.assertEqual(len(parsed_data), 500 if manufacturer == 'emh' else 1000, f'Generated {manufacturer} P98 failed')
+
+    def test_parseP98_duplicates(self):
+        p = parser.Parser(raw_data=IECTest.P98_data_1, data_type='p98', logger=logger, **IECTest.meter_emh)
+        parsed_data = p.parse()
+        self.assertEqual([r['value'] for r in parsed_data], ['00002000', '00004000', '00000100', '00000080'], 'P98 order changed')
+        self.assertEqual(int(parsed_data[1]['line_time']) - int(parsed_data[0]['line_time']), 1, 'Same second entries expected one second apart')
+
+        # Backfill after an outage, many entries in the same second
+        raw_data = 'P.98(1220901000000)(00000010)()(0)\r\n' * 20000
+        parsed_data = parser.Parser(raw_data=raw_data, data_type='p98', logger=logger, **IECTest.meter_emh).parse()
+        self.assertEqual(len({r['line_time'] for r in parsed_data}), 20000, 'P98 timestamps are not unique')
+
+    def test_parseP98_broken_lines(self):
+        # Truncated and broken entries are skipped, the rest of the logbook is kept
+        raw_data = (
+            'P.98(1220826235646)(00008020)()(2)(0.9.1)()(0.9.2)()(1235703)(1220826)\r\n'
+            'P.98(12208\r\n'
+            'P.98(1220828235723)(0000\r\n'
+            'P.98(1220901000000)(00000010)()(0)\r\n'
+        )
+        parsed_data = parser.Parser(raw_data=raw_data, data_type='p98', logger=logger, **IECTest.meter_emh).parse()
+        self.assertEqual([r['value'] for r in parsed_data], ['00008020', '00000010'], 'P98 broken line failed')
+
+        raw_data = 'P.99(1201021132243)(0000ZZ00)()(0)\r\nP.99(1201021132500)(00002001)()(0)\r\n'
+        parsed_data = parser.Parser(raw_data=raw_data, data_type='p99', logger=logger, **IECTest.meter_emh).parse()
+        self.assertEqual([r['value'] for r in parsed_data], ['8193'], 'P99 broken status failed')
+
+    def test_parseP99(self):
+        raw_data = 'P.99(1201021132243)(00002001)()(0)\r\nP.99(1201021132500)(00000000)()(1)(0.9.1)()(132500;132510)\r\n'
+        p = parser.Parser(raw_data=raw_data, data_type='p99', logger=logger, **IECTest.meter_emh)
+        parsed_data = p.parse()
+        self.assertEqual(len(parsed_data), 2, 'Parse EMH P99 failed')
+        self.assertEqual((parsed_data[0]['id'], parsed_data[0]['value']), ('100.0.99', '8193'), 'P99 status word failed')
+        self.assertEqual((int(parsed_data[0]['value']) >> 13) & 1, 1, 'P99 bit 13 failed')
+
+        readings = parser.Parser(raw_data=raw_data, data_type='p99', logger=logger, compact=True, **IECTest.meter_metcom).parse()
+        self.assertEqual([(r.id, r.value) for r in readings], [('101.1.99', 8193), ('101.1.99', 0)])
+
+    def test_parseP200(self):
+        raw_data = 'P.200(1220906115553)(00000080)()(1)(0.9.1)()(115553)\r\n'
+        p = parser.Parser(raw_data=raw_data, data_type='p200', logger=logger, **IECTest.meter_emh)
+        self.assertEqual([(r['id'], r['value']) for r in p.parse()], [('100.0.200', '00000080'), ('p200-0.9.1', '115553')], 'Parse EMH P200 failed')
+
+    def test_stream(self):
+        for data, data_type, meter in [
+                (IECTest.P01_data_2, 'p01', IECTest.meter_metcom),
+                (IECTest.P98_data_1, 'p98', IECTest.meter_emh),
+                (IECTest.P98_data_2, 'p98', IECTest.meter_metcom),
+                (IECTest.Table1_data, 'list1', IECTest.meter_metcom),
+                (IECTest.Table2_data_1, 'list2', IECTest.meter_metcom),
+                (IECTest.FF_data, 'error', IECTest.meter_emh),
+                ]:
+            parsed_data = parser.Parser(raw_data=data, data_type=data_type, logger=logger, **meter).parse()
+
+            # Chunks as they come from the socket, lines are split in the middle
+            data = data.encode()
+            chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+            p = parser.Parser(raw_data=b'', data_type=data_type, logger=logger, **meter)
+            self.assertEqual(list(p.stream(chunks)), parsed_data, f'Streaming {data_type} differs from parse()')
+
+    def test_feed(self):
+        p = parser.Parser(raw_data=b'', data_type='p01', logger=logger, **IECTest.meter_emh)
+        header, line_1, line_2 = IECTest.P01_data_1.encode().split(b'\r\n')
+        self.assertEqual(p.feed(header + b'\r\n' + line_1[:10]), [], 'No complete data line yet')
+        self.assertEqual(len(p.feed(line_1[10:] + b'\r\n')), 6, 'Records of the complete line expected')
+        self.assertEqual(len(p.feed(line_2)), 0, 'Line without <CR><LF> is kept')
+        self.assertEqual(len(p.close()), 6, 'Last line is parsed by close()')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+import logging
+import threading
+import unittest
+from unittest import mock
+import request_sender as rs
+from iec6205621 import client
+from iec6205621.breaker import Breaker
+from iec6205621.scheduler import Scheduler
+
+logger = logging.getLogger()
+
+
+class FakeMeter:
+    """
+    Connected session, connects fails if FakeMeter.reachable is False
+    """
+    reachable = True
+
+    def __init__(self, **meter):
+        if not FakeMeter.reachable:
+            raise client.NoAnswer(0)
+
+    def close(self):
+        pass
+
+
+class SessionTest(unittest.TestCase):
+
+    meter = {'meter_id': '10067967', 'ip_address': '192.168.121.101', 'port': 8000, 'p01': 900, 'p98': 3600}
+    now = 1661264100
+
+    def setUp(self):
+        FakeMeter.reachable = True
+        self.breaker = Breaker(retry_delay=30, threshold=3)
+        self.scheduler = Scheduler()
+        jobs = [(SessionTest.meter, d) for d in ['p01', 'p98']]
+        self.scheduler.sync(jobs, lambda job: job[0][job[1]], key=lambda job: (job[0]['meter_id'], job[1]), now=SessionTest.now)
+        self.scheduler.due(SessionTest.now)
+
+    def session(self, errors: dict, now: float):
+        """
+        Runs process_session() for p01 and p98, errors is data_id => exception of its read
+        """
+        def process_data(meter, logger, data_id, db, session=None):
+            if data_id in errors:
+                raise errors[data_id]
+
+        kwargs = {'meter': SessionTest.meter, 'logger': logger, 'data_ids': ['p01', 'p98']}
+        error = None
+        with mock.patch.object(rs, 'MyMeter', FakeMeter), mock.patch.object(rs, 'process_data', process_data):
+            try:
+                rs.process_session(**kwargs)
+            except SystemExit as e:
+                error = e
+        rs.session_finished('10067967', kwargs, error, now, self.breaker, self.scheduler, logger)
+        return error
+
+    def test_silent_meter(self):
+        # TCP is accepted, the reads time out: parked like a closed port
+        for n in range(3):
+            error = self.session({'p01': client.NoAnswer(1), 'p98': client.NoAnswer(1)}, SessionTest.now + n)
+            self.assertIsInstance(error, client.NoAnswer)
+            self.assertNotIsInstance(error.code, list)
+        self.assertFalse(self.breaker.allows('10067967'), 'Silent meter is not parked')
+
+    def test_unreachable(self):
+        FakeMeter.reachable = False
+        self.assertEqual(self.session({}, SessionTest.now).code, 0)
+        self.assertEqual(self.breaker.meters['10067967'][0], 1)
+        self.assertEqual(self.scheduler.entries[('10067967', 'p01')][0], SessionTest.now + 30)
+
+    def test_partial(self):
+        # P.01 read, P.98 timed out: the breaker is closed, only P.98 is retried
+        self.breaker.failed('10067967', SessionTest.now)
+        error = self.session({'p98': client.NoAnswer(1)}, SessionTest.now)
+        self.assertEqual(error.code, ['p98'])
+        self.assertNotIn('10067967', self.breaker.meters)
+        self.assertEqual(self.scheduler.entries[('10067967', 'p98')][0], SessionTest.now + 30)
+        self.assertEqual(self.scheduler.entries[('10067967', 'p01')][0], SessionTest.now + 900)
+
+    def test_parser_error(self):
+        # The meter answered every read, never parked
+        for n in range(5):
+            error = self.session({'p01': SystemExit(1), 'p98': ValueError('Broken data set')}, SessionTest.now + n)
+            self.assertNotIsInstance(error, client.NoAnswer)
+        self.assertTrue(self.breaker.allows('10067967'))
+        self.assertEqual(self.breaker.backoff[('10067967', 'p98')], 5)
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = rs.MeterPool(logger, max_workers=4)
+        self.addCleanup(self.pool.shutdown)
+
+    def finish(self):
+        """
+        :return: meter ids of the queries finished by the next poll() which finishes any
+        """
+        for n in range(100):
+            finished = self.pool.poll(0.1)
+            if finished:
+                return [meter_id for meter_id, _, _, _ in finished]
+        self.fail('No query finished')
+
+    def test_group_limit(self):
+        def no_answer():
+            raise client.NoAnswer(0)
+
+        # The first timeout of the gateway halves both limits, the next ones only the group limit
+        self.pool.submit('10067967', no_answer, group='192.168.121.101')
+        self.finish()
+        self.assertEqual((self.pool.limit.limit, self.pool.group_limits['192.168.121.101'].limit), (2, 2))
+        self.pool.submit('10067968', no_answer, group='192.168.121.101')
+        self.finish()
+        self.assertEqual((self.pool.limit.limit, self.pool.group_limits['192.168.121.101'].limit), (2, 1))
+
+        # One session behind the throttled gateway, the meter of another gateway isn't queued behind the second one
+        release = threading.Event()
+        self.pool.submit('10067967', release.wait, group='192.168.121.101')
+        self.pool.submit('10067968', release.wait, group='192.168.121.101')
+        self.pool.submit('08354050', release.wait, group='192.168.121.102')
+        self.assertEqual(sorted(meter_id for meter_id, *_ in self.pool.running.values()), ['08354050', '10067967'])
+        self.assertEqual([item[0] for item in self.pool.waiting], ['10067968'])
+        self.assertFalse(self.pool.submit('10067968', release.wait), 'Meter queried twice')
+
+        release.set()
+        finished = self.finish()
+        while len(finished) < 3:
+            finished += self.finish()
+        self.assertEqual(sorted(finished), ['08354050', '10067967', '10067968'])
+        self.assertEqual((self.pool.completed, self.pool.failed, self.pool.skipped), (5, 2, 1))
+
+
+class FlushTest(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.object(rs.sqlalchemy, 'create_engine'):
+            self.db = rs.MeterDB(logger, pg_schema='meters')
+        self.conn = self.db.engine.begin.return_value.__enter__.return_value
+
+    def test_flush(self):
+        self.db.update_from_field('10067967', 'p01_from', time_from=1700506800)
+        self.db.update_from_field('08354050', 'p01_from', action='delete')
+        self.db.update_from_field('10067967', 'p98_from', time_from=1700000000)
+        # The last update of a field wins
+        self.db.update_from_field('10067967', 'p01_from', time_from=1700507700)
+        self.db.flush()
+
+        # One UPDATE per field for all meters, bound values
+        self.assertEqual(self.conn.execute.call_count, 2)
+        (query, params), _ = self.conn.execute.call_args_list[0]
+        self.assertIn('UPDATE meters.meters SET p01_from = to_timestamp(v.ts) FROM (VALUES', str(query))
+        self.assertEqual(params, {'m0': '10067967', 't0': 1700507700, 'm1': '08354050', 't1': None})
+        (query, params), _ = self.conn.execute.call_args_list[1]
+        self.assertIn('SET p98_from', str(query))
+        self.assertEqual(params, {'m0': '10067967', 't0': 1700000000})
+        self.assertEqual(self.db.pending, {})
+        self.db.flush()
+        self.assertEqual(self.conn.execute.call_count, 2, 'Nothing queued, nothing written')
+
+    def test_failed_flush(self):
+        def execute(query, params):
+            # Read again meanwhile, the newer watermark is kept
+            self.db.update_from_field('08354050', 'p01_from', time_from=1700508600)
+            raise Exception('server closed the connection unexpectedly')
+
+        self.conn.execute.side_effect = execute
+        self.db.update_from_field('10067967', 'p01_from', time_from=1700507700)
+        self.db.update_from_field('08354050', 'p01_from', time_from=1700506800)
+        self.db.flush()
+        self.assertEqual(self.db.pending, {('10067967', 'p01_from'): 1700507700, ('08354050', 'p01_from'): 1700508600})
+
+
+class ReloadTest(unittest.TestCase):
+
+    def test_watermarks(self):
+        # A watermark written by the session is not a change of the meter list
+        in_memory = {'9': {'id': 9, 'meter_id': '08354050', 'p01': 900, 'p01_from': '2023-11-13T10:30:00+00:00', 'p98_from': None}}
+        in_db = {'9': {'id': 9, 'meter_id': '08354050', 'p01': 900, 'p01_from': '2023-11-13T11:30:00+01:00', 'p98_from': None}}
+        self.assertEqual(rs.without_watermarks(in_memory), rs.without_watermarks(in_db))
+        in_db['9']['p01'] = 300
+        self.assertNotEqual(rs.without_watermarks(in_memory), rs.without_watermarks(in_db))
+
+
+if __name__ == '__main__':
+    unittest.main()
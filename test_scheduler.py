@@ -0,0 +1,116 @@
+import unittest
+from iec6205621.scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+    meters = [
+        {'meter_id': '10067967', 'p01': 900},
+        {'meter_id': '08354050', 'p01': 300},
+        {'meter_id': '1MCS0010045438', 'p01': 0},
+    ]
+
+    def test_slots(self):
+        scheduler = Scheduler()
+        now = 1661264100 + 10
+        scheduler.sync(SchedulerTest.meters, lambda meter: meter['p01'], now=now)
+        self.assertEqual(len(scheduler), 2, 'Meter with interval 0 is scheduled')
+
+        # New meters right away, then on the interval border like time.time() // interval
+        self.assertEqual(sorted(m['meter_id'] for m in scheduler.due(now)), ['08354050', '10067967'])
+        self.assertEqual(scheduler.due(now + 1), [])
+        self.assertEqual(scheduler.wait(now, limit=3600), 290)
+        self.assertEqual([m['meter_id'] for m in scheduler.due(1661264400)], ['08354050'])
+        self.assertEqual([m['meter_id'] for m in scheduler.due(1661265000)], ['08354050', '10067967'])
+
+    def test_sync_in_place(self):
+        scheduler = Scheduler()
+        now = 1661264100
+        scheduler.sync(SchedulerTest.meters, lambda meter: meter['p01'], now=now)
+        scheduler.due(now)
+
+        # Interval change moves the next run, a removed meter is not returned any more
+        meters = [{'meter_id': '10067967', 'p01': 60, 'ip': '192.168.121.101'}]
+        scheduler.sync(meters, lambda meter: meter['p01'], now=now + 5)
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.wait(now + 5), 55)
+        self.assertEqual(scheduler.due(now + 60), meters, 'Updated profile expected')
+        self.assertEqual(scheduler.due(now + 300), meters)
+        self.assertEqual(scheduler.due(now + 301), [])
+
+        # Nothing scheduled
+        scheduler.sync([], 900, now=now)
+        self.assertEqual(scheduler.wait(now, limit=1), 1)
+
+    def test_update(self):
+        scheduler = Scheduler()
+        now = 1661264100
+        scheduler.sync(SchedulerTest.meters, lambda meter: meter['p01'], now=now)
+        scheduler.due(now)
+
+        # Only the changed meters, the other one keeps its slot
+        meters = [{'meter_id': '10067967', 'p01': 0}, {'meter_id': '1MCS0010045438', 'p01': 900}]
+        self.assertEqual(scheduler.update(meters, lambda meter: meter['p01'], now=now + 5), {'1MCS0010045438'})
+        self.assertEqual(sorted(scheduler.entries), ['08354050', '1MCS0010045438'])
+        self.assertEqual([m['meter_id'] for m in scheduler.due(now + 5)], ['1MCS0010045438'])
+        self.assertEqual([m['meter_id'] for m in scheduler.due(now + 300)], ['08354050'])
+
+        scheduler.remove(['08354050', '10067967'])
+        self.assertEqual(list(scheduler.entries), ['1MCS0010045438'])
+        self.assertEqual(scheduler.due(now + 600), [])
+
+    def test_sessions(self):
+        scheduler = Scheduler()
+        meter = {'meter_id': '10067967', 'p01': 900, 'p98': 3600, 'list4': 30}
+        jobs = [(meter, d) for d in ['p01', 'p98', 'list4']]
+        scheduler.sync(jobs, lambda job: job[0][job[1]], key=lambda job: (job[0]['meter_id'], job[1]), now=1661263000)
+        self.assertEqual(len(scheduler.due(1661263000)), 3)
+
+        # Aligned slots, P.01 and P.98 are due at the same time
+        self.assertEqual(sorted(d for _, d in scheduler.due(1661266800)), ['list4', 'p01', 'p98'])
+
+        # list4 is taken 10s before its slot and is not run again on it
+        self.assertEqual(scheduler.due(1661266820), [])
+        self.assertEqual(scheduler.take(('10067967', 'list4'), 1661266830, now=1661266820), jobs[2])
+        self.assertEqual(scheduler.due(1661266830), [])
+        self.assertEqual(scheduler.due(1661266860), [jobs[2]])
+        self.assertIsNone(scheduler.take(('10067967', 'p01'), 1661266870, now=1661266860))
+
+        # Postponed behind a running session
+        scheduler.postpone(('10067967', 'p01'), 1661266865)
+        self.assertEqual(scheduler.due(1661266865), [jobs[0]])
+
+        # Retry before the next slot, then on the slots again. A retry after the next slot is not moved
+        self.assertTrue(scheduler.advance(('10067967', 'p01'), 1661266895))
+        self.assertIn(jobs[0], scheduler.due(1661266895))
+        self.assertEqual(scheduler.entries[('10067967', 'p01')][0], 1661267700)
+        self.assertFalse(scheduler.advance(('10067967', 'p01'), 1661267800))
+
+    def test_spread(self):
+        scheduler = Scheduler(spread=300)
+        meters = [{'meter_id': str(10067967 + n), 'p01': 900} for n in range(1000)]
+        now = 1661264100
+        scheduler.sync(meters, 900, now=now)
+        first = [m['meter_id'] for m in scheduler.due(now + 300)]
+        self.assertEqual(len(first), 1000, 'Restart is not spread over the window')
+
+        # Every meter keeps its own second after the slot, no one before it
+        offsets = dict()
+        for second in range(now + 900, now + 1800):
+            for m in scheduler.due(second):
+                offsets[m['meter_id']] = second - (now + 900)
+        self.assertEqual(len(offsets), 1000)
+        self.assertTrue(all(0 <= offset < 300 for offset in offsets.values()))
+        self.assertGreater(len(set(offsets.values())), 250, 'Meters are not spread')
+
+        # The same offset after a restart and for the other data types of the meter
+        scheduler = Scheduler(spread=300)
+        jobs = [(meters[0], 'p01'), (meters[0], 'p98')]
+        scheduler.sync(jobs, 900, key=lambda job: (job[0]['meter_id'], job[1]), now=now)
+        scheduler.due(now + 300)
+        self.assertEqual(scheduler.wait(now + 900, limit=900), offsets[meters[0]['meter_id']])
+        self.assertEqual(len(scheduler.due(now + 900 + offsets[meters[0]['meter_id']])), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()